@@ -55,6 +55,8 @@ _C.MODEL.NAME = 'DeBERTa-large'
 # Checkpoint to resume, could be overwritten by command line argument
 _C.MODEL.RESUME = ''
 _C.MODEL.NO_DECAY_KEYWORDS = ("LayerNorm.weight", "bias")
+# Factorize the FFN & 'in_proj' projections keeping this ratio of the SVD energy before training, None for off
+_C.MODEL.LOW_RANK_ENERGY = None
 
 # -----------------------------------------------------------------------------
 # Training settings
@@ -156,10 +158,28 @@ _C.PRUNE.PRUNING = False
 _C.PRUNE.SPARSITY = 0.9375
 _C.PRUNE.DEPLOY_DEVICE = 'none'
 _C.PRUNE.GROUP_SIZE = 64
+# (N, M) of the 'nm' deploy device, i.e. keep N of every M contiguous input weights
+_C.PRUNE.NM = (2, 4)
+# Tiles of the 'tile' deploy device are TILE_SIZE x TILE_SIZE, pruned as a whole
+_C.PRUNE.TILE_SIZE = 32
 _C.PRUNE.FREQUENCY = 100
 _C.PRUNE.FIXED_MASK = None
 _C.PRUNE.MASK = None
 _C.PRUNE.SPARSE_STEPS = 0
+# Plan file of per-layer target sparsities by 'engine/sparsity_plan.py', overrides SPARSITY
+_C.PRUNE.PLAN = None
+# Shard the mask computation across ranks & broadcast the packed masks
+_C.PRUNE.DISTRIBUTED = False
+# Mask gradients by hooks & keep optimizer states for the kept entries only
+_C.PRUNE.FUSE_OPTIMIZER = False
+# All-reduce only the kept gradient entries under DDP, the masks must be fixed('FIXED_MASK')
+_C.PRUNE.SPARSE_ALLREDUCE = False
+# Rank the weights by 'magnitude' or by accumulated 'movement' scores(-weight * grad)
+_C.PRUNE.CRITERION = 'magnitude'
+# Record the mask updates as deltas in 'mask_history.pmhist' of the output directory, see 'engine/mask_history.py'
+_C.PRUNE.HISTORY = False
+# Verify the bank constraints of the deploy device after every mask update
+_C.PRUNE.CHECK = False
 
 # -------------------------------------------------------------------------
 
@@ -223,6 +243,8 @@ def update_config_by_args(config: CN, args):
         config.MODEL.NAME = config.MODEL.TYPE.split('/')[-1].lower()
     if args.cls_dropout:
         config.MODEL.CLS_DROPOUT = args.cls_dropout
+    if args.low_rank_energy:
+        config.MODEL.LOW_RANK_ENERGY = args.low_rank_energy
     if args.use_slow_tokenizer:
         config.USE_SLOW_TOKENIZER = args.use_slow_tokenizer
     if args.weight_decay is not None:
@@ -287,6 +309,10 @@ def update_config_by_args(config: CN, args):
         config.PRUNE.DEPLOY_DEVICE = args.prune_deploy_device
     if args.prune_group_size:
         config.PRUNE.GROUP_SIZE = args.prune_group_size
+    if args.prune_nm:
+        config.PRUNE.NM = tuple(args.prune_nm)
+    if args.prune_tile_size:
+        config.PRUNE.TILE_SIZE = args.prune_tile_size
     if args.prune_frequency:
         config.PRUNE.FREQUENCY = args.prune_frequency
     if args.fixed_mask:
@@ -295,6 +321,18 @@ def update_config_by_args(config: CN, args):
         config.PRUNE.MASK = args.mask
     if args.sparse_steps is not None:
         config.PRUNE.SPARSE_STEPS = args.sparse_steps
+    if args.prune_plan:
+        config.PRUNE.PLAN = args.prune_plan
+    if args.prune_distributed:
+        config.PRUNE.DISTRIBUTED = True
+    if args.prune_fuse_optimizer:
+        config.PRUNE.FUSE_OPTIMIZER = True
+    if args.prune_sparse_allreduce:
+        config.PRUNE.SPARSE_ALLREDUCE = True
+    if args.prune_criterion:
+        config.PRUNE.CRITERION = args.prune_criterion
+    if args.prune_history:
+        config.PRUNE.HISTORY = True
     
     if args.kd_on:
         config.TRAIN.KD.ON = args.kd_on
@@ -0,0 +1,135 @@
+# --------------------------------------------------------
+# [Balanced Mask Benchmark] Parity & latency of the bank balanced mask kernels
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+"""
+    Check that the bank balanced mask kernels of 'Prune' produce exactly the same masks
+    as the original NumPy kernels, then time both of them.
+    The script exits with a non-zero code if any mask differs.
+
+    Run this script like:
+
+    python bench_balanced_mask.py --kernel asic_2d --sparsity 0.9375 --group_size 64 --device cpu
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+
+BASE_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(BASE_DIR, '..'))
+
+from pruner import Prune
+from legacy_pruner import LegacyPrune
+
+
+# Weight shapes covering divisible & non-divisible bank splits
+KERNEL_SHAPES = {
+    'fpga': [
+        (64, 64, 3, 3),
+        (128, 256, 3, 3),
+        (256, 512, 1, 1),
+        (96, 30, 3, 3),
+        (64, 7, 5, 5),
+        (512, 2046, 1, 1),
+    ],
+    'asic_2d': [
+        (4096, 1024),
+        (1024, 4096),
+        (3072, 1024),
+        (100, 700),
+        (64, 515),
+    ],
+    'asic_4d': [
+        (64, 64, 3, 3),
+        (128, 200, 3, 3),
+        (256, 1024, 1, 1),
+        (64, 520, 1, 1),
+    ],
+}
+
+KERNEL_METHODS = {
+    'fpga': '_update_mask_fpga',
+    'asic_2d': '_update_mask_asic_2d',
+    'asic_4d': '_update_mask_asic_4d',
+}
+
+DEPLOY_DEVICES = {
+    'fpga': 'fpga',
+    'asic_2d': 'asic',
+    'asic_4d': 'asic',
+}
+
+
+def build_pruner(pruner_cls, shape, kernel, group_size, device):
+    model = nn.Module()
+    model.weight = nn.Parameter(torch.randn(shape, device=device))
+    pruner = pruner_cls(model, prune_dict={'weight': 0.}, deploy_device=DEPLOY_DEVICES[kernel], group_size=group_size)
+
+    return model, pruner
+
+
+def run_kernel(pruner, kernel, weight, keep_k, repeat, device):
+    """Returns the mean latency(seconds) & the resulting mask."""
+
+    update = getattr(pruner, KERNEL_METHODS[kernel])
+    # Warm up, also builds the cached bank layouts
+    update('weight', weight, keep_k)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+    start = time.time()
+    for _ in range(repeat):
+        update('weight', weight, keep_k)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+    return (time.time() - start) / repeat, pruner._mask['weight'].bool()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Parity & latency of the balanced mask kernels")
+    parser.add_argument('--kernel', type=str, default='fpga', choices=list(KERNEL_SHAPES.keys()))
+    parser.add_argument('--sparsity', type=float, nargs='+', default=[0.5, 0.9375])
+    parser.add_argument('--group_size', type=int, default=64)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    device = torch.device(args.device)
+
+    failed = 0
+    for shape in KERNEL_SHAPES[args.kernel]:
+        torch.manual_seed(args.seed)
+        model, pruner = build_pruner(Prune, shape, args.kernel, args.group_size, device)
+        if 'weight' not in pruner._prune_dict:
+            print(f"=> skip {shape}, it can not be balanced pruned")
+            continue
+        _, legacy_pruner = build_pruner(LegacyPrune, shape, args.kernel, args.group_size, device)
+
+        # Random weights have no ties, where top-k may break them differently
+        weight = model.weight.data
+        for sparsity in args.sparsity:
+            keep_k = int(weight.numel() * (1. - sparsity))
+            legacy_time, legacy_mask = run_kernel(legacy_pruner, args.kernel, weight, keep_k, args.repeat, device)
+            current_time, current_mask = run_kernel(pruner, args.kernel, weight, keep_k, args.repeat, device)
+
+            identical = torch.equal(legacy_mask, current_mask)
+            failed += not identical
+            print(f"{str(shape):<24} sparsity {sparsity:<8} "
+                  f"legacy: {legacy_time * 1000:9.2f}ms\tcurrent: {current_time * 1000:9.2f}ms\t"
+                  f"speedup: {legacy_time / current_time:7.2f}x\tidentical: {identical}")
+
+    if failed:
+        sys.exit(f"=> {failed} mask(s) differ from the legacy kernel")
@@ -0,0 +1,107 @@
+# --------------------------------------------------------
+# [Block Sparse Benchmark] Latency of tile pruned Linear layers against dense ones
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+"""
+    Prune the Linear layers of a DeBERTa layer with the tile deploy device of 'Prune', then
+    compare the forward latency of 'BlockSparseLinear' with the dense 'nn.Linear' on CPU.
+    The outputs of both are checked to match.
+
+    Run this script like:
+
+    python bench_block_sparse.py --model_size large --tile_size 32 --sparsity 0.5 0.75 0.875 0.9375
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+
+BASE_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(BASE_DIR, '..'))
+
+from pruner import Prune
+from sparse import BlockSparseLinear
+
+
+# (hidden size, intermediate size)
+MODEL_SHAPES = {
+    'base': (768, 3072),
+    'large': (1024, 4096),
+}
+
+
+def layer_shapes(hidden_size, intermediate_size):
+    """(in features, out features) of the pruned Linear layers of a DeBERTa layer."""
+
+    return {
+        'attention.self.in_proj': (hidden_size, 3 * hidden_size),
+        'attention.output.dense': (hidden_size, hidden_size),
+        'intermediate.dense': (hidden_size, intermediate_size),
+        'output.dense': (intermediate_size, hidden_size),
+    }
+
+
+def tile_prune(linear, sparsity, tile_size):
+    # A single sparse step reaches the target sparsity at the first 'prune()'
+    pruner = Prune(
+        linear, pretrain_step=0, sparse_step=1, frequency=1,
+        prune_dict={'weight': sparsity}, deploy_device='tile', tile_size=tile_size
+    )
+    pruner.prune()
+
+    return linear
+
+
+def time_forward(module, input, repeat):
+    with torch.no_grad():
+        module(input)
+        start = time.time()
+        for _ in range(repeat):
+            output = module(input)
+
+    return (time.time() - start) / repeat, output
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Latency of block sparse Linear layers on CPU")
+    parser.add_argument('--model_size', type=str, default='base', choices=list(MODEL_SHAPES.keys()))
+    parser.add_argument('--tile_size', type=int, default=32)
+    parser.add_argument('--sparsity', type=float, nargs='+', default=[0.5, 0.75, 0.875, 0.9375])
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--seq_len', type=int, default=128)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=42)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+
+    hidden_size, intermediate_size = MODEL_SHAPES[args.model_size]
+    print(f"=> DeBERTa-{args.model_size}, tile {args.tile_size}x{args.tile_size}, "
+          f"{args.batch_size}x{args.seq_len} tokens, {torch.get_num_threads()} threads")
+
+    for name, (in_features, out_features) in layer_shapes(hidden_size, intermediate_size).items():
+        input = torch.randn(args.batch_size, args.seq_len, in_features)
+        for sparsity in args.sparsity:
+            linear = tile_prune(nn.Linear(in_features, out_features), sparsity, args.tile_size)
+            block_sparse = BlockSparseLinear.from_dense(linear, args.tile_size)
+
+            dense_time, dense_output = time_forward(linear, input, args.repeat)
+            sparse_time, sparse_output = time_forward(block_sparse, input, args.repeat)
+            error = (dense_output - sparse_output).abs().max().item()
+
+            print(f"{name:<24} {in_features:>5}->{out_features:<5} sparsity {sparsity:<7} "
+                  f"dense: {dense_time * 1000:8.2f}ms\tblock sparse: {sparse_time * 1000:8.2f}ms\t"
+                  f"speedup: {dense_time / sparse_time:6.2f}x\tmax error: {error:.2e}")
@@ -0,0 +1,83 @@
+# --------------------------------------------------------
+# [Low-Rank Benchmark] CPU latency & fidelity of low-rank factorized DeBERTa
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+"""
+    Factorize a DeBERTa with 'factorize_model' at a list of energy thresholds and compare each with
+    the dense model: parameters, CPU inference latency & throughput, and the agreement of the predicted
+    labels & the max logit error on the same inputs. With '--checkpoint' a fine-tuned model is used,
+    otherwise a random one, whose flat spectrum keeps most layers dense unless the energy is low.
+    The task accuracy after fine-tuning is given by 'run_glue.py --low_rank_energy'.
+
+    Run this script like:
+
+    python bench_lowrank.py --model_size base --energies 0.5 0.7 0.9
+    python bench_lowrank.py --checkpoint best.pth --energies 0.8 0.9 0.95
+"""
+
+import os
+import sys
+import copy
+import argparse
+
+import torch
+
+BASE_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(BASE_DIR, '..'))
+sys.path.append(os.path.join(BASE_DIR, '..', '..'))
+
+from lowrank import factorize_model, count_parameters
+from export_sparse import MODEL_CLASSES, load_pruned_checkpoint
+from bench_sparse_inference import MODEL_SHAPES, build_config, time_inference
+from models.configuration_deberta import DebertaConfig
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="CPU inference of dense & low-rank factorized DeBERTa")
+    parser.add_argument('--checkpoint', type=str, help='fine-tuned checkpoint, a random model is used if not given')
+    parser.add_argument('--task', type=str, default='cls', choices=list(MODEL_CLASSES.keys()))
+    parser.add_argument('--model_size', type=str, default='base', choices=list(MODEL_SHAPES.keys()))
+    parser.add_argument('--energies', type=float, nargs='+', default=[0.5, 0.7, 0.9])
+    parser.add_argument('--multiple', type=int, default=8)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--seq_len', type=int, default=128)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+
+    if args.checkpoint:
+        state_dict, model_config = load_pruned_checkpoint(args.checkpoint)
+        dense = MODEL_CLASSES[args.task](DebertaConfig.from_dict(model_config))
+        dense.load_state_dict(state_dict)
+    else:
+        dense = MODEL_CLASSES[args.task](build_config(args.model_size))
+    dense.eval()
+
+    input_ids = torch.randint(1, dense.config.vocab_size, (args.batch_size, args.seq_len))
+    tokens = args.batch_size * args.seq_len
+    dense_time, dense_logits = time_inference(dense, input_ids, args.repeat)
+
+    print(f"=> {args.batch_size}x{args.seq_len} tokens, {torch.get_num_threads()} threads")
+    print(f"dense:        {count_parameters(dense) / 1e6:6.1f}M params\t{dense_time * 1000:8.2f}ms/batch\t"
+          f"{tokens / dense_time:.1f} tokens/s")
+    for energy in args.energies:
+        model = copy.deepcopy(dense)
+        ranks = factorize_model(model, energy, args.multiple)
+        model_time, logits = time_inference(model, input_ids, args.repeat)
+        # For QA models the start logits are compared
+        agreement = (logits.argmax(-1) == dense_logits.argmax(-1)).float().mean().item()
+        error = (logits - dense_logits).abs().max().item()
+        print(f"energy {energy:<5} {count_parameters(model) / 1e6:6.1f}M params\t{model_time * 1000:8.2f}ms/batch\t"
+              f"{tokens / model_time:.1f} tokens/s\tspeedup {dense_time / model_time:.2f}x\t"
+              f"{len(ranks)} layers factorized\tlabel agreement {agreement:.4f}\tmax logit error {error:.2e}")
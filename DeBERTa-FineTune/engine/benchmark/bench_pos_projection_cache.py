@@ -0,0 +1,110 @@
+# --------------------------------------------------------
+# [Position Projection Cache Benchmark] DeBERTa inference with & without the cached relative embedding projection
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+"""
+    Compare DeBERTa inference with the per-layer cache of the projected relative position embeddings
+    of 'models.modeling_deberta' on & off('POS_PROJECTION_CACHE'), on batches of varying lengths as
+    with dynamic padding:
+        i.   the forward latency, the outputs of both are checked to be equal;
+        ii.  the cache invalidation, after the 'pos_proj' & 'pos_q_proj' weights are modified in place
+             (as by an optimizer step) the cached outputs must still equal the uncached ones.
+    The script exits with a non-zero code if the outputs differ beyond '--atol'.
+
+    Run this script like:
+
+    python bench_pos_projection_cache.py --model_size large --seq_lens 128 256 384 --batch_size 4 --device cuda
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+
+BASE_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(BASE_DIR, '..'))
+sys.path.append(os.path.join(BASE_DIR, '..', '..'))
+
+import models.modeling_deberta as modeling_deberta
+
+from models.modeling_deberta import DebertaModel
+from bench_sparse_inference import MODEL_SHAPES, build_config
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+@torch.no_grad()
+def forward_all(model, batches):
+    return [model(input_ids)[0] for input_ids in batches]
+
+
+def time_forward(model, batches, device, repeat):
+    forward_all(model, batches)
+    synchronize(device)
+    start = time.time()
+    for _ in range(repeat):
+        outputs = forward_all(model, batches)
+    synchronize(device)
+
+    return (time.time() - start) / (repeat * len(batches)), outputs
+
+
+def compare(model, batches, device, repeat):
+    results = {}
+    # The cached one goes first, since the uncached forward drops the cache
+    for tag, enabled in (('cached', True), ('uncached', False)):
+        modeling_deberta.POS_PROJECTION_CACHE = enabled
+        results[tag] = time_forward(model, batches, device, repeat)
+    error = max((cached - uncached).abs().max().item()
+                for cached, uncached in zip(results['cached'][1], results['uncached'][1]))
+
+    return results['uncached'][0], results['cached'][0], error
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="DeBERTa inference with & without the position projection cache")
+    parser.add_argument('--model_size', type=str, default='large', choices=list(MODEL_SHAPES.keys()))
+    parser.add_argument('--seq_lens', type=int, nargs='+', default=[128, 256, 384])
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--atol', type=float, default=1e-4)
+    parser.add_argument('--seed', type=int, default=42)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+
+    config = build_config(args.model_size)
+    model = DebertaModel(config).to(device).eval()
+    batches = [torch.randint(1, config.vocab_size, (args.batch_size, seq_len), device=device)
+               for seq_len in args.seq_lens]
+
+    print(f"=> DeBERTa-{args.model_size}, batch size {args.batch_size}, lengths {args.seq_lens}, on {device}")
+    uncached_time, cached_time, error = compare(model, batches, device, args.repeat)
+    print(f"uncached: {uncached_time * 1000:8.2f}ms/batch\tcached: {cached_time * 1000:8.2f}ms/batch\t"
+          f"speedup: {uncached_time / cached_time:.2f}x\tmax output difference: {error:.2e}")
+
+    # Fill the cache, then update in place, which bumps the version counters & must invalidate it
+    modeling_deberta.POS_PROJECTION_CACHE = True
+    forward_all(model, batches)
+    with torch.no_grad():
+        for name, parameter in model.named_parameters():
+            if name.endswith(('pos_proj.weight', 'pos_q_proj.weight')):
+                parameter.mul_(1.5)
+    _, _, update_error = compare(model, batches, device, 1)
+    print(f"after in-place weight update: max output difference {update_error:.2e}")
+
+    if max(error, update_error) > args.atol:
+        sys.exit(1)
@@ -0,0 +1,132 @@
+# --------------------------------------------------------
+# [Pruner Benchmark] Per-step prune latency of the mask kernels
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+"""
+    Compare the per-step latency of 'Prune.prune()' on a mask update step between
+    the current mask kernels and the original NumPy based ones.
+    No pretrained weight is needed, parameters are built with DeBERTa shapes.
+
+    Run this script like:
+
+    python bench_prune.py --model_size large --num_layers 24 --sparsity 0.9375 --device cuda
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+
+BASE_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(BASE_DIR, '..'))
+sys.path.append(os.path.join(BASE_DIR, '..', '..'))
+
+from pruner import Prune
+from legacy_pruner import LegacyPrune
+
+
+# (hidden size, intermediate size)
+MODEL_SHAPES = {
+    'base': (768, 3072),
+    'large': (1024, 4096),
+}
+
+
+def build_model(hidden_size, intermediate_size, num_layers):
+    """A parameter-only stand-in with the same prunable parameter names as DeBERTa."""
+
+    model = nn.Module()
+    model.encoder = nn.Module()
+    model.encoder.layer = nn.ModuleList()
+    for _ in range(num_layers):
+        layer = nn.Module()
+        layer.attention = nn.Module()
+        layer.attention.self = nn.Module()
+        layer.attention.self.in_proj = nn.Linear(hidden_size, 3 * hidden_size, bias=False)
+        layer.attention.output = nn.Module()
+        layer.attention.output.dense = nn.Linear(hidden_size, hidden_size)
+        layer.intermediate = nn.Module()
+        layer.intermediate.dense = nn.Linear(hidden_size, intermediate_size)
+        layer.output = nn.Module()
+        layer.output.dense = nn.Linear(intermediate_size, hidden_size)
+        model.encoder.layer.append(layer)
+
+    return model
+
+
+def build_prune_dict(model, sparsity):
+    # Same targets as 'run_glue.py'
+    return {
+        name: sparsity for name, _ in model.named_parameters()
+        if name.endswith(('attention.self.in_proj.weight', 'attention.output.dense.weight',
+                          'intermediate.dense.weight', 'output.dense.weight'))
+    }
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_prune(pruner_cls, model, args, device):
+    """Mean latency(seconds) of a 'prune()' call which updates every mask."""
+
+    # frequency=1 makes every call a mask update step
+    pruner = pruner_cls(
+        model, pretrain_step=0, sparse_step=args.warmup + args.repeat, frequency=1,
+        prune_dict=build_prune_dict(model, args.sparsity), deploy_device=args.deploy_device,
+        group_size=args.group_size
+    )
+    for _ in range(args.warmup):
+        pruner.prune()
+    synchronize(device)
+
+    start = time.time()
+    for _ in range(args.repeat):
+        pruner.prune()
+    synchronize(device)
+
+    return (time.time() - start) / args.repeat, pruner
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark per-step prune latency")
+    parser.add_argument('--model_size', type=str, default='large', choices=list(MODEL_SHAPES.keys()))
+    parser.add_argument('--num_layers', type=int, default=24)
+    parser.add_argument('--sparsity', type=float, default=0.9375)
+    parser.add_argument('--deploy_device', type=str, default='none')
+    parser.add_argument('--group_size', type=int, default=64)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    device = torch.device(args.device)
+    hidden_size, intermediate_size = MODEL_SHAPES[args.model_size]
+
+    results = {}
+    masks = {}
+    for tag, pruner_cls in (('legacy', LegacyPrune), ('current', Prune)):
+        # Same initial weights for both kernels
+        torch.manual_seed(args.seed)
+        model = build_model(hidden_size, intermediate_size, args.num_layers).to(device)
+        results[tag], pruner = time_prune(pruner_cls, model, args, device)
+        masks[tag] = {name: mask.bool() for name, mask in pruner._mask.items()}
+
+    # Ties of top-k are the only source of difference
+    mismatch = sum(int((masks['legacy'][name] != masks['current'][name]).sum()) for name in masks['legacy'])
+    print(f"=> DeBERTa-{args.model_size} x{args.num_layers} layers, sparsity {args.sparsity}, "
+          f"deploy device '{args.deploy_device}', on {device}")
+    print(f"legacy:  {results['legacy'] * 1000:.2f}ms/step")
+    print(f"current: {results['current'] * 1000:.2f}ms/step")
+    print(f"speedup: {results['legacy'] / results['current']:.2f}x\tmismatched mask entries: {mismatch}")
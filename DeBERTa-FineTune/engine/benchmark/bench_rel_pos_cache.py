@@ -0,0 +1,100 @@
+# --------------------------------------------------------
+# [Relative Position Cache Benchmark] DeBERTa forward with & without the cached gather indices
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+"""
+    Compare a DeBERTa forward at the SQuAD length(L=384 by default) with the relative position &
+    c2p/p2c gather index cache of 'models.modeling_deberta' on & off('RELATIVE_POSITION_CACHE'):
+        i.  the index preparation alone, i.e. 'build_relative_position' once plus the indices of
+            every layer, as done by one forward;
+        ii. the whole forward, the outputs of both are checked to be equal.
+
+    Run this script like:
+
+    python bench_rel_pos_cache.py --model_size large --seq_len 384 --batch_size 4 --device cuda
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+
+BASE_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(BASE_DIR, '..'))
+sys.path.append(os.path.join(BASE_DIR, '..', '..'))
+
+import models.modeling_deberta as modeling_deberta
+
+from models.modeling_deberta import DebertaModel, build_relative_position
+from bench_sparse_inference import MODEL_SHAPES, build_config
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def prepare_indices(seq_len, att_span, num_layers, device):
+    relative_pos = build_relative_position(seq_len, seq_len, device)
+    if modeling_deberta._use_position_cache():
+        for _ in range(num_layers):
+            modeling_deberta._cached_relative_position_index(seq_len, seq_len, att_span, device)
+    else:
+        for _ in range(num_layers):
+            modeling_deberta._relative_position_index(relative_pos.unsqueeze(1), seq_len, seq_len, att_span, device)
+
+
+def time_fn(fn, device, repeat):
+    fn()
+    synchronize(device)
+    start = time.time()
+    for _ in range(repeat):
+        output = fn()
+    synchronize(device)
+
+    return (time.time() - start) / repeat, output
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="DeBERTa forward with & without the relative position cache")
+    parser.add_argument('--model_size', type=str, default='large', choices=list(MODEL_SHAPES.keys()))
+    parser.add_argument('--seq_len', type=int, default=384)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=42)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+
+    config = build_config(args.model_size)
+    model = DebertaModel(config).to(device).eval()
+    input_ids = torch.randint(1, config.vocab_size, (args.batch_size, args.seq_len), device=device)
+    att_span = min(args.seq_len, config.max_relative_positions if config.max_relative_positions > 0
+                   else config.max_position_embeddings)
+
+    results = {}
+    for tag, enabled in (('uncached', False), ('cached', True)):
+        modeling_deberta.RELATIVE_POSITION_CACHE = enabled
+        index_time, _ = time_fn(
+            lambda: prepare_indices(args.seq_len, att_span, config.num_hidden_layers, device), device, args.repeat
+        )
+        with torch.no_grad():
+            forward_time, output = time_fn(lambda: model(input_ids)[0], device, args.repeat)
+        results[tag] = (index_time, forward_time, output)
+
+    error = (results['cached'][2] - results['uncached'][2]).abs().max().item()
+    print(f"=> DeBERTa-{args.model_size}, {args.batch_size}x{args.seq_len} tokens, on {device}")
+    for tag, (index_time, forward_time, _) in results.items():
+        print(f"{tag:>8}: indices {index_time * 1000:8.3f}ms/forward\tforward {forward_time * 1000:8.2f}ms")
+    print(f"index speedup: {results['uncached'][0] / results['cached'][0]:.2f}x\t"
+          f"forward speedup: {results['uncached'][1] / results['cached'][1]:.2f}x\tmax output difference: {error:.2e}")
@@ -0,0 +1,113 @@
+# --------------------------------------------------------
+# [Relative Shift Benchmark] c2p/p2c by relative shifting vs by gathering
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+"""
+    Compare the two ways of 'disentangled_att_bias' to get the c2p & p2c scores, gathering by
+    index(default) and relative shifting('relative_shift' of the config), on DeBERTa layers of the
+    same weights at several sequence lengths:
+        i.   equality of the outputs & of the input gradients;
+        ii.  forward & forward + backward latency;
+        iii. peak memory of forward + backward(CUDA only).
+    The script exits with a non-zero code if the outputs differ beyond '--atol'.
+
+    Run this script like:
+
+    python bench_relative_shift.py --model_size base --num_layers 2 --seq_lens 128 384 512 --device cuda
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+
+BASE_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(BASE_DIR, '..'))
+sys.path.append(os.path.join(BASE_DIR, '..', '..'))
+
+from models.modeling_deberta import DebertaModel
+from bench_sparse_inference import MODEL_SHAPES, build_config
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def run(model, embeddings, backward):
+    embeddings.grad = None
+    output = model(inputs_embeds=embeddings)[0]
+    if backward:
+        output.sum().backward()
+
+    return output
+
+
+def time_run(model, embeddings, backward, device, repeat):
+    run(model, embeddings, backward)
+    synchronize(device)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.time()
+    for _ in range(repeat):
+        run(model, embeddings, backward)
+    synchronize(device)
+    peak = torch.cuda.max_memory_allocated(device) if device.type == 'cuda' else None
+
+    return (time.time() - start) / repeat, peak
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="c2p/p2c by relative shifting vs by gathering")
+    parser.add_argument('--model_size', type=str, default='base', choices=list(MODEL_SHAPES.keys()))
+    parser.add_argument('--num_layers', type=int, default=2)
+    parser.add_argument('--seq_lens', type=int, nargs='+', default=[128, 384, 512])
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--atol', type=float, default=1e-4)
+    parser.add_argument('--seed', type=int, default=42)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+
+    config = build_config(args.model_size)
+    config.num_hidden_layers = args.num_layers
+    models = {}
+    for tag, shift in (('gather', False), ('shift', True)):
+        config.relative_shift = shift
+        models[tag] = DebertaModel(config).to(device).eval()
+    models['shift'].load_state_dict(models['gather'].state_dict())
+
+    failed = False
+    print(f"=> DeBERTa-{args.model_size} x{args.num_layers} layers, batch size {args.batch_size}, on {device}")
+    for seq_len in args.seq_lens:
+        embeddings = torch.randn(args.batch_size, seq_len, config.hidden_size, device=device, requires_grad=True)
+
+        outputs, grads = {}, {}
+        for tag, model in models.items():
+            outputs[tag] = run(model, embeddings, backward=True).detach()
+            grads[tag] = embeddings.grad.clone()
+        error = (outputs['shift'] - outputs['gather']).abs().max().item()
+        grad_error = (grads['shift'] - grads['gather']).abs().max().item()
+        failed |= error > args.atol
+
+        print(f"L={seq_len}: max output difference {error:.2e}\tmax gradient difference {grad_error:.2e}")
+        for tag, model in models.items():
+            with torch.no_grad():
+                forward_time, _ = time_run(model, embeddings, False, device, args.repeat)
+            train_time, peak = time_run(model, embeddings, True, device, args.repeat)
+            memory = f"\tpeak memory {peak / 2 ** 20:.1f}MB" if peak is not None else ''
+            print(f"  {tag:>6}: forward {forward_time * 1000:8.2f}ms\tforward + backward {train_time * 1000:8.2f}ms{memory}")
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,156 @@
+# --------------------------------------------------------
+# [SDPA Attention Benchmark] DeBERTa attention by eager softmax vs by scaled_dot_product_attention
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+"""
+    Compare the 'eager' & 'sdpa' attention backends('attention_backend' of the config) on DeBERTa
+    layers of the same weights at several sequence lengths, with a padding attention mask whose
+    valid lengths differ across the batch:
+        i.   equality of the outputs & of the input gradients;
+        ii.  forward & forward + backward latency;
+        iii. peak memory of forward + backward, by 'torch.cuda.max_memory_allocated' on CUDA and
+             by the memory events of 'torch.profiler' on CPU.
+    The script exits with a non-zero code if the outputs differ beyond '--atol'.
+
+    Run this script like:
+
+    python bench_sdpa_attention.py --model_size base --num_layers 2 --seq_lens 128 384 512 --device cpu
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+
+from torch.profiler import profile, ProfilerActivity
+
+BASE_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(BASE_DIR, '..'))
+sys.path.append(os.path.join(BASE_DIR, '..', '..'))
+
+from models.modeling_deberta import DebertaModel
+from bench_sparse_inference import MODEL_SHAPES, build_config
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def padding_mask(batch_size, seq_len, device):
+    """The i-th sample keeps the first 'seq_len x (1 - i / (2 x batch_size))' tokens."""
+
+    lengths = [max(1, seq_len - seq_len * i // (2 * batch_size)) for i in range(batch_size)]
+    mask = torch.zeros(batch_size, seq_len, dtype=torch.long, device=device)
+    for i, length in enumerate(lengths):
+        mask[i, :length] = 1
+
+    return mask
+
+
+def run(model, embeddings, mask, backward):
+    embeddings.grad = None
+    output = model(inputs_embeds=embeddings, attention_mask=mask)[0]
+    if backward:
+        output.sum().backward()
+
+    return output
+
+
+def time_run(model, embeddings, mask, backward, device, repeat):
+    run(model, embeddings, mask, backward)
+    synchronize(device)
+    start = time.time()
+    for _ in range(repeat):
+        run(model, embeddings, mask, backward)
+    synchronize(device)
+
+    return (time.time() - start) / repeat
+
+
+def peak_memory(model, embeddings, mask, device):
+    """Peak memory allocated by one forward + backward, over what was allocated before it."""
+
+    if device.type == 'cuda':
+        synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        start = torch.cuda.memory_allocated(device)
+        run(model, embeddings, mask, True)
+        synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - start
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        run(model, embeddings, mask, True)
+    # The '[memory]' events carry the signed size of every allocation & free
+    events = sorted((event for event in prof.events() if event.name == '[memory]'),
+                    key=lambda event: event.time_range.start)
+    allocated = peak = 0
+    for event in events:
+        allocated += event.cpu_memory_usage
+        peak = max(peak, allocated)
+
+    return peak
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="DeBERTa attention by eager softmax vs by SDPA")
+    parser.add_argument('--model_size', type=str, default='base', choices=list(MODEL_SHAPES.keys()))
+    parser.add_argument('--num_layers', type=int, default=2)
+    parser.add_argument('--seq_lens', type=int, nargs='+', default=[128, 384, 512])
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--atol', type=float, default=1e-4)
+    parser.add_argument('--seed', type=int, default=42)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if not hasattr(torch.nn.functional, 'scaled_dot_product_attention'):
+        raise RuntimeError(f"'scaled_dot_product_attention' is not available in PyTorch {torch.__version__}")
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+
+    config = build_config(args.model_size)
+    config.num_hidden_layers = args.num_layers
+    models = {}
+    for backend in ('eager', 'sdpa'):
+        config.attention_backend = backend
+        models[backend] = DebertaModel(config).to(device).eval()
+    models['sdpa'].load_state_dict(models['eager'].state_dict())
+
+    failed = False
+    print(f"=> DeBERTa-{args.model_size} x{args.num_layers} layers, batch size {args.batch_size}, "
+          f"on {device}, {torch.get_num_threads()} threads")
+    for seq_len in args.seq_lens:
+        embeddings = torch.randn(args.batch_size, seq_len, config.hidden_size, device=device, requires_grad=True)
+        mask = padding_mask(args.batch_size, seq_len, device)
+
+        outputs, grads = {}, {}
+        for backend, model in models.items():
+            outputs[backend] = run(model, embeddings, mask, backward=True).detach()
+            grads[backend] = embeddings.grad.clone()
+        error = (outputs['sdpa'] - outputs['eager']).abs().max().item()
+        grad_error = (grads['sdpa'] - grads['eager']).abs().max().item()
+        failed |= error > args.atol
+
+        print(f"L={seq_len}: max output difference {error:.2e}\tmax gradient difference {grad_error:.2e}")
+        for backend, model in models.items():
+            with torch.no_grad():
+                forward_time = time_run(model, embeddings, mask, False, device, args.repeat)
+            train_time = time_run(model, embeddings, mask, True, device, args.repeat)
+            peak = peak_memory(model, embeddings, mask, device)
+            print(f"  {backend:>6}: forward {forward_time * 1000:8.2f}ms\tforward + backward {train_time * 1000:8.2f}ms"
+                  f"\tpeak memory {peak / 2 ** 20:.1f}MB")
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,140 @@
+# --------------------------------------------------------
+# [Sparse All-Reduce Benchmark] Gradient traffic of DDP with fixed masks, gloo on CPU
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+"""
+    Spawn 'world_size' CPU processes with the gloo backend and train a DeBERTa-shaped stack of
+    Linear layers under DDP with fixed masks, once with the default all-reduce and once with
+    'sparse_allreduce_hook'. Reports the gradient bytes on wire per step, the step time, and
+    checks that both end with the same weights.
+
+    Run this script like:
+
+    python bench_sparse_allreduce.py --world_size 2 --model_size base --num_layers 4 --sparsity 0.9375
+"""
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+
+from torch.nn.parallel import DistributedDataParallel
+
+BASE_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(BASE_DIR, '..'))
+sys.path.append(os.path.join(BASE_DIR, '..', '..'))
+
+from pruner import Prune
+from comm_hooks import register_sparse_allreduce
+from bench_prune import MODEL_SHAPES, build_model, build_prune_dict
+from utils.dist import init_process_group, kill_all_process
+
+
+class Stack(nn.Module):
+    """Forward over the DeBERTa-shaped Linear layers of 'build_model', enough to produce gradients."""
+
+    def __init__(self, hidden_size, intermediate_size, num_layers):
+        super().__init__()
+        self.model = build_model(hidden_size, intermediate_size, num_layers)
+
+    def forward(self, x):
+        for layer in self.model.encoder.layer:
+            value = layer.attention.self.in_proj(x).chunk(3, dim=-1)[-1]
+            x = x + layer.attention.output.dense(value)
+            x = x + layer.output.dense(torch.relu(layer.intermediate.dense(x)))
+
+        return x
+
+
+def build_pruned(args, mask_path):
+    torch.manual_seed(args.seed)
+    model = Stack(*MODEL_SHAPES[args.model_size], args.num_layers)
+    pruner = Prune(model, prune_dict=build_prune_dict(model, args.sparsity), fixed_mask=mask_path)
+    # Apply the fixed masks
+    pruner.prune()
+
+    return model, pruner
+
+
+def train(args, rank, mask_path, sparse):
+    model, pruner = build_pruned(args, mask_path)
+    ddp_model = DistributedDataParallel(model)
+    state = register_sparse_allreduce(ddp_model, pruner) if sparse else None
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-3)
+
+    # Different data on each rank
+    torch.manual_seed(args.seed + rank)
+    hidden_size = MODEL_SHAPES[args.model_size][0]
+    elapsed = 0.
+    for step in range(args.warmup + args.steps):
+        x = torch.randn(args.batch_size, hidden_size)
+        start = time.time()
+        loss = ddp_model(x).pow(2).mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        pruner.prune()
+        if step >= args.warmup:
+            elapsed += time.time() - start
+
+    bytes_per_step = state.bytes_sent / (args.warmup + args.steps) if sparse else \
+        sum(parameter.numel() * parameter.element_size() for parameter in model.parameters())
+
+    return model, elapsed / args.steps, bytes_per_step
+
+
+def worker(rank, args, mask_path):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(args.port)
+    init_process_group(backend='gloo', world_size=args.world_size, rank=rank)
+
+    dense_model, dense_time, dense_bytes = train(args, rank, mask_path, sparse=False)
+    sparse_model, sparse_time, sparse_bytes = train(args, rank, mask_path, sparse=True)
+    error = max((one - two).abs().max().item()
+                for one, two in zip(dense_model.parameters(), sparse_model.parameters()))
+
+    if rank == 0:
+        print(f"=> {args.world_size} ranks, DeBERTa-{args.model_size} x{args.num_layers} layers, "
+              f"sparsity {args.sparsity}")
+        print(f"default all-reduce: {dense_bytes / 2 ** 20:8.2f}MB/step\t{dense_time * 1000:8.2f}ms/step")
+        print(f"sparse all-reduce:  {sparse_bytes / 2 ** 20:8.2f}MB/step\t{sparse_time * 1000:8.2f}ms/step")
+        print(f"bytes reduction: {dense_bytes / sparse_bytes:.2f}x\tmax weight difference: {error:.2e}")
+
+    kill_all_process()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Sparse gradient all-reduce of fixed masks with gloo")
+    parser.add_argument('--world_size', type=int, default=2)
+    parser.add_argument('--model_size', type=str, default='base', choices=list(MODEL_SHAPES.keys()))
+    parser.add_argument('--num_layers', type=int, default=4)
+    parser.add_argument('--sparsity', type=float, default=0.9375)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--port', type=int, default=29512)
+    parser.add_argument('--seed', type=int, default=42)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    # Fixed masks are the magnitude masks of the initial weights at the target sparsity
+    torch.manual_seed(args.seed)
+    model = Stack(*MODEL_SHAPES[args.model_size], args.num_layers)
+    pruner = Prune(model, pretrain_step=0, sparse_step=1, frequency=1,
+                   prune_dict=build_prune_dict(model, args.sparsity))
+    pruner.prune()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        mask_path = pruner.save_mask(os.path.join(tmp, 'mask.pmask'))
+        mp.spawn(worker, args=(args, mask_path), nprocs=args.world_size, join=True)
@@ -0,0 +1,124 @@
+# --------------------------------------------------------
+# [Sparse Inference Benchmark] CPU latency & throughput of sparse exported DeBERTa
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+"""
+    Compare the CPU inference latency & throughput of a pruned DeBERTa before and after its
+    pruned Linear layers are converted to 'SparseLinear'. Either a sparse artifact written by
+    'export_sparse.py' together with its source checkpoint is benchmarked, or, without any,
+    a randomly initialized model is pruned by 'Prune' to the given sparsity.
+
+    Run this script like:
+
+    python bench_sparse_inference.py --model_size base --sparsity 0.9375 --layout csr
+    python bench_sparse_inference.py --checkpoint best.pth --artifact best_sparse.pth
+"""
+
+import os
+import sys
+import copy
+import time
+import argparse
+
+import torch
+
+BASE_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(BASE_DIR, '..'))
+sys.path.append(os.path.join(BASE_DIR, '..', '..'))
+
+from pruner import Prune
+from sparse import SparseLinear, sparsify_model, load_sparse_model
+from export_sparse import MODEL_CLASSES, load_pruned_checkpoint
+from models.configuration_deberta import DebertaConfig
+
+
+# (hidden size, intermediate size, number of layers, number of heads)
+MODEL_SHAPES = {
+    'base': (768, 3072, 12, 12),
+    'large': (1024, 4096, 24, 16),
+}
+
+
+def build_config(model_size):
+    hidden_size, intermediate_size, num_layers, num_heads = MODEL_SHAPES[model_size]
+    return DebertaConfig(
+        hidden_size=hidden_size, intermediate_size=intermediate_size, num_hidden_layers=num_layers,
+        num_attention_heads=num_heads, relative_attention=True, position_biased_input=False,
+        pos_att_type=['c2p', 'p2c'], num_labels=2
+    )
+
+
+def build_pruned_model(args):
+    """Random DeBERTa with the same prune targets as 'run_glue.py', pruned to 'args.sparsity'."""
+
+    model = MODEL_CLASSES[args.task](build_config(args.model_size)).eval()
+    prune_dict = {
+        name: args.sparsity for name, _ in model.named_parameters()
+        if name.endswith(('attention.self.in_proj.weight', 'attention.output.dense.weight',
+                          'intermediate.dense.weight', 'output.dense.weight'))
+    }
+    # A single sparse step reaches the target sparsity at the first 'prune()'
+    Prune(model, pretrain_step=0, sparse_step=1, frequency=1, prune_dict=prune_dict).prune()
+
+    return model
+
+
+def time_inference(model, input_ids, repeat):
+    with torch.no_grad():
+        model(input_ids)
+        start = time.time()
+        for _ in range(repeat):
+            logits = model(input_ids)[0]
+
+    return (time.time() - start) / repeat, logits
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="CPU inference of dense & sparse exported DeBERTa")
+    parser.add_argument('--checkpoint', type=str, help='pruned checkpoint, a random model is pruned if not given')
+    parser.add_argument('--artifact', type=str, help="sparse artifact of the checkpoint by 'export_sparse.py'")
+    parser.add_argument('--task', type=str, default='cls', choices=list(MODEL_CLASSES.keys()))
+    parser.add_argument('--model_size', type=str, default='base', choices=list(MODEL_SHAPES.keys()))
+    parser.add_argument('--sparsity', type=float, default=0.9375)
+    parser.add_argument('--layout', type=str, default='csr', choices=list(SparseLinear.LAYOUTS))
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--seq_len', type=int, default=128)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+
+    if args.checkpoint:
+        assert args.artifact, "'--artifact' is needed along with '--checkpoint'"
+        state_dict, model_config = load_pruned_checkpoint(args.checkpoint)
+        dense = MODEL_CLASSES[args.task](DebertaConfig.from_dict(model_config))
+        dense.load_state_dict(state_dict)
+        dense.eval()
+        sparse = load_sparse_model(args.artifact, MODEL_CLASSES[args.task], DebertaConfig)
+    else:
+        dense = build_pruned_model(args)
+        sparse = copy.deepcopy(dense)
+        sparsify_model(sparse, layout=args.layout)
+
+    input_ids = torch.randint(1, dense.config.vocab_size, (args.batch_size, args.seq_len))
+    dense_time, dense_logits = time_inference(dense, input_ids, args.repeat)
+    sparse_time, sparse_logits = time_inference(sparse, input_ids, args.repeat)
+    num_sparse = sum(isinstance(module, SparseLinear) for module in sparse.modules())
+    tokens = args.batch_size * args.seq_len
+
+    print(f"=> {args.batch_size}x{args.seq_len} tokens, {num_sparse} sparse Linear layers, "
+          f"{torch.get_num_threads()} threads")
+    print(f"dense:  {dense_time * 1000:.2f}ms/batch\t{tokens / dense_time:.1f} tokens/s")
+    print(f"sparse: {sparse_time * 1000:.2f}ms/batch\t{tokens / sparse_time:.1f} tokens/s")
+    print(f"speedup: {dense_time / sparse_time:.2f}x\t"
+          f"max logit error: {(dense_logits - sparse_logits).abs().max().item():.2e}")
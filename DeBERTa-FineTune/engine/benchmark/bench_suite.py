@@ -0,0 +1,234 @@
+# --------------------------------------------------------
+# [Pruner Benchmark Suite] CPU latency of every Prune entry point & mask kernel, as JSON
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+"""
+    Time 'Prune' on DeBERTa-base/large shaped parameters(no pretrained weight is needed) across
+    deploy devices, group sizes & sparsities:
+        i.   entry points: 'prune()' on a mask update step & on a plain step, 'sparsity()' of the
+             weights & of the masks, 'check()' & 'verify(current=True)';
+        ii.  mask kernels: one call of the kernel on a single weight of each shape.
+    Results are written as JSON, two result files(e.g. of two commits) are compared by '--compare'.
+    To run on earlier commits as well, deploy devices the checked out 'Prune' rejects are skipped,
+    so are the entry points it lacks & the kernel timings before the plan of mask kernels, only the
+    timings present in both files are compared.
+
+    Run this script like:
+
+    python bench_suite.py --model_size base --num_layers 2 --output base.json
+    python bench_suite.py --compare before.json after.json
+"""
+
+import os
+import sys
+import json
+import time
+import inspect
+import argparse
+import platform
+import subprocess
+
+import torch
+
+BASE_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(BASE_DIR, '..'))
+sys.path.append(os.path.join(BASE_DIR, '..', '..'))
+
+from pruner import Prune
+from bench_prune import MODEL_SHAPES, build_model, build_prune_dict
+
+
+# (deploy device, group size), the group size only matters to 'asic'
+CONFIGS = [('none', 64), ('fpga', 64), ('asic', 32), ('asic', 64), ('asic', 128), ('nm', 64), ('tile', 64)]
+SPARSITIES = [0.5, 0.875, 0.9375]
+
+
+def _time(fn, warmup, repeat):
+    """Median latency(seconds) of 'fn', more robust than the mean to a noisy CPU."""
+
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return sorted(times)[len(times) // 2]
+
+
+def build_pruner(model, sparsity, deploy_device, group_size, steps):
+    # frequency=1 makes every call a mask update step until 'steps'
+    return Prune(
+        model, pretrain_step=0, sparse_step=steps, frequency=1, prune_dict=build_prune_dict(model, sparsity),
+        deploy_device=deploy_device, group_size=group_size
+    )
+
+
+def bench_entry_points(model, sparsity, deploy_device, group_size, args):
+    pruner = build_pruner(model, sparsity, deploy_device, group_size, steps=args.warmup + args.repeat)
+    results = {'prune_update': _time(pruner.prune, args.warmup, args.repeat)}
+    # The schedule is over, the rest of the calls only apply the masks
+    results['prune_apply'] = _time(pruner.prune, args.warmup, args.repeat)
+    results['sparsity'] = _time(pruner.sparsity, args.warmup, args.repeat)
+    if 'from_mask' in inspect.signature(pruner.sparsity).parameters:
+        results['sparsity_from_mask'] = _time(lambda: pruner.sparsity(from_mask=True), args.warmup, args.repeat)
+    results['check'] = _time(pruner.check, args.warmup, args.repeat)
+    if hasattr(pruner, 'verify'):
+        results['verify_current'] = _time(lambda: pruner.verify(current=True), args.warmup, args.repeat)
+
+    return results
+
+
+def bench_kernels(model, sparsity, deploy_device, group_size, args):
+    """Latency of the mask kernel on the first weight of each (kind, shape)."""
+
+    pruner = build_pruner(model, sparsity, deploy_device, group_size, steps=1)
+    results = {}
+    # Mask kernels are planned per parameter since 'Prune._plan', nothing to time before it
+    if not hasattr(pruner, '_plan'):
+        return results
+    with torch.no_grad():
+        for name, entry in pruner._plan.items():
+            key = f"{entry.kind}:{'x'.join(map(str, entry.parameter.shape))}"
+            if key in results:
+                continue
+            weight = entry.parameter.data
+            keep_k = int(entry.numel * (1.0 - sparsity))
+            results[key] = _time(lambda: entry.kernel(name, weight, keep_k), args.warmup, args.repeat)
+
+    return results
+
+
+def supported(model, deploy_device, group_size):
+    """Whether the checked out 'Prune' accepts the deploy device, e.g. 'nm' & 'tile' of later commits."""
+
+    try:
+        build_pruner(model, SPARSITIES[0], deploy_device, group_size, steps=1)
+    except (AssertionError, ValueError):
+        return False
+
+    return True
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    torch.manual_seed(args.seed)
+    model = build_model(*MODEL_SHAPES[args.model_size], args.num_layers)
+    # Pruners modify the weights in place, every case starts from the same ones
+    initial = {name: parameter.detach().clone() for name, parameter in model.named_parameters()}
+
+    cases = []
+    for deploy_device, group_size in CONFIGS:
+        if not supported(model, deploy_device, group_size):
+            print(f"=> {deploy_device}(group size {group_size}) is not supported by this 'Prune', skipped")
+            continue
+        for sparsity in args.sparsities:
+            with torch.no_grad():
+                for name, parameter in model.named_parameters():
+                    parameter.copy_(initial[name])
+            case = {
+                'deploy_device': deploy_device,
+                'group_size': group_size,
+                'sparsity': sparsity,
+                'entry_points': bench_entry_points(model, sparsity, deploy_device, group_size, args),
+            }
+            with torch.no_grad():
+                for name, parameter in model.named_parameters():
+                    parameter.copy_(initial[name])
+            case['kernels'] = bench_kernels(model, sparsity, deploy_device, group_size, args)
+            cases.append(case)
+            print(f"=> {deploy_device}(group size {group_size}) sparsity {sparsity}: "
+                  f"prune update {case['entry_points']['prune_update'] * 1000:.2f}ms")
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'torch': torch.__version__,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'threads': torch.get_num_threads(),
+            'model_size': args.model_size,
+            'num_layers': args.num_layers,
+            'warmup': args.warmup,
+            'repeat': args.repeat,
+        },
+        'cases': cases,
+    }
+
+
+def _flatten(results):
+    """(deploy device, group size, sparsity, section, name) -> seconds."""
+
+    flat = {}
+    for case in results['cases']:
+        key = (case['deploy_device'], case['group_size'], case['sparsity'])
+        for section in ('entry_points', 'kernels'):
+            for name, seconds in case[section].items():
+                flat[key + (section, name)] = seconds
+
+    return flat
+
+
+def compare(before_path, after_path, threshold):
+    """Print the ratio after / before of every timing, those slower by more than 'threshold' are flagged."""
+
+    with open(before_path) as f:
+        before = _flatten(json.load(f))
+    with open(after_path) as f:
+        after = _flatten(json.load(f))
+
+    regressions = 0
+    for key in sorted(before.keys() & after.keys(), key=str):
+        ratio = after[key] / before[key] if before[key] else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            flag, regressions = '  <- slower', regressions + 1
+        deploy_device, group_size, sparsity, section, name = key
+        print(f"{deploy_device:>5} g{group_size:<4} s{sparsity:<7} {section:>12} {name:<24} "
+              f"{before[key] * 1000:9.3f}ms -> {after[key] * 1000:9.3f}ms  x{ratio:.2f}{flag}")
+    print(f"=> {regressions} timing(s) slower by more than {threshold * 100:.0f}%")
+
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="CPU benchmark suite of Prune, results as JSON")
+    parser.add_argument('--model_size', type=str, default='base', choices=list(MODEL_SHAPES.keys()))
+    parser.add_argument('--num_layers', type=int, default=2)
+    parser.add_argument('--sparsities', type=float, nargs='+', default=SPARSITIES)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', type=str, default='bench_suite.json')
+    parser.add_argument('--compare', type=str, nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two result files instead of running')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown flagged by --compare')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.compare:
+        compare(*args.compare, args.threshold)
+        sys.exit(0)
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    results = run(args)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"=> results saved to '{args.output}'")
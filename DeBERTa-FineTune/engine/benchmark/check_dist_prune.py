@@ -0,0 +1,108 @@
+# --------------------------------------------------------
+# [Distributed Prune Check] Sharded mask computation on CPU with gloo
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+"""
+    Spawn 'world_size' CPU processes with the gloo backend, prune the same DeBERTa-shaped model on
+    each with 'Prune(distributed=True)', then check that:
+        i.  all the ranks end with identical masks;
+        ii. they equal the masks of a single process 'Prune'.
+    The per-step prune latency of the sharded & the single process modes is also reported.
+    The script exits with a non-zero code if any mask differs.
+
+    Run this script like:
+
+    python check_dist_prune.py --world_size 4 --model_size base --num_layers 12
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+BASE_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(BASE_DIR, '..'))
+sys.path.append(os.path.join(BASE_DIR, '..', '..'))
+
+from pruner import Prune
+from mask_io import pack_mask
+from bench_prune import MODEL_SHAPES, build_model, build_prune_dict
+from utils.dist import init_process_group, broadcast_coalesced, kill_all_process
+
+
+def run_pruner(args, distributed):
+    """Returns the pruner after 'args.steps' mask updates & the mean latency(seconds) of a step."""
+
+    # Same initial weights on every rank
+    torch.manual_seed(args.seed)
+    model = build_model(*MODEL_SHAPES[args.model_size], args.num_layers)
+    pruner = Prune(
+        model, pretrain_step=0, sparse_step=args.steps, frequency=1,
+        prune_dict=build_prune_dict(model, args.sparsity), deploy_device=args.deploy_device,
+        group_size=args.group_size, distributed=distributed
+    )
+
+    start = time.time()
+    for _ in range(args.steps):
+        pruner.prune()
+
+    return pruner, (time.time() - start) / args.steps
+
+
+def worker(rank, args):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(args.port)
+    init_process_group(backend='gloo', world_size=args.world_size, rank=rank)
+
+    pruner, sharded_time = run_pruner(args, distributed=True)
+    local = [pack_mask(mask) for mask in pruner._mask.values()]
+
+    # i. Compare with the masks of rank 0
+    reference = [one.clone() for one in local]
+    broadcast_coalesced(reference, 0)
+    mismatch = torch.tensor([sum(int((one != ref).sum()) for one, ref in zip(local, reference))])
+
+    # ii. Compare with a single process pruner
+    if rank == 0:
+        single, single_time = run_pruner(args, distributed=False)
+        mismatch += sum(
+            int((pack_mask(single._mask[name]) != one).sum()) for name, one in zip(pruner._mask, local)
+        )
+
+    dist.all_reduce(mismatch)
+    if rank == 0:
+        print(f"=> {args.world_size} ranks, DeBERTa-{args.model_size} x{args.num_layers} layers, "
+              f"deploy device '{args.deploy_device}'")
+        print(f"single process: {single_time * 1000:.2f}ms/step\tsharded: {sharded_time * 1000:.2f}ms/step")
+        print(f"mismatched mask bytes: {int(mismatch)}")
+
+    kill_all_process()
+    if int(mismatch):
+        sys.exit(1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Check the sharded mask computation of Prune with gloo")
+    parser.add_argument('--world_size', type=int, default=2)
+    parser.add_argument('--model_size', type=str, default='base', choices=list(MODEL_SHAPES.keys()))
+    parser.add_argument('--num_layers', type=int, default=4)
+    parser.add_argument('--sparsity', type=float, default=0.9375)
+    parser.add_argument('--deploy_device', type=str, default='none')
+    parser.add_argument('--group_size', type=int, default=64)
+    parser.add_argument('--steps', type=int, default=3)
+    parser.add_argument('--port', type=int, default=29511)
+    parser.add_argument('--seed', type=int, default=42)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    # A failed rank makes 'spawn' raise, hence a non-zero exit code
+    mp.spawn(worker, args=(args,), nprocs=args.world_size, join=True)
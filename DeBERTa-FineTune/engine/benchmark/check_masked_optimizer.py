@@ -0,0 +1,163 @@
+# --------------------------------------------------------
+# [Masked Optimizer Check] MaskedAdamW vs AdamW with masked gradients & weights, and its resumption
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+"""
+    Prune a DeBERTa-shaped model once, bind the masks to 'MaskedAdamW'(see 'Prune.bind_optimizer'),
+    then check that:
+        i.   after '--steps' steps the weights equal those of 'torch.optim.AdamW' whose gradients &
+             weights are multiplied by the masks at every step;
+        ii.  a run resumed from the optimizer & pruner state dicts, saved by 'torch.save' & loaded
+             into a fresh model, optimizer & pruner, continues with the same weights as the
+             uninterrupted run for another '--steps' steps.
+    The per-step latency & the size of the optimizer states of both optimizers are also reported.
+    The script exits with a non-zero code if the weights differ beyond '--atol'.
+
+    Run this script like:
+
+    python check_masked_optimizer.py --model_size base --num_layers 2 --sparsity 0.9 --steps 5
+"""
+
+import io
+import os
+import sys
+import copy
+import time
+import argparse
+
+import torch
+
+from torch.optim import AdamW
+
+BASE_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(BASE_DIR, '..'))
+sys.path.append(os.path.join(BASE_DIR, '..', '..'))
+
+from pruner import Prune
+from optimizer import MaskedAdamW
+from bench_prune import MODEL_SHAPES, build_model, build_prune_dict, synchronize
+
+
+def build_pruner(model, args):
+    return Prune(
+        model, pretrain_step=0, sparse_step=1, frequency=1,
+        prune_dict=build_prune_dict(model, args.sparsity), deploy_device=args.deploy_device
+    )
+
+
+def build_masked(model, args):
+    optimizer = MaskedAdamW(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+    pruner = build_pruner(model, args)
+    # Masks at the target sparsity, then fixed along the steps
+    pruner.prune()
+    pruner.bind_optimizer(optimizer)
+
+    return optimizer, pruner
+
+
+def train_step(model, optimizer, targets, masks=None):
+    """One step on the loss 'sum(weight x target)'. 'masks' are multiplied explicitly, for the reference."""
+
+    optimizer.zero_grad()
+    loss = sum((parameter * targets[name]).sum() for name, parameter in model.named_parameters())
+    loss.backward()
+    if masks is not None:
+        with torch.no_grad():
+            for name, parameter in model.named_parameters():
+                if name in masks:
+                    parameter.grad.mul_(masks[name])
+    optimizer.step()
+    if masks is not None:
+        with torch.no_grad():
+            for name, parameter in model.named_parameters():
+                if name in masks:
+                    parameter.mul_(masks[name])
+
+
+def make_targets(model, steps, device):
+    return [
+        {name: torch.randn_like(parameter, device=device) for name, parameter in model.named_parameters()}
+        for _ in range(steps)
+    ]
+
+
+def max_difference(model, other):
+    return max((one - two).abs().max().item() for one, two in zip(model.parameters(), other.parameters()))
+
+
+def state_size(optimizer):
+    return sum(value.numel() * value.element_size() for state in optimizer.state.values()
+               for value in state.values() if torch.is_tensor(value))
+
+
+def time_steps(model, optimizer, targets, device, masks=None):
+    synchronize(device)
+    start = time.time()
+    for step_targets in targets:
+        train_step(model, optimizer, step_targets, masks)
+    synchronize(device)
+
+    return (time.time() - start) / len(targets)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Check MaskedAdamW against AdamW with masking & its resumption")
+    parser.add_argument('--model_size', type=str, default='base', choices=list(MODEL_SHAPES.keys()))
+    parser.add_argument('--num_layers', type=int, default=2)
+    parser.add_argument('--sparsity', type=float, default=0.9)
+    parser.add_argument('--deploy_device', type=str, default='none')
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--weight_decay', type=float, default=0.01)
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--atol', type=float, default=1e-5)
+    parser.add_argument('--seed', type=int, default=42)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+
+    model = build_model(*MODEL_SHAPES[args.model_size], args.num_layers).to(device)
+    optimizer, pruner = build_masked(model, args)
+    masks = {name: mask.clone() for name, mask in pruner._mask.items()}
+    # The pruned weights are zero from here on, for both
+    reference = copy.deepcopy(model)
+    reference_optimizer = AdamW(reference.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+
+    targets = make_targets(model, 2 * args.steps, device)
+    masked_time = time_steps(model, optimizer, targets[:args.steps], device)
+    reference_time = time_steps(reference, reference_optimizer, targets[:args.steps], device, masks)
+    error = max_difference(model, reference)
+
+    # Resume from the saved states, on a fresh model, optimizer & pruner
+    buffer = io.BytesIO()
+    torch.save({'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'pruner': pruner.state_dict()},
+               buffer)
+    buffer.seek(0)
+    checkpoint = torch.load(buffer, map_location=device)
+    resumed = build_model(*MODEL_SHAPES[args.model_size], args.num_layers).to(device)
+    resumed.load_state_dict(checkpoint['model'])
+    resumed_optimizer = MaskedAdamW(resumed.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+    resumed_pruner = build_pruner(resumed, args)
+    resumed_pruner.load_state_dict(checkpoint['pruner'])
+    resumed_pruner.bind_optimizer(resumed_optimizer)
+    resumed_optimizer.load_state_dict(checkpoint['optimizer'])
+
+    for step_targets in targets[args.steps:]:
+        train_step(model, optimizer, step_targets)
+        train_step(resumed, resumed_optimizer, step_targets)
+    resume_error = max_difference(model, resumed)
+
+    print(f"=> DeBERTa-{args.model_size} x{args.num_layers} layers, sparsity {args.sparsity}, on {device}")
+    print(f"AdamW + masking: {reference_time * 1000:8.2f}ms/step, states {state_size(reference_optimizer) / 2 ** 20:.1f}MB"
+          f"\tMaskedAdamW: {masked_time * 1000:8.2f}ms/step, states {state_size(optimizer) / 2 ** 20:.1f}MB")
+    print(f"max weight difference: to AdamW + masking {error:.2e}\tresumed to uninterrupted {resume_error:.2e}")
+
+    if max(error, resume_error) > args.atol:
+        sys.exit(1)
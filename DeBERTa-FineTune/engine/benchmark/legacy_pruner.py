@@ -0,0 +1,299 @@
+# --------------------------------------------------------
+# [Legacy Pruner] The original NumPy mask kernels, the baseline of the benchmarks
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+import os
+import sys
+
+import numpy
+import torch
+
+BASE_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(BASE_DIR, '..'))
+
+from pruner import Prune
+
+
+class LegacyPrune(Prune):
+    """'Prune' with the original NumPy mask kernels, kept as the baseline."""
+
+    def _update_mask(self, name, weight, keep_k):
+        if keep_k >= 1:
+            reshape_weight = weight.reshape(-1)
+            index = torch.topk(reshape_weight.abs(), keep_k)[1].cpu().numpy().tolist()
+            mask = numpy.zeros(reshape_weight.shape)
+            mask[index] = 1
+            mask = mask.reshape(weight.shape)
+            mask = torch.as_tensor(mask, dtype=weight.dtype, device=weight.device)
+            self._mask[name][:] = mask
+        else:
+            self._mask[name][:] = 0
+
+    def _update_mask_fpga(self, name, weight, keep_k):
+        def _block_sparsity_balance(transpose_weight, keep_k, inc_group):
+            reshape_weight = transpose_weight.reshape(
+                [
+                    -1,
+                    transpose_weight.shape[-2]
+                    * transpose_weight.shape[-1]
+                    // inc_group,
+                ]
+            )
+            base_k = keep_k // reshape_weight.shape[0]
+            remain_k = keep_k % reshape_weight.shape[0]
+            if remain_k > 0:
+                index = torch.topk(reshape_weight.abs(), base_k + 1)[1]
+            else:
+                index = torch.topk(reshape_weight.abs(), base_k)[1]
+            dim1 = []
+            dim2 = []
+            for i, temp in enumerate(index.cpu().numpy().tolist()):
+                for j in temp:
+                    dim1.append(i)
+                    dim2.append(j)
+            mask = numpy.zeros(reshape_weight.shape)
+            mask[dim1, dim2] = 1
+            mask = mask.reshape(transpose_weight.shape)
+            mask = mask.transpose([0, 2, 1, 3])
+            mask = torch.as_tensor(
+                mask, dtype=transpose_weight.dtype, device=transpose_weight.device
+            )
+            return mask
+
+        if keep_k >= 1:
+            transpose_weight = weight.permute([0, 2, 1, 3])
+            if transpose_weight.shape[-2] % self._fpga_input_group == 0:
+                mask = _block_sparsity_balance(
+                    transpose_weight, keep_k, self._fpga_input_group
+                )
+            else:
+                temp1 = transpose_weight.shape[-2]
+                temp4 = (self._fpga_input_group - 1) * (
+                    temp1 // self._fpga_input_group + 1
+                )
+                keep_k_1 = int(temp4 / temp1 * keep_k)
+                keep_k_2 = keep_k - keep_k_1
+                transpose_weight_1 = transpose_weight[:, :, :temp4, :]
+                transpose_weight_2 = transpose_weight[:, :, temp4:, :]
+                mask_1 = _block_sparsity_balance(
+                    transpose_weight_1, keep_k_1, self._fpga_input_group - 1
+                )
+                mask_2 = _block_sparsity_balance(transpose_weight_2, keep_k_2, 1)
+                mask = torch.cat([mask_1, mask_2], 1)
+            self._mask[name][:] = mask
+        else:
+            self._mask[name][:] = 0
+
+    def _update_mask_asic_4d(self, name, weight, keep_k):
+        def _block_sparsity_balance(transpose_weight, keep_k):
+            reshape_weight = transpose_weight.reshape([-1, transpose_weight.shape[-1]])
+            base_k = keep_k // reshape_weight.shape[0]
+            remain_k = keep_k % reshape_weight.shape[0]
+            if remain_k > 0:
+                index = torch.topk(reshape_weight.abs(), base_k + 1)[1]
+            else:
+                index = torch.topk(reshape_weight.abs(), base_k)[1]
+            dim1 = []
+            dim2 = []
+            for i, temp in enumerate(index.cpu().numpy().tolist()):
+                for j in temp:
+                    dim1.append(i)
+                    dim2.append(j)
+            mask = numpy.zeros(reshape_weight.shape)
+            mask[dim1, dim2] = 1
+            mask = mask.reshape(transpose_weight.shape)
+            mask = mask.transpose([0, 3, 1, 2])
+            mask = torch.as_tensor(
+                mask, dtype=transpose_weight.dtype, device=transpose_weight.device
+            )
+            return mask
+
+        def _block_1x1(transpose_weight, keep_k):
+            temp1 = transpose_weight.shape[-1] // self._asic_input_gloup
+            temp2 = transpose_weight.shape[-1] % self._asic_input_gloup
+            for i in range(self._asic_input_gloup):
+                locals()["list%s" % i] = []
+            for i in range(temp1):
+                for j in range(
+                    i * self._asic_input_gloup, (i + 1) * self._asic_input_gloup
+                ):
+                    locals()["list%s" % (j % self._asic_input_gloup)].append(j)
+            for i in range(temp1 * self._asic_input_gloup, transpose_weight.shape[-1]):
+                locals()["list%s" % (i % self._asic_input_gloup)].append(i)
+            temp3 = []
+            for i in range(self._asic_input_gloup):
+                temp3.append(
+                    int(
+                        len(locals()["list%s" % i])
+                        / transpose_weight.shape[-1]
+                        * keep_k
+                    )
+                )
+            group_mask = numpy.ones(transpose_weight.shape).transpose([0, 3, 1, 2])
+            for i in range(self._asic_input_gloup):
+                temp4 = torch.cat(
+                    [
+                        transpose_weight[:, :, :, one : one + 1]
+                        for one in locals()["list%s" % i]
+                    ],
+                    3,
+                )
+                mask = _block_sparsity_balance(temp4, temp3[i])
+                for one, two in enumerate(locals()["list%s" % i]):
+                    group_mask[:, two : two + 1, :, :] = (
+                        mask[:, one : one + 1, :, :].cpu().numpy()
+                    )
+            group_mask = torch.as_tensor(
+                group_mask, dtype=transpose_weight.dtype, device=transpose_weight.device
+            )
+            return group_mask
+
+        if keep_k >= 1:
+            transpose_weight = weight.permute([0, 2, 3, 1])
+            if transpose_weight.shape[1] == 1 and transpose_weight.shape[2] == 1:
+                group_size = 512
+                temp1 = transpose_weight.shape[-1] // group_size
+                temp2 = transpose_weight.shape[-1] % group_size
+                keep_k_1 = int(keep_k * temp1 * group_size / transpose_weight.shape[-1])
+                keep_k_2 = keep_k - keep_k_1
+                mask = numpy.ones(weight.shape)
+                if temp1 > 0:
+                    for i in range(temp1):
+                        transpose_weight_1 = transpose_weight[
+                            :, :, :, i * group_size : (i + 1) * group_size
+                        ]
+                        mask_1 = _block_1x1(transpose_weight_1, keep_k_1 // temp1)
+                        mask[
+                            :, i * group_size : (i + 1) * group_size, :, :
+                        ] = mask_1.cpu().numpy()
+                if temp2 > 0:
+                    transpose_weight_2 = transpose_weight[:, :, :, temp1 * group_size :]
+                    if transpose_weight_2.shape[-1] >= self._asic_input_gloup:
+                        mask_2 = _block_1x1(transpose_weight_2, keep_k_2)
+                        mask[:, temp1 * group_size :, :, :] = mask_2.cpu().numpy()
+                    else:
+                        pass
+                mask = torch.as_tensor(
+                    mask, dtype=transpose_weight.dtype, device=transpose_weight.device
+                )
+            else:
+                group_size = self._group_size
+                temp1 = transpose_weight.shape[-1] // group_size
+                temp2 = transpose_weight.shape[-1] % group_size
+                keep_k_1 = int(keep_k * temp1 * group_size / transpose_weight.shape[-1])
+                keep_k_2 = keep_k - keep_k_1
+                mask = numpy.ones(weight.shape)
+                if temp1 > 0:
+                    for i in range(temp1):
+                        transpose_weight_1 = transpose_weight[
+                            :, :, :, i * group_size : (i + 1) * group_size
+                        ]
+                        mask_1 = _block_sparsity_balance(
+                            transpose_weight_1, keep_k_1 // temp1
+                        )
+                        mask[
+                            :, i * group_size : (i + 1) * group_size, :, :
+                        ] = mask_1.cpu().numpy()
+                if temp2 > 0:
+                    transpose_weight_2 = transpose_weight[:, :, :, temp1 * group_size :]
+                    mask_2 = _block_sparsity_balance(transpose_weight_2, keep_k_2)
+                    mask[:, temp1 * group_size :, :, :] = mask_2.cpu().numpy()
+                mask = torch.as_tensor(
+                    mask, dtype=transpose_weight.dtype, device=transpose_weight.device
+                )
+            self._mask[name][:] = mask
+        else:
+            self._mask[name][:] = 0
+
+    def _update_mask_asic_2d(self, name, weight, keep_k):
+        def _block_sparsity_balance(transpose_weight, keep_k):
+            reshape_weight = transpose_weight
+            base_k = keep_k // reshape_weight.shape[0]
+            remain_k = keep_k % reshape_weight.shape[0]
+            if remain_k > 0:
+                index = torch.topk(reshape_weight.abs(), base_k + 1)[1]
+            else:
+                index = torch.topk(reshape_weight.abs(), base_k)[1]
+            dim1 = []
+            dim2 = []
+            for i, temp in enumerate(index.cpu().numpy().tolist()):
+                for j in temp:
+                    dim1.append(i)
+                    dim2.append(j)
+            mask = numpy.zeros(reshape_weight.shape)
+            mask[dim1, dim2] = 1
+            mask = torch.as_tensor(
+                mask, dtype=transpose_weight.dtype, device=transpose_weight.device
+            )
+            return mask
+
+        def _block_1x1(transpose_weight, keep_k):
+            temp1 = transpose_weight.shape[-1] // self._asic_input_gloup
+            temp2 = transpose_weight.shape[-1] % self._asic_input_gloup
+            for i in range(self._asic_input_gloup):
+                locals()["list%s" % i] = []
+            for i in range(temp1):
+                for j in range(
+                    i * self._asic_input_gloup, (i + 1) * self._asic_input_gloup
+                ):
+                    locals()["list%s" % (j % self._asic_input_gloup)].append(j)
+            for i in range(temp1 * self._asic_input_gloup, transpose_weight.shape[-1]):
+                locals()["list%s" % (i % self._asic_input_gloup)].append(i)
+            temp3 = []
+            for i in range(self._asic_input_gloup):
+                temp3.append(
+                    int(
+                        len(locals()["list%s" % i])
+                        / transpose_weight.shape[-1]
+                        * keep_k
+                    )
+                )
+            group_mask = numpy.ones(transpose_weight.shape)
+            for i in range(self._asic_input_gloup):
+                temp4 = torch.cat(
+                    [
+                        transpose_weight[:, one : one + 1]
+                        for one in locals()["list%s" % i]
+                    ],
+                    1,
+                )
+                mask = _block_sparsity_balance(temp4, temp3[i])
+                for one, two in enumerate(locals()["list%s" % i]):
+                    group_mask[:, two : two + 1] = mask[:, one : one + 1].cpu().numpy()
+            group_mask = torch.as_tensor(
+                group_mask, dtype=transpose_weight.dtype, device=transpose_weight.device
+            )
+            return group_mask
+
+        if keep_k >= 1:
+            transpose_weight = weight
+            group_size = 512
+            temp1 = transpose_weight.shape[-1] // group_size
+            temp2 = transpose_weight.shape[-1] % group_size
+            keep_k_1 = int(keep_k * temp1 * group_size / transpose_weight.shape[-1])
+            keep_k_2 = keep_k - keep_k_1
+            mask = numpy.ones(weight.shape)
+            if temp1 > 0:
+                for i in range(temp1):
+                    transpose_weight_1 = transpose_weight[
+                        :, i * group_size : (i + 1) * group_size
+                    ]
+                    mask_1 = _block_1x1(transpose_weight_1, keep_k_1 // temp1)
+                    mask[
+                        :, i * group_size : (i + 1) * group_size
+                    ] = mask_1.cpu().numpy()
+            if temp2 > 0:
+                transpose_weight_2 = transpose_weight[:, temp1 * group_size :]
+                if transpose_weight_2.shape[-1] >= self._asic_input_gloup:
+                    mask_2 = _block_1x1(transpose_weight_2, keep_k_2)
+                    mask[:, temp1 * group_size :] = mask_2.cpu().numpy()
+                else:
+                    pass
+            mask = torch.as_tensor(
+                mask, dtype=transpose_weight.dtype, device=transpose_weight.device
+            )
+            self._mask[name][:] = mask
+        else:
+            self._mask[name][:] = 0
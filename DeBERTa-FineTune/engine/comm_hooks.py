@@ -0,0 +1,81 @@
+# --------------------------------------------------------
+# [Comm Hooks] DDP communication hooks for pruned models
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+import torch
+import torch.distributed as dist
+
+
+class SparseAllReduceState:
+    """
+        State of 'sparse_allreduce_hook'. Parameters with a fixed mask only contribute their kept
+        gradient entries to the all-reduce, others are reduced as a whole.
+        The kept index of each bucket is built once, as the masks never change.
+    """
+
+    def __init__(self, param_masks, process_group=None):
+        self.process_group = process_group
+        self.param_masks = param_masks
+        self._index = {}
+        # Bytes of the gradients of this rank reduced so far, with & without the hook
+        self.bytes_sent = 0
+        self.bytes_dense = 0
+
+    def kept_index(self, bucket):
+        """Kept index of the flat bucket buffer, None if none of its parameters is masked."""
+
+        parameters = bucket.parameters()
+        key = tuple(id(parameter) for parameter in parameters)
+        if key not in self._index:
+            if not any(parameter in self.param_masks for parameter in parameters):
+                self._index[key] = None
+            else:
+                keep = torch.cat([
+                    self.param_masks[parameter].reshape(-1) if parameter in self.param_masks
+                    else parameter.new_ones(parameter.numel(), dtype=torch.bool)
+                    for parameter in parameters
+                ])
+                self._index[key] = keep.nonzero().squeeze(-1).to(bucket.buffer().device)
+
+        return self._index[key]
+
+
+def sparse_allreduce_hook(state: SparseAllReduceState, bucket):
+    """
+    All-reduce (average) only the kept gradient entries of the masked parameters, packed into one
+    contiguous tensor, then scatter them back into the bucket. Pruned entries are zeroed.
+    """
+
+    group = state.process_group if state.process_group is not None else dist.group.WORLD
+    world_size = group.size()
+
+    buffer = bucket.buffer()
+    index = state.kept_index(bucket)
+    state.bytes_dense += buffer.numel() * buffer.element_size()
+
+    if index is None:
+        state.bytes_sent += buffer.numel() * buffer.element_size()
+        future = dist.all_reduce(buffer.div_(world_size), group=group, async_op=True).get_future()
+        return future.then(lambda fut: fut.value()[0])
+
+    values = buffer.index_select(0, index).div_(world_size)
+    state.bytes_sent += values.numel() * values.element_size()
+    future = dist.all_reduce(values, group=group, async_op=True).get_future()
+
+    def scatter(fut):
+        buffer.zero_()
+        buffer.index_copy_(0, index, fut.value()[0])
+        return buffer
+
+    return future.then(scatter)
+
+
+def register_sparse_allreduce(ddp_model, pruner, process_group=None):
+    """Register 'sparse_allreduce_hook' on a DDP model, the masks of 'pruner' must be fixed."""
+
+    state = SparseAllReduceState(pruner.param_masks(fixed=True), process_group=process_group)
+    ddp_model.register_comm_hook(state, sparse_allreduce_hook)
+
+    return state
@@ -0,0 +1,96 @@
+# --------------------------------------------------------
+# [Sparse Export] Convert pruned DeBERTa checkpoints for sparse inference
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+"""
+    Convert every pruned Linear layer of a pruned checkpoint into a CSR/COO 'SparseLinear', or for
+    a checkpoint pruned with 'PRUNE.DEPLOY_DEVICE nm' into the values & metadata layout of
+    'NMSparseLinear'(the '--layout nm'), then save the result as a sparse artifact, which is loaded
+    back by 'load_sparse_model'.
+    Checkpoints are either the '.pth' files of 'save_checkpoint'(GLUE) or the directories of
+    'save_pretrained'(SQuAD).
+
+    Run this script like:
+
+    python export_sparse.py --checkpoint best.pth --task cls --output best_sparse.pth
+    python export_sparse.py --checkpoint squad_output_dir --task qa --output squad_sparse.pth --layout coo
+    python export_sparse.py --checkpoint best.pth --task cls --output best_nm.pth --layout nm --nm 2 4
+"""
+
+import os
+import sys
+import json
+import argparse
+
+import torch
+
+BASE_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(BASE_DIR, '..'))
+
+from sparse import SparseLinear, sparsify_model, save_sparse_model, load_sparse_model
+from models.configuration_deberta import DebertaConfig
+from models.modeling_deberta import DebertaForSequenceClassification, DebertaForQuestionAnswering
+
+
+MODEL_CLASSES = {
+    'cls': DebertaForSequenceClassification,
+    'qa': DebertaForQuestionAnswering,
+}
+
+
+def load_pruned_checkpoint(checkpoint):
+    """Returns (state dict, model config dict) of a '.pth' checkpoint or a 'save_pretrained' directory."""
+
+    if os.path.isdir(checkpoint):
+        state_dict = torch.load(os.path.join(checkpoint, 'pytorch_model.bin'), map_location='cpu')
+        with open(os.path.join(checkpoint, 'config.json')) as f:
+            model_config = json.load(f)
+    else:
+        checkpoint = torch.load(checkpoint, map_location='cpu')
+        state_dict, model_config = checkpoint['model'], checkpoint['model_config']
+
+    return state_dict, model_config
+
+
+def export_sparse(checkpoint, task, output, min_sparsity=0.5, layout='csr', nm=(2, 4)):
+    state_dict, model_config = load_pruned_checkpoint(checkpoint)
+    model = MODEL_CLASSES[task](DebertaConfig.from_dict(model_config))
+    model.load_state_dict(state_dict)
+    model.eval()
+
+    replaced = sparsify_model(model, min_sparsity=min_sparsity, layout=layout, nm=nm)
+    save_sparse_model(model, model_config, output)
+
+    return model, replaced
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export a pruned DeBERTa checkpoint for sparse inference")
+    parser.add_argument('--checkpoint', type=str, required=True, help="'.pth' file or 'save_pretrained' directory")
+    parser.add_argument('--task', type=str, default='cls', choices=list(MODEL_CLASSES.keys()))
+    parser.add_argument('--output', type=str, required=True, help='sparse artifact path')
+    parser.add_argument('--min_sparsity', type=float, default=0.5,
+                        help='Linear layers sparser than it are converted')
+    parser.add_argument('--layout', type=str, default='csr', choices=list(SparseLinear.LAYOUTS) + ['nm'])
+    parser.add_argument('--nm', type=int, nargs=2, default=[2, 4], metavar=('N', 'M'),
+                        help="N:M of the 'nm' layout, only the N:M sparse layers are converted")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    dense_size = os.path.getsize(args.checkpoint) if os.path.isfile(args.checkpoint) else \
+        os.path.getsize(os.path.join(args.checkpoint, 'pytorch_model.bin'))
+    model, replaced = export_sparse(
+        args.checkpoint, args.task, args.output, args.min_sparsity, args.layout, tuple(args.nm)
+    )
+    print(f"=> {len(replaced)} Linear layers converted to {args.layout.upper()}")
+    print(f"=> artifact saved to '{args.output}', {os.path.getsize(args.output) / 2 ** 20:.1f}MB "
+          f"(checkpoint {dense_size / 2 ** 20:.1f}MB)")
+
+    # Make sure the artifact loads back
+    load_sparse_model(args.output, MODEL_CLASSES[args.task], DebertaConfig)
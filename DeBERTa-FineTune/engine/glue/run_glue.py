@@ -35,6 +35,7 @@ from tqdm import tqdm
 
 from torch.optim import optimizer
 from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
 
 from datasets import load_metric
 from accelerate import Accelerator, DistributedType
@@ -73,6 +74,9 @@ from trainer_accelerate import Trainer
 from configs.glue.cfg import get_config, TASK_TO_KEYS
 
 from pruner import Prune
+from sparsity_plan import load_plan
+from comm_hooks import register_sparse_allreduce
+from lowrank import factorize_model
 # from bbcs_projection_v3_linear import Prune
 from loss import loss_dict
 
@@ -122,6 +126,11 @@ def parse_args():
         type=float,
         help='model classifier dropout rate'
     )
+    parser.add_argument(
+        "--low_rank_energy",
+        type=float,
+        help='factorize the FFN & in_proj projections keeping this ratio of the SVD energy'
+    )
     parser.add_argument(
         "--use_slow_tokenizer",
         action="store_true",
@@ -191,11 +200,22 @@ def parse_args():
     parser.add_argument('--sparse_steps', type=int, help='total sparse steps, default is the training steps')
     parser.add_argument('--prune_sparsity',type=float, help='sparsity rate')
     parser.add_argument('--prune_deploy_device',type=str,
-                        help='also known as balance. options none, fix=asic, fpga')
+                        help='also known as balance. options none, fix=asic, fpga, nm, tile')
     parser.add_argument('--prune_group_size',type=int, help='also known as bank_size')
+    parser.add_argument('--prune_nm', type=int, nargs=2, help="N M of the 'nm' deploy device, e.g. 2 4")
+    parser.add_argument('--prune_tile_size', type=int, help="tile size of the 'tile' deploy device")
     parser.add_argument('--prune_frequency',type=int, help='also known as bank_size')
     parser.add_argument('--fixed_mask', type=str, help="Fixed mask path.")
     parser.add_argument('--mask', type=str, help="mask path")
+    parser.add_argument('--prune_plan', type=str, help="per-layer sparsity plan path")
+    parser.add_argument('--prune_distributed', action='store_true', help='shard the mask computation across ranks')
+    parser.add_argument('--prune_fuse_optimizer', action='store_true',
+                        help='mask gradients & skip optimizer states of pruned weights')
+    parser.add_argument('--prune_sparse_allreduce', action='store_true',
+                        help='all-reduce only the kept gradient entries, needs a fixed mask')
+    parser.add_argument('--prune_criterion', type=str, choices=['magnitude', 'movement'],
+                        help='rank the weights by magnitude or by accumulated movement scores')
+    parser.add_argument('--prune_history', action='store_true', help='record the mask updates as deltas')
 
     # Kd
     parser.add_argument('--kd_on', action='store_true', help='whether to use knowledge distillation')
@@ -223,6 +243,11 @@ def parse_args():
 
     # Update the default configuration by command line arguments
     cfg = get_config(args)
+    # Factorized layers are renamed to '*.down/up.weight', which the prune targets do not cover
+    if cfg.MODEL.LOW_RANK_ENERGY and cfg.PRUNE.PRUNING:
+        raise ValueError("Low-rank factorization('MODEL.LOW_RANK_ENERGY') can not be combined with pruning, "
+                         "the factorized layers would be silently left unpruned.")
+
     return args, cfg
 
 
@@ -477,6 +502,14 @@ if __name__ == '__main__':
     used = time.time() - s
     logger.info(f"=> Dataloader takes time:{datetime.timedelta(used)}\n")
 
+    # Low-rank factorization(optional), the factorized layers are fine-tuned as the others
+    if cfg.MODEL.LOW_RANK_ENERGY:
+        ranks = factorize_model(model, energy=cfg.MODEL.LOW_RANK_ENERGY)
+        # Saved along the config by 'save_checkpoint', so that 'load_lowrank_model' rebuilds the shapes
+        model.config.low_rank = ranks
+        logger.info(f"=> {len(ranks)} layers factorized keeping {cfg.MODEL.LOW_RANK_ENERGY} of the SVD energy, "
+                    f"ranks: {ranks}\n")
+
     '''viii. Build optimizer & lr_scheduler'''
     # Linear scale the learning rate according to total batch size
     if cfg.TRAIN.LINEAR_SCALED_LR:
@@ -505,7 +538,66 @@ if __name__ == '__main__':
     # This is the frequency that lr scheduler updates
     lr_scheduler, num_update_steps = build_lr_scheduler(optimizer, cfg, len(train_dataloader))
 
-    '''ix. Training preparation'''
+    '''ix. Pruner setting'''
+    # Built before resuming, so that its state is loaded along the checkpoint,
+    # the schedule of a resumed run is restored from it
+    if cfg.PRUNE.PRUNING:
+        prune_dict = {}
+        for name, _ in accelerator.unwrap_model(model).named_parameters():
+            if 'deberta' in cfg.MODEL.NAME.lower():
+                # FFN
+                if ('intermediate.dense.weight' in name or 'output.dense.weight' in name) \
+                    and ('attention' not in name):
+                    prune_dict[name] = cfg.PRUNE.SPARSITY
+                # Attention
+                # TODO: whether to prune all kind of attentions(i.e. pos_proj, pos_q_proj)
+                # if 'attention.self.in_proj.weight' in name or 'attention.self.pos_proj.weight' in name \
+                #     or 'attention.self.pos_q_proj.weight' in name or 'attention.output.dense.weight' in name:
+                if 'attention.self.in_proj.weight' in name or 'attention.output.dense.weight' in name:
+                    prune_dict[name] = cfg.PRUNE.SPARSITY
+            else:
+                pass
+        # Per-layer target sparsities allocated under a latency budget
+        if cfg.PRUNE.PLAN:
+            plan = load_plan(cfg.PRUNE.PLAN)
+            prune_dict = {name: plan.get(name, sparsity) for name, sparsity in prune_dict.items()}
+        logger.info(f"=> \n[Prune Dict]\n{prune_dict}\n")
+        
+        pruner = Prune(
+            model=accelerator.unwrap_model(model), 
+            pretrain_step=0,
+            sparse_step=cfg.PRUNE.SPARSE_STEPS or (cfg.TRAIN.EPOCHS - cfg.TRAIN.START_EPOCH) * len(train_dataloader),
+            frequency=cfg.PRUNE.FREQUENCY,
+            prune_dict=prune_dict,
+            restore_sparsity=False,
+            fix_sparsity=False,
+            prune_device='default',
+            deploy_device=cfg.PRUNE.DEPLOY_DEVICE,
+            group_size=cfg.PRUNE.GROUP_SIZE,
+            fixed_mask=cfg.PRUNE.FIXED_MASK,
+            mask=cfg.PRUNE.MASK,
+            nm=tuple(cfg.PRUNE.NM),
+            tile_size=cfg.PRUNE.TILE_SIZE,
+            distributed=cfg.PRUNE.DISTRIBUTED,
+            criterion=cfg.PRUNE.CRITERION,
+            # Masks are the same on all processes, only the main one records them
+            history=os.path.join(log_dir, 'mask_history.pmhist') \
+                if cfg.PRUNE.HISTORY and accelerator.is_main_process else None
+        )
+        # Movement scores are accumulated in the optimizer step if supported, otherwise by the trainer
+        if cfg.PRUNE.CRITERION == 'movement':
+            pruner.bind_scores(optimizer)
+        if cfg.PRUNE.FUSE_OPTIMIZER and not pruner.bind_optimizer(optimizer):
+            logger.info(f"=> Optimizer '{cfg.TRAIN.OPTIMIZER.NAME}' does not support masks, only gradients are masked\n")
+        if cfg.PRUNE.SPARSE_ALLREDUCE:
+            if isinstance(model, DistributedDataParallel):
+                register_sparse_allreduce(model, pruner)
+            else:
+                logger.info("=> Model is not wrapped by DDP, sparse all-reduce is skipped\n")
+    else:
+        pruner = None
+
+    '''x. Training preparation'''
     best_avg = 0.
     best_val_results = {'accuracy': 0., 'f1': 0., 
                         'pearson': 0., 'spearmanr': 0., 'matthews_correlation': 0.}
@@ -517,10 +609,13 @@ if __name__ == '__main__':
             # Dict: metric type -> metric value
             best_val_results = load_checkpoint(
                 accelerator.unwrap_model(model), accelerator.unwrap_model(optimizer), 
-                lr_scheduler, cfg, logger
+                lr_scheduler, cfg, logger, pruner=pruner
             )
             num_update_steps = (cfg.TRAIN.EPOCHS - cfg.TRAIN.START_EPOCH) * \
                 math.ceil(len(train_dataloader) / cfg.TRAIN.GRADIENT_ACCUMULATION_STEPS)
+            # Pruning starts from scratch without a pruner state, so it is scheduled over the epochs left
+            if pruner is not None and pruner._t == 0 and not cfg.PRUNE.SPARSE_STEPS:
+                pruner._sparse_step = (cfg.TRAIN.EPOCHS - cfg.TRAIN.START_EPOCH) * len(train_dataloader)
             logger.info(
                 f"Done!\n"
                 f"[Start Epoch]:{cfg.TRAIN.START_EPOCH}\t"
@@ -546,42 +641,6 @@ if __name__ == '__main__':
     logger.info(f"  Gradient Accumulation steps = {cfg.TRAIN.GRADIENT_ACCUMULATION_STEPS}")
     logger.info(f"  Total train batch size (batch size per device x num devices x gradient accumulation steps) = {total_batch_size}\n")
 
-    '''x. Pruner setting'''
-    if cfg.PRUNE.PRUNING:
-        prune_dict = {}
-        for name, _ in accelerator.unwrap_model(model).named_parameters():
-            if 'deberta' in cfg.MODEL.NAME.lower():
-                # FFN
-                if ('intermediate.dense.weight' in name or 'output.dense.weight' in name) \
-                    and ('attention' not in name):
-                    prune_dict[name] = cfg.PRUNE.SPARSITY
-                # Attention
-                # TODO: whether to prune all kind of attentions(i.e. pos_proj, pos_q_proj)
-                # if 'attention.self.in_proj.weight' in name or 'attention.self.pos_proj.weight' in name \
-                #     or 'attention.self.pos_q_proj.weight' in name or 'attention.output.dense.weight' in name:
-                if 'attention.self.in_proj.weight' in name or 'attention.output.dense.weight' in name:
-                    prune_dict[name] = cfg.PRUNE.SPARSITY
-            else:
-                pass
-        logger.info(f"=> \n[Prune Dict]\n{prune_dict}\n")
-        
-        pruner = Prune(
-            model=accelerator.unwrap_model(model), 
-            pretrain_step=0,
-            sparse_step=cfg.PRUNE.SPARSE_STEPS or num_train_steps,
-            frequency=cfg.PRUNE.FREQUENCY,
-            prune_dict=prune_dict,
-            restore_sparsity=False,
-            fix_sparsity=False,
-            prune_device='default',
-            deploy_device=cfg.PRUNE.DEPLOY_DEVICE,
-            group_size=cfg.PRUNE.GROUP_SIZE,
-            fixed_mask=cfg.PRUNE.FIXED_MASK,
-            mask=cfg.PRUNE.MASK
-        )
-    else:
-        pruner = None
-
     '''xi. Training'''
     logger.info(f"=> Start training\n")
 
@@ -634,7 +693,7 @@ if __name__ == '__main__':
                 epoch_checkpoint = save_checkpoint(
                     log_dir, unwrap_model,
                     accelerator.unwrap_model(optimizer), lr_scheduler,
-                    epoch, unwrap_model.config, val_results
+                    epoch, unwrap_model.config, val_results, pruner=pruner
                 )
                 logger.info(f"\n=> Epoch checkpoint '{epoch_checkpoint}' saved\n")
         
@@ -655,7 +714,7 @@ if __name__ == '__main__':
                     best_checkpoint_dir, unwrap_model, 
                     accelerator.unwrap_model(optimizer), lr_scheduler, 
                     epoch, unwrap_model.config, best_saved, 
-                    tokenizer=tokenizer, accelerator=accelerator, best=True
+                    tokenizer=tokenizer, accelerator=accelerator, best=True, pruner=pruner
                 )
                 logger.info(f"\n=> Best checkpoint '{best_checkpoint}' saved\n")
 
@@ -683,7 +742,7 @@ if __name__ == '__main__':
             log_dir, unwrap_model, 
             accelerator.unwrap_model(optimizer), lr_scheduler, epoch, 
             unwrap_model.config, val_results,
-            tokenizer=tokenizer, accelerator=accelerator
+            tokenizer=tokenizer, accelerator=accelerator, pruner=pruner
         )
         logger.info(f"=>Final checkpoint '{checkpoint}' saved\n")
 
@@ -0,0 +1,190 @@
+# --------------------------------------------------------
+# [Low-Rank] SVD factorization of the FFN & attention projections of DeBERTa
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+"""
+    Replace 'attention.self.in_proj', 'intermediate.dense' & the FFN 'output.dense' of every layer
+    with a pair of dense Linear layers of rank r, initialized by the truncated SVD of the weight.
+    The rank of each layer is the smallest one keeping 'energy' of the squared singular values,
+    layers which would not get smaller are kept as they are.
+    The ranks are recorded as 'low_rank' in the model config, so that checkpoints saved by
+    'save_checkpoint' are rebuilt by 'load_lowrank_model'. 'run_glue.py' factorizes the model
+    before fine-tuning with 'MODEL.LOW_RANK_ENERGY'.
+
+    Run this script like:
+
+    python lowrank.py --checkpoint best.pth --task cls --energy 0.9 --output lowrank.pth
+"""
+
+import os
+import sys
+import argparse
+
+import torch
+import torch.nn as nn
+
+BASE_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(BASE_DIR, '..'))
+
+from sparse import _set_module
+
+
+class LowRankLinear(nn.Module):
+    """Linear layer factorized as 'up(down(x))', 'down' projects to the rank & 'up' holds the bias."""
+
+    def __init__(self, in_features, out_features, rank, bias=True):
+        super().__init__()
+
+        self.in_features = in_features
+        self.out_features = out_features
+        self.rank = rank
+        self.down = nn.Linear(in_features, rank, bias=False)
+        self.up = nn.Linear(rank, out_features, bias=bias)
+
+    @classmethod
+    def from_linear(cls, linear, rank):
+        """Truncated SVD of the weight, the singular values are split evenly over both factors."""
+
+        weight = linear.weight.data
+        out_features, in_features = weight.shape
+        layer = cls(in_features, out_features, rank, bias=linear.bias is not None)
+
+        u, s, vh = torch.linalg.svd(weight.float(), full_matrices=False)
+        root = s[:rank].sqrt()
+        with torch.no_grad():
+            layer.down.weight.copy_(root.unsqueeze(1) * vh[:rank])
+            layer.up.weight.copy_(u[:, :rank] * root)
+            if linear.bias is not None:
+                layer.up.bias.copy_(linear.bias.data)
+
+        return layer.to(weight.device, weight.dtype)
+
+    @property
+    def weight(self):
+        """Dense weight, for the code paths which read 'weight' directly(e.g. 'in_proj')."""
+        return self.up.weight @ self.down.weight
+
+    def forward(self, input):
+        return self.up(self.down(input))
+
+    def extra_repr(self):
+        return f'in_features={self.in_features}, out_features={self.out_features}, rank={self.rank}'
+
+
+def lowrank_targets(model):
+    """Names of the Linear layers to factorize, the same projections as the prune targets of 'run_glue.py'."""
+
+    return [
+        name for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and (
+            name.endswith(('attention.self.in_proj', 'intermediate.dense'))
+            or (name.endswith('output.dense') and 'attention' not in name)
+        )
+    ]
+
+
+def energy_rank(singular_values, energy, multiple=8):
+    """Smallest rank keeping 'energy' of the squared singular values, rounded up to a multiple of 'multiple'."""
+
+    power = singular_values.float() ** 2
+    ratio = power.cumsum(0) / power.sum()
+    rank = int((ratio < energy).sum()) + 1
+    rank = -(-rank // multiple) * multiple
+
+    return min(rank, singular_values.numel())
+
+
+def factorize_model(model, energy=0.9, multiple=8, names=None):
+    """
+    Factorize the target Linear layers of a model in place.
+
+    Args:
+        energy: float, ratio of the squared singular values kept by each layer.
+        multiple: int, ranks are rounded up to a multiple of it for dense-friendly shapes.
+        names: list of module names to factorize, 'lowrank_targets' if None.
+    Returns:
+        dict, module name -> rank, for the factorized layers only.
+    """
+
+    modules = dict(model.named_modules())
+    ranks = {}
+    for name in names if names is not None else lowrank_targets(model):
+        linear = modules[name]
+        out_features, in_features = linear.weight.shape
+        singular_values = torch.linalg.svdvals(linear.weight.data.float())
+        rank = energy_rank(singular_values, energy, multiple)
+        # Not worth it unless both factors together are smaller than the weight
+        if rank * (in_features + out_features) >= in_features * out_features:
+            continue
+
+        _set_module(model, name, LowRankLinear.from_linear(linear, rank))
+        ranks[name] = rank
+
+    return ranks
+
+
+def apply_ranks(model, ranks):
+    """Replace the layers with empty 'LowRankLinear' of the given ranks, to load a factorized state dict."""
+
+    modules = dict(model.named_modules())
+    for name, rank in ranks.items():
+        linear = modules[name]
+        out_features, in_features = linear.weight.shape
+        layer = LowRankLinear(in_features, out_features, rank, bias=linear.bias is not None)
+        _set_module(model, name, layer.to(linear.weight.device, linear.weight.dtype))
+
+
+def load_lowrank_model(path, model_cls, config_cls):
+    """
+    Build a model from a checkpoint of 'save_checkpoint' whose config records 'low_rank'.
+
+    Args:
+        model_cls: class of the model, e.g. 'DebertaForSequenceClassification'.
+        config_cls: class of its config, built by 'config_cls.from_dict'.
+    """
+
+    checkpoint = torch.load(path, map_location='cpu')
+    model_config = checkpoint['model_config']
+    model = model_cls(config_cls.from_dict(model_config))
+    apply_ranks(model, model_config.get('low_rank', {}))
+    model.load_state_dict(checkpoint['model'])
+
+    return model
+
+
+def count_parameters(model):
+    return sum(parameter.numel() for parameter in model.parameters())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Low-rank factorization of a DeBERTa checkpoint")
+    parser.add_argument('--checkpoint', type=str, required=True, help="'.pth' file or 'save_pretrained' directory")
+    parser.add_argument('--task', type=str, default='cls', choices=['cls', 'qa'])
+    parser.add_argument('--energy', type=float, default=0.9, help='ratio of the squared singular values kept')
+    parser.add_argument('--multiple', type=int, default=8, help='ranks are rounded up to a multiple of it')
+    parser.add_argument('--output', type=str, required=True, help='factorized checkpoint path')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    from export_sparse import MODEL_CLASSES, load_pruned_checkpoint
+    from models.configuration_deberta import DebertaConfig
+
+    state_dict, model_config = load_pruned_checkpoint(args.checkpoint)
+    model = MODEL_CLASSES[args.task](DebertaConfig.from_dict(model_config))
+    model.load_state_dict(state_dict)
+
+    num_parameters = count_parameters(model)
+    ranks = factorize_model(model, args.energy, args.multiple)
+    model.config.low_rank = ranks
+    print(f"=> {len(ranks)} layers factorized, ranks: {sorted(set(ranks.values()))}")
+    print(f"=> parameters: {num_parameters / 1e6:.1f}M -> {count_parameters(model) / 1e6:.1f}M")
+
+    # Same layout as 'save_checkpoint', loaded by 'load_lowrank_model'
+    torch.save({'model': model.state_dict(), 'model_config': model.config.to_dict()}, args.output)
+    print(f"=> factorized checkpoint saved to '{args.output}'")
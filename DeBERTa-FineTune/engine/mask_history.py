@@ -0,0 +1,233 @@
+# --------------------------------------------------------
+# [Mask History] Append-only, delta-encoded history of the pruning masks
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+"""
+    A mask history file is laid out as:
+        i.   8 bytes magic 'PMHIST1\\n';
+        ii.  records appended at every mask update, each is:
+             8 bytes little-endian unsigned header length, a utf-8 JSON header
+             {"step": int, "layers": {name: {"kind", "shape", "nbytes", "flipped", "nonzero"}}},
+             then the payload of each layer in the order of the header.
+    The payload of a 'full' layer is its bit-packed mask(see 'mask_io.py'), that of a 'delta' layer
+    the int32(int64 for huge layers) flat indices flipped since its previous record. A full mask is
+    written on the first record of a layer, every 'keyframe' records, and whenever it is smaller than
+    the delta, so that a mask is rebuilt from at most 'keyframe' records.
+
+    Print the per-layer churn or export the masks at a step to a mask file like:
+
+    python mask_history.py --history mask_history.pmhist
+    python mask_history.py --history mask_history.pmhist --step 3000 --dst mask.pmask
+"""
+
+import os
+import json
+import struct
+import argparse
+
+import numpy
+import torch
+
+from mask_io import pack_mask, unpack_mask, save_mask_file
+
+
+MAGIC = b'PMHIST1\n'
+
+
+def _index_dtype(numel):
+    return numpy.int32 if numel < 2 ** 31 else numpy.int64
+
+
+class MaskHistoryWriter:
+    """
+        Appends a record of the masks at every call, only the flipped indices of each mask are written.
+        The previous masks are kept bit-packed on their device.
+        Usage:
+            history = MaskHistoryWriter(path)
+            history.append(step, masks)
+    """
+
+    def __init__(self, path, keyframe=10):
+        assert keyframe >= 1
+        self.path = path
+        self.keyframe = keyframe
+        # Name -> (bit-packed mask of its last record, number of records since its last full one)
+        self._previous = {}
+        # Appending to an existing history starts over with full masks
+        if not os.path.exists(path) or not os.path.getsize(path):
+            with open(path, 'wb') as f:
+                f.write(MAGIC)
+        else:
+            with open(path, 'rb') as f:
+                assert f.read(len(MAGIC)) == MAGIC, f"'{path}' is not a mask history file"
+
+    def _encode(self, name, mask):
+        packed = pack_mask(mask)
+        numel = mask.numel()
+        previous, since_full = self._previous.get(name, (None, self.keyframe))
+
+        meta = {'shape': list(mask.shape), 'nonzero': int(mask.count_nonzero())}
+        if previous is None:
+            meta['flipped'] = numel
+        else:
+            flipped = unpack_mask(packed ^ previous, mask.shape).reshape(-1).nonzero().squeeze(-1)
+            meta['flipped'] = int(flipped.numel())
+
+        dtype = _index_dtype(numel)
+        if since_full + 1 >= self.keyframe or meta['flipped'] * numpy.dtype(dtype).itemsize >= packed.numel():
+            meta['kind'], payload, since_full = 'full', packed.cpu().numpy().tobytes(), 0
+        else:
+            meta['kind'], payload, since_full = 'delta', flipped.cpu().numpy().astype(dtype).tobytes(), since_full + 1
+        meta['nbytes'] = len(payload)
+        self._previous[name] = (packed, since_full)
+
+        return meta, payload
+
+    def append(self, step, masks):
+        """Append a record of 'masks'(name -> bool mask) at pruning step 'step'."""
+
+        layers, payloads = {}, []
+        with torch.no_grad():
+            for name, mask in masks.items():
+                layers[name], payload = self._encode(name, mask)
+                payloads.append(payload)
+
+        header = json.dumps({'step': int(step), 'layers': layers}).encode('utf-8')
+        with open(self.path, 'ab') as f:
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            for payload in payloads:
+                f.write(payload)
+
+
+class MaskHistory:
+    """
+        Reader of a mask history file. Only the record headers are read when it is opened,
+        payloads are read on demand to rebuild a mask.
+        Usage:
+            history = MaskHistory(path)
+            mask = history.mask(name, step)
+            churn = history.churn()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Each record: (step, {name: (meta, file offset of its payload)})
+        self.records = []
+        with open(path, 'rb') as f:
+            assert f.read(len(MAGIC)) == MAGIC, f"'{path}' is not a mask history file"
+            while True:
+                size = f.read(8)
+                # A truncated trailing record(e.g. of a killed run) is ignored
+                if len(size) < 8:
+                    break
+                header_size, = struct.unpack('<Q', size)
+                raw = f.read(header_size)
+                if len(raw) < header_size:
+                    break
+                header = json.loads(raw.decode('utf-8'))
+
+                offset, layers = f.tell(), {}
+                for name, meta in header['layers'].items():
+                    layers[name] = (meta, offset)
+                    offset += meta['nbytes']
+                if offset > os.path.getsize(path):
+                    break
+                f.seek(offset)
+                self.records.append((header['step'], layers))
+
+    @property
+    def steps(self):
+        return [step for step, _ in self.records]
+
+    def names(self):
+        names = {}
+        for _, layers in self.records:
+            names.update(dict.fromkeys(layers))
+        return list(names)
+
+    def _read(self, f, meta, offset):
+        f.seek(offset)
+        data = numpy.frombuffer(f.read(meta['nbytes']), dtype=numpy.uint8)
+        if meta['kind'] == 'full':
+            return unpack_mask(torch.from_numpy(data.copy()), meta['shape'])
+
+        numel = 1
+        for size in meta['shape']:
+            numel *= size
+        return torch.from_numpy(data.view(_index_dtype(numel)).astype(numpy.int64))
+
+    def mask(self, name, step=None):
+        """Mask of 'name' at the last record up to 'step'(the last one if None), None if not recorded yet."""
+
+        chain = []
+        for record_step, layers in self.records:
+            if step is not None and record_step > step:
+                break
+            if name not in layers:
+                continue
+            meta, offset = layers[name]
+            if meta['kind'] == 'full':
+                chain = []
+            chain.append(layers[name])
+        if not chain:
+            return None
+
+        with open(self.path, 'rb') as f:
+            mask = self._read(f, *chain[0]).reshape(-1).clone()
+            for meta, offset in chain[1:]:
+                flipped = self._read(f, meta, offset)
+                mask[flipped] = ~mask[flipped]
+
+        return mask.reshape(chain[0][0]['shape'])
+
+    def masks(self, step=None):
+        masks = {name: self.mask(name, step) for name in self.names()}
+        return {name: mask for name, mask in masks.items() if mask is not None}
+
+    def churn(self):
+        """
+        Per-layer churn from the record headers alone, no payload is read.
+
+        Returns:
+            dict, name -> list of {'step', 'flipped', 'churn', 'sparsity'} of its records, where 'churn'
+            is the ratio of the entries flipped since the previous record(1 for the first one).
+        """
+
+        stats = {}
+        for step, layers in self.records:
+            for name, (meta, _) in layers.items():
+                numel = 1
+                for size in meta['shape']:
+                    numel *= size
+                stats.setdefault(name, []).append({
+                    'step': step,
+                    'flipped': meta['flipped'],
+                    'churn': meta['flipped'] / numel,
+                    'sparsity': 1 - meta['nonzero'] / numel,
+                })
+
+        return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Churn statistics & mask export of a mask history file")
+    parser.add_argument('--history', type=str, required=True, help='mask history file')
+    parser.add_argument('--step', type=int, default=None, help='export the masks at this step, the last if not given')
+    parser.add_argument('--dst', type=str, default=None, help='output mask file of the exported masks')
+    args = parser.parse_args()
+
+    history = MaskHistory(args.history)
+    print(f"=> {len(history.records)} records, steps {history.steps[:1]}..{history.steps[-1:]}")
+    for name, records in history.churn().items():
+        # The first record is the whole mask, it is left out of the mean churn
+        churn = [one['churn'] for one in records[1:]]
+        mean_churn = sum(churn) / len(churn) if churn else 0.
+        print(f"{name}: sparsity {records[-1]['sparsity']:.4f}\tmean churn {mean_churn:.6f}\t"
+              f"last churn {records[-1]['churn'] if churn else 0.:.6f}")
+
+    if args.dst:
+        save_mask_file(history.masks(args.step), args.dst)
+        print(f"=> Masks at step {args.step} saved to '{args.dst}'")
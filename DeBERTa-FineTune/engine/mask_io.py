@@ -0,0 +1,154 @@
+# --------------------------------------------------------
+# [Mask IO] Bit-packed pruning masks & their memory-mappable file format
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+"""
+    A mask file is laid out as:
+        i.   8 bytes magic 'PMASKv1\\n';
+        ii.  8 bytes little-endian unsigned header length;
+        iii. utf-8 JSON header: {"masks": {name: {"shape": [...], "offset": int, "nbytes": int}}},
+             offsets are relative to the start of the data section;
+        iv.  data section starting at a 64 bytes aligned position, each mask is bit-packed
+             (most significant bit first, same as 'numpy.packbits') and 64 bytes aligned.
+
+    Convert a dense '.pth' mask file saved by 'torch.save' like:
+
+    python mask_io.py --src mask.pth --dst mask.pmask
+"""
+
+import json
+import struct
+import argparse
+
+import numpy
+import torch
+
+
+MAGIC = b'PMASKv1\n'
+ALIGNMENT = 64
+
+# Bit weights of a packed byte, most significant bit first
+_BITS = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8)
+
+
+def _align(size):
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+def pack_mask(mask):
+    """Bit-pack a mask(nonzero means kept) into a flat uint8 tensor on the same device."""
+
+    flat = mask.reshape(-1) != 0
+    padding = -flat.numel() % 8
+    if padding:
+        flat = torch.cat([flat, flat.new_zeros(padding)])
+
+    bits = flat.view(-1, 8).to(torch.uint8) * _BITS.to(flat.device)
+    return bits.sum(-1, dtype=torch.uint8)
+
+
+def unpack_mask(packed, shape, device=None):
+    """Inverse of 'pack_mask', returns a bool mask of 'shape'."""
+
+    packed = packed.to(device) if device is not None else packed
+    numel = 1
+    for size in shape:
+        numel *= size
+
+    bits = packed.unsqueeze(-1).bitwise_and(_BITS.to(packed.device)) != 0
+    return bits.reshape(-1)[:numel].reshape(shape)
+
+
+def is_mask_file(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def save_mask_file(masks, path):
+    """Save a dict of masks(name -> tensor) to the bit-packed mask file format."""
+
+    packed, header, offset = {}, {}, 0
+    for name, mask in masks.items():
+        packed[name] = pack_mask(mask).cpu().numpy()
+        header[name] = {'shape': list(mask.shape), 'offset': offset, 'nbytes': int(packed[name].size)}
+        offset = _align(offset + packed[name].size)
+
+    header = json.dumps({'masks': header}).encode('utf-8')
+    data_start = _align(len(MAGIC) + 8 + len(header))
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name, meta in json.loads(header)['masks'].items():
+            f.seek(data_start + meta['offset'])
+            f.write(packed[name].tobytes())
+
+    return path
+
+
+class MaskFile:
+    """
+        Memory-mapped view of a mask file, a mask is only unpacked when it is accessed.
+        Usage:
+            masks = MaskFile(path)
+            if name in masks:
+                mask = masks.get(name, device='cuda')
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            assert f.read(len(MAGIC)) == MAGIC, f"'{path}' is not a mask file"
+            header_size, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(header_size).decode('utf-8'))
+
+        self.path = path
+        self.masks = header['masks']
+        # Copy-on-write, so tensors can be built on top of it without being written back
+        data = numpy.memmap(path, dtype=numpy.uint8, mode='c')
+        self._data = data[_align(len(MAGIC) + 8 + header_size):]
+
+    def __contains__(self, name):
+        return name in self.masks
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __len__(self):
+        return len(self.masks)
+
+    def keys(self):
+        return self.masks.keys()
+
+    def packed(self, name):
+        meta = self.masks[name]
+        return torch.from_numpy(self._data[meta['offset']:meta['offset'] + meta['nbytes']])
+
+    def get(self, name, device=None):
+        return unpack_mask(self.packed(name), self.masks[name]['shape'], device=device)
+
+
+def load_masks(path):
+    """Load masks from either a mask file or a dense '.pth' file saved by 'torch.save'."""
+
+    if is_mask_file(path):
+        return MaskFile(path)
+    return torch.load(path, map_location='cpu')
+
+
+def convert_mask_file(src, dst):
+    """Convert a dense '.pth' mask file into the bit-packed mask file format."""
+
+    masks = torch.load(src, map_location='cpu')
+    return save_mask_file(masks, dst)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert a dense '.pth' mask file to the bit-packed format")
+    parser.add_argument('--src', type=str, required=True, help="dense mask file saved by 'torch.save'")
+    parser.add_argument('--dst', type=str, required=True, help='output mask file')
+    args = parser.parse_args()
+
+    convert_mask_file(args.src, args.dst)
+    print(f"=> Masks of '{args.src}' converted to '{args.dst}'")
@@ -34,8 +34,11 @@ def build_optimizer(model, config):
         optimizer = Adam(params, lr=config.TRAIN.LR, betas=config.TRAIN.OPTIMIZER.BETAS,
                          eps=config.TRAIN.OPTIMIZER.EPS, weight_decay=config.TRAIN.WEIGHT_DECAY)
     elif opt_name.lower() == 'adamw':
-        optimizer = AdamW(params, lr=config.TRAIN.LR, betas=config.TRAIN.OPTIMIZER.BETAS,
-                          eps=config.TRAIN.OPTIMIZER.EPS, weight_decay=config.TRAIN.WEIGHT_DECAY)
+        # The masked variant only when the pruning masks are fused into the optimizer(see 'Prune.bind_optimizer')
+        fuse_masks = 'PRUNE' in config and config.PRUNE.get('FUSE_OPTIMIZER', False)
+        adamw_cls = MaskedAdamW if fuse_masks else AdamW
+        optimizer = adamw_cls(params, lr=config.TRAIN.LR, betas=config.TRAIN.OPTIMIZER.BETAS,
+                              eps=config.TRAIN.OPTIMIZER.EPS, weight_decay=config.TRAIN.WEIGHT_DECAY)
     elif opt_name.lower() == 'child_tuning_adamw':
         optimizer = ChildTuningAdamW(
             params, lr=config.TRAIN.LR, betas=config.TRAIN.OPTIMIZER.BETAS,
@@ -49,7 +52,150 @@ def build_optimizer(model, config):
     return optimizer
 
 
-class ChildTuningAdamW(Optimizer):
+class MaskedStateMixin:
+    """
+    Adam states of masked parameters(see 'Prune.bind_optimizer') are kept for their kept entries only,
+    the pruned entries get neither states nor updates, so they stay zero without multiplying the masks.
+    The kept index is rebuilt whenever a mask is updated in place, the moments of the entries kept
+    before & after are carried over. The index is rebuilt from the mask rather than kept in the
+    optimizer state, so the state dict only holds the compact moments, which are restored along
+    the masks of the same checkpoint.
+    """
+
+    def set_param_masks(self, masks: dict):
+        """masks: parameter -> bool mask of the same shape, True means kept."""
+        self.param_masks = masks
+
+    def _param_mask(self, p):
+        return getattr(self, 'param_masks', {}).get(p)
+
+    def set_param_scores(self, scores: dict):
+        """scores: parameter -> movement score buffer of the same shape, see 'Prune.bind_scores'."""
+        self.param_scores = scores
+
+    def load_state_dict(self, state_dict):
+        # The cached kept indices belong to the states being replaced
+        self._kept = {}
+        super().load_state_dict(state_dict)
+        # Written by earlier versions, the index was casted to float by the loading
+        for state in self.state.values():
+            state.pop('index', None)
+            state.pop('mask_version', None)
+
+    @torch.no_grad()
+    def _accumulate_scores(self):
+        """Movement scores '-weight * grad' of all the scored parameters, as a separate multi-tensor pass before the update."""
+
+        scores = getattr(self, 'param_scores', {})
+        params = [p for p in scores if p.grad is not None]
+        if params:
+            torch._foreach_addcmul_([scores[p] for p in params], params, [p.grad for p in params], value=-1)
+
+    def _kept_index(self, p, mask):
+        """Flat index of the kept entries of 'p', the compact moments are remapped when the mask changed."""
+
+        if not hasattr(self, '_kept'):
+            self._kept = {}
+        # (index, version of the mask it is built from), the version is only meaningful in this process
+        index, version = self._kept.get(p, (None, None))
+        if index is None or version != mask._version:
+            state = self.state[p]
+            new_index = mask.reshape(-1).nonzero().squeeze(-1)
+            for key in ('exp_avg', 'exp_avg_sq'):
+                if key not in state:
+                    state[key] = p.data.new_zeros(new_index.numel())
+                elif state[key].numel() == p.numel():
+                    # Dense states, e.g. of a plain AdamW checkpoint or of steps before 'bind_optimizer'
+                    state[key] = state[key].reshape(-1)[new_index]
+                elif index is not None:
+                    dense = state[key].new_zeros(p.numel())
+                    dense[index] = state[key]
+                    state[key] = dense[new_index]
+                elif state[key].numel() != new_index.numel():
+                    # Compact states of some other masks can not be mapped, they start over
+                    state[key] = p.data.new_zeros(new_index.numel())
+                # Otherwise compact states of the same masks, i.e. resumed along the pruner
+            self._kept[p] = (new_index, mask._version)
+            # Entries pruned by the new mask won't be updated any more
+            p.data.mul_(mask)
+
+        return self._kept[p][0]
+
+
+class MaskedAdamW(MaskedStateMixin, AdamW):
+    """
+    'torch.optim.AdamW' keeping compact states for the masked parameters, whose kept entries are
+    gathered & updated by multi-tensor kernels, the pruned entries are never updated.
+    """
+
+    @torch.no_grad()
+    def step(self, closure: Callable = None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        self._accumulate_scores()
+        masks = getattr(self, 'param_masks', {})
+        # The masked parameters are hidden from 'AdamW.step' then updated over their kept entries
+        masked = []
+        for group in self.param_groups:
+            params = [p for p in group['params'] if p.grad is not None and p in masks]
+            grads = [p.grad for p in params]
+            for p in params:
+                p.grad = None
+            if params:
+                masked.append((group, params, grads))
+
+        super().step()
+
+        for group, params, grads in masked:
+            for p, grad in zip(params, grads):
+                p.grad = grad
+            self._masked_step(group, params, grads, masks)
+
+        return loss
+
+    def _masked_step(self, group, params, grads, masks):
+        """The AdamW update of 'params' over their kept entries, as a single multi-tensor update."""
+
+        if any(grad.is_sparse for grad in grads):
+            raise RuntimeError("AdamW does not support sparse gradients")
+        assert not group['amsgrad'], "amsgrad is not supported for masked parameters"
+        assert not group.get('capturable', False), "capturable is not supported for masked parameters"
+
+        beta1, beta2 = group['betas']
+        indices, weights, kept_grads, exp_avgs, exp_avg_sqs, steps = [], [], [], [], [], []
+        for p, grad in zip(params, grads):
+            index = self._kept_index(p, masks[p])
+            state = self.state[p]
+            state['step'] = int(state.get('step', 0)) + 1
+
+            indices.append(index)
+            weights.append(p.data.view(-1).index_select(0, index))
+            kept_grads.append(grad.reshape(-1).index_select(0, index))
+            exp_avgs.append(state['exp_avg'])
+            exp_avg_sqs.append(state['exp_avg_sq'])
+            steps.append(state['step'])
+        if group.get('maximize', False):
+            kept_grads = torch._foreach_neg(kept_grads)
+
+        torch._foreach_mul_(weights, 1 - group['lr'] * group['weight_decay'])
+        torch._foreach_mul_(exp_avgs, beta1)
+        torch._foreach_add_(exp_avgs, kept_grads, alpha=1 - beta1)
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+        torch._foreach_addcmul_(exp_avg_sqs, kept_grads, kept_grads, value=1 - beta2)
+
+        denoms = torch._foreach_sqrt(exp_avg_sqs)
+        torch._foreach_div_(denoms, [math.sqrt(1 - beta2 ** step) for step in steps])
+        torch._foreach_add_(denoms, group['eps'])
+        torch._foreach_addcdiv_(weights, exp_avgs, denoms, [-group['lr'] / (1 - beta1 ** step) for step in steps])
+
+        for p, index, weight in zip(params, indices, weights):
+            p.data.view(-1).index_copy_(0, index, weight)
+
+
+class ChildTuningAdamW(MaskedStateMixin, Optimizer):
     def __init__(
         self, params: Iterable[Parameter], lr: float = 1e-3, betas: tuple = (0.9, 0.999), eps: float = 1e-6,
         weight_decay: float = 0., correct_bias: bool = True, reserve_p: float = 1., mode=None
@@ -187,6 +333,7 @@ class ChildTuningAdamW(Optimizer):
         if closure is not None:
             loss = closure()
 
+        self._accumulate_scores()
         for group in self.param_groups:
             for p in group["params"]:
                 if p.grad is None:
@@ -209,6 +356,11 @@ class ChildTuningAdamW(Optimizer):
                         grad *= grad_mask
                 # =================== HACK END =========================
 
+                mask = self._param_mask(p)
+                if mask is not None:
+                    self._masked_step(group, p, grad, mask)
+                    continue
+
                 state = self.state[p]
                 # State initialization
                 if not len(state):
@@ -249,3 +401,30 @@ class ChildTuningAdamW(Optimizer):
                 p.data.add_(p.data, alpha=-group["lr"] * group["weight_decay"])
 
         return loss
+
+    def _masked_step(self, group, p, grad, mask):
+        """Same update as 'step' but over the kept entries of the mask only."""
+
+        state = self.state[p]
+        index = self._kept_index(p, mask)
+        state["step"] = state.get("step", 0) + 1
+
+        beta1, beta2 = group["betas"]
+        exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
+        grad = grad.reshape(-1).index_select(0, index)
+        weight = p.data.view(-1).index_select(0, index)
+
+        exp_avg.mul_(beta1).add_(grad, alpha=1.0 - beta1)
+        exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1.0 - beta2)
+        denom = exp_avg_sq.sqrt().add_(group["eps"])
+
+        step_size = group["lr"]
+        if group["correct_bias"]:
+            bias_correction1 = 1.0 - beta1 ** state["step"]
+            bias_correction2 = 1.0 - beta2 ** state["step"]
+            step_size = step_size * math.sqrt(bias_correction2) / bias_correction1
+
+        weight.addcdiv_(exp_avg, denom, value=-step_size)
+        weight.add_(weight, alpha=-group["lr"] * group["weight_decay"])
+
+        p.data.view(-1).index_copy_(0, index, weight)
@@ -1,7 +1,156 @@
 __all__ = ("Prune",)
 
 import torch
-import numpy
+
+from functools import lru_cache, partial
+from collections import namedtuple
+
+from mask_io import load_masks, save_mask_file, pack_mask, unpack_mask
+from mask_history import MaskHistoryWriter
+from sparse import compress_nm
+
+
+def _ceil_div(a, b):
+    return -(-a // b)
+
+
+def _bank_index(banks, num_columns, device):
+    """
+    (banks, length) column index of each bank, 'banks' is a list of column ranges.
+    Banks shorter than the longest one are padded with 'num_columns', which points to
+    the dummy column appended by '_bank_topk_mask'.
+    """
+
+    length = max((len(bank) for bank in banks), default=0)
+    index = torch.full((len(banks), length), num_columns, dtype=torch.long)
+    for i, bank in enumerate(banks):
+        index[i, :len(bank)] = torch.arange(bank.start, bank.stop, bank.step)
+
+    return index.to(device)
+
+
+@lru_cache(maxsize=None)
+def _fpga_bank_layout(in_channels, width, input_group, device):
+    """
+    Banks of a flattened 'in_channels x width' slab. If 'in_channels' can not be divided
+    by 'input_group', the slab is split into 'input_group - 1' equal banks plus a smaller
+    trailing one.
+    """
+
+    num_columns = in_channels * width
+    if in_channels % input_group == 0:
+        lengths = [num_columns // input_group] * input_group
+    else:
+        split = (input_group - 1) * (in_channels // input_group + 1)
+        lengths = [split * width // (input_group - 1)] * (input_group - 1) + [(in_channels - split) * width]
+
+    starts = [sum(lengths[:i]) for i in range(len(lengths))]
+    banks = [range(start, start + length) for start, length in zip(starts, lengths)]
+
+    return _bank_index(banks, num_columns, device)
+
+
+@lru_cache(maxsize=None)
+def _asic_bank_layout(num_columns, block_size, input_group, device):
+    """
+    Banks of the ASIC layout. Columns are split into blocks of 'block_size' and the trailing
+    block takes the rest. With 'input_group', each block is further split into 'input_group'
+    interleaved banks(column 'c' of a block belongs to bank 'c % input_group'), while a trailing
+    block narrower than 'input_group' is not pruned at all.
+
+    Returns:
+        index: (banks, length) column index of each bank.
+        uncovered: (num_columns,) bool, columns that are not pruned.
+        banks: tuple of (block, bank length, block width) for each bank.
+    """
+
+    banks, layout = [], []
+    uncovered = torch.zeros(num_columns, dtype=torch.bool)
+    for block, start in enumerate(range(0, num_columns, block_size)):
+        stop = min(start + block_size, num_columns)
+        width = stop - start
+        if input_group is None:
+            groups = [range(start, stop)]
+        elif width >= input_group:
+            groups = [range(start + group, stop, input_group) for group in range(input_group)]
+        else:
+            uncovered[start:stop] = True
+            continue
+
+        for group in groups:
+            banks.append(group)
+            layout.append((block, len(group), width))
+
+    return _bank_index(banks, num_columns, device), uncovered.to(device), tuple(layout)
+
+
+@lru_cache(maxsize=None)
+def _nm_bank_layout(num_columns, m, device):
+    """Banks of the N:M layout, every contiguous group of 'm' columns is a bank."""
+    return torch.arange(num_columns, device=device).view(-1, m)
+
+
+def _bank_topk_mask(score, index, bank_k):
+    """
+    Keep the 'bank_k[b]' largest scores of every row inside each bank 'b' with one batched top-k.
+
+    Args:
+        score: (rows, columns) non-negative scores.
+        index: (banks, length) column index of each bank, padded with 'columns'.
+        bank_k: list of int, number of entries kept per row in each bank.
+    Returns:
+        (rows, columns) bool mask.
+    """
+
+    rows, columns = score.shape
+    # The dummy column scores below any real entry so that padding is never kept
+    # unless a bank keeps more entries than it has
+    score = torch.cat([score, score.new_full((rows, 1), -1.)], dim=1)
+    mask = torch.zeros_like(score, dtype=torch.bool)
+
+    k_max = max(bank_k, default=0)
+    if k_max > 0:
+        # Sorted, so the first 'bank_k[b]' entries of bank 'b' are its own top-k
+        top = torch.topk(score[:, index], k_max, dim=-1)[1]
+        column = index.expand(rows, -1, -1).gather(-1, top)
+        rank = torch.arange(k_max, device=score.device)
+        keep = rank < torch.as_tensor(bank_k, device=score.device).unsqueeze(-1)
+        column = column.masked_fill(~keep, columns)
+        mask.scatter_(1, column.reshape(rows, -1), True)
+
+    return mask[:, :columns]
+
+
+def _tile_score(weight, tile_size):
+    """(rows // tile_size, columns // tile_size) L1 norm of every tile of a 2-D weight."""
+
+    rows, columns = weight.shape
+    tiles = weight.reshape(rows // tile_size, tile_size, columns // tile_size, tile_size)
+    return tiles.abs().sum((1, 3))
+
+
+def _bank_nonzero(matrix, index):
+    """(rows, banks) number of nonzeros of every row inside each bank."""
+
+    nonzero = matrix != 0
+    # Padding points to the dummy column, which is never counted
+    nonzero = torch.cat([nonzero, nonzero.new_zeros((nonzero.shape[0], 1))], dim=1)
+
+    return nonzero[:, index].sum(-1)
+
+
+# One entry of the prune plan built by 'Prune._prepare'
+_PlanEntry = namedtuple("_PlanEntry", ["parameter", "kind", "kernel", "numel"])
+
+# Mask kernel of each kind of the plan entries
+_KERNELS = {
+    "none": "_update_mask",
+    "fpga": "_update_mask_fpga",
+    "asic_4d": "_update_mask_asic_4d",
+    "asic_2d": "_update_mask_asic_2d",
+    "nm": "_update_mask_nm",
+    "tile": "_update_mask_tile",
+}
 
 
 class Prune:
@@ -19,7 +168,12 @@ class Prune:
         deploy_device: str = "none",
         group_size: int = 64,
         fixed_mask=None,
-        mask=None
+        mask=None,
+        nm: tuple = (2, 4),
+        tile_size: int = 32,
+        distributed: bool = False,
+        criterion: str = "magnitude",
+        history=None
     ):
         self._model = model
         self._t = current_step 
@@ -36,17 +190,38 @@ class Prune:
         # self._asic_input_gloup = 8
         self._group_size = group_size
         self._asic_input_gloup = 512 // group_size
+        # (N, M) of the N:M deploy device, keep at most N of every M contiguous input weights
+        self._nm_n, self._nm_m = nm
+        # Tiles of the tile deploy device are 'tile_size x tile_size', pruned as a whole
+        self._tile_size = tile_size
+        # Shard the mask computation across ranks, each computes its own part then broadcasts it
+        self._distributed = distributed
+        # 'magnitude' ranks the weights by |w|, 'movement' by the accumulated '-w * grad' scores
+        self._criterion = criterion
+        # Path of an append-only mask history file, recording the flipped entries at every mask update
+        self._history = MaskHistoryWriter(history) if history else None
         self._check_parameter()
         self.fixed_mask = fixed_mask
         self.mask = mask 
+        # Bool masks, 1 byte per entry instead of a full precision copy of the weights
         self._mask = {}
+        # Number of kept entries of each mask, as device tensors
+        self._nonzero = {}
+        # Movement scores, device buffers of the same shape as the parameters
+        self._score = {}
+        # Set by 'bind_scores', the optimizer accumulates the scores in its step instead
+        self._scores_fused = False
+        # Set by 'bind_optimizer', the optimizer keeps pruned entries zero instead of 'prune()'
+        self._fused = False
+        self._applied = False
+        self._hooks = []
         self._prepare()
         if self.fixed_mask:
-            self._mask = torch.load(self.fixed_mask)
+            self._load_mask(self.fixed_mask)
             self._fix_sparsity = True
 
         if self.mask:
-            self._mask = torch.load(self.mask)
+            self._load_mask(self.mask)
 
     def _check_parameter(self):
         assert isinstance(self._pretrain_step, int)
@@ -56,330 +231,281 @@ class Prune:
         assert isinstance(self._restore_sparsity, bool)
         assert isinstance(self._fix_sparsity, bool)
         assert self._prune_device in ["default", "cpu"]
-        assert self._deploy_device in ["none", "fpga", "asic"]
+        assert self._deploy_device in ["none", "fpga", "asic", "nm", "tile"]
+        assert isinstance(self._tile_size, int) and self._tile_size > 0
+        assert isinstance(self._distributed, bool)
+        assert self._criterion in ["magnitude", "movement"]
+        assert 0 < self._nm_n <= self._nm_m
 
     def _prepare(self):
+        """Build the prune plan: target parameter -> (parameter, kernel kind, mask kernel, number of elements)."""
+
+        self._plan = {}
         with torch.no_grad():
             for name, parameter in self._model.named_parameters():
-                if any(name == one for one in self._prune_dict):
-                    if (
-                        (self._deploy_device == "fpga")
-                        and (len(parameter.shape) == 4)
-                        and (parameter.shape[1] < self._fpga_input_group)
-                    ):
-                        self._prune_dict.pop(name)
-                        print(
-                            "For %s, the parameter %s cannot be balanced pruned and will be deleted from the prune_dict."
-                            % (self._deploy_device, name)
-                        )
-                        continue
-                    elif (
-                        (self._deploy_device == "asic")
-                        and (len(parameter.shape) == 4)
-                        and (parameter.shape[1] < self._asic_input_gloup)
-                        and ([parameter.shape[2], parameter.shape[3]] == [1, 1])
-                    ):
-                        self._prune_dict.pop(name)
-                        print(
-                            "For %s, the parameter %s cannot be balanced pruned and will be deleted from the prune_dict."
-                            % (self._deploy_device, name)
-                        )
-                        continue
-                    weight = self._get_weight(parameter)
-                    if self._restore_sparsity == True:
-                        mask = torch.where(
-                            weight == 0,
-                            torch.zeros_like(weight),
-                            torch.ones_like(weight),
-                        )
-                        self._initial_sparsity[name] = (
-                            1
-                            - mask.cpu().numpy().astype(numpy.float32).sum()
-                            / weight.cpu().numpy().size
-                        )
-                        self._mask[name] = mask
-                    else:
-                        self._initial_sparsity[name] = 0
-                        self._mask[name] = torch.ones_like(weight)
+                if name not in self._prune_dict:
+                    continue
+                if (
+                    (self._deploy_device == "fpga")
+                    and (len(parameter.shape) == 4)
+                    and (parameter.shape[1] < self._fpga_input_group)
+                ) or (
+                    (self._deploy_device == "asic")
+                    and (len(parameter.shape) == 4)
+                    and (parameter.shape[1] < self._asic_input_gloup)
+                    and ([parameter.shape[2], parameter.shape[3]] == [1, 1])
+                ) or (
+                    (self._deploy_device == "nm")
+                    and ((len(parameter.shape) != 2) or (parameter.shape[1] % self._nm_m != 0))
+                ) or (
+                    (self._deploy_device == "tile")
+                    and ((len(parameter.shape) != 2) or any(size % self._tile_size for size in parameter.shape))
+                ):
+                    self._prune_dict.pop(name)
+                    print(
+                        "For %s, the parameter %s cannot be balanced pruned and will be deleted from the prune_dict."
+                        % (self._deploy_device, name)
+                    )
+                    continue
+                # Masks live on the parameter's device so that they can be applied in place
+                if self._restore_sparsity == True:
+                    mask = parameter.data != 0
+                    self._initial_sparsity[name] = 1 - mask.sum().item() / mask.numel()
+                else:
+                    mask = torch.ones_like(parameter.data, dtype=torch.bool)
+                    self._initial_sparsity[name] = 0
+                self._mask[name] = mask
+                if self._criterion == "movement":
+                    self._score[name] = torch.zeros_like(parameter.data)
+                kind = self._select_kernel(parameter)
+                self._plan[name] = _PlanEntry(parameter, kind, getattr(self, _KERNELS[kind]), parameter.numel())
+
+    def _select_kernel(self, parameter):
+        if self._deploy_device == "fpga" and len(parameter.shape) == 4:
+            return "fpga"
+        if self._deploy_device == "asic" and len(parameter.shape) == 4:
+            return "asic_4d"
+        if self._deploy_device == "asic" and len(parameter.shape) == 2:
+            return "asic_2d"
+        if self._deploy_device == "nm":
+            return "nm"
+        if self._deploy_device == "tile":
+            return "tile"
+
+        return "none"
+
+    def _load_mask(self, path):
+        """
+        Load masks from a bit-packed mask file(see 'mask_io.py') or a dense '.pth' file,
+        masks of a mask file are memory-mapped and only the planned ones are unpacked.
+        """
+
+        masks = load_masks(path)
+        for name, entry in self._plan.items():
+            if name in masks:
+                mask = torch.as_tensor(masks[name], device=entry.parameter.device)
+                self._mask[name] = mask != 0
+                self._nonzero.pop(name, None)
+
+    def save_mask(self, path):
+        """Save the masks to a bit-packed mask file, which can be passed as 'mask' or 'fixed_mask'."""
+        return save_mask_file(self._mask, path)
+
+    def state_dict(self):
+        """
+        State to resume pruning from: the step, the sparsity schedule & the bit-packed masks,
+        so that the masks take 1 bit per entry in a checkpoint.
+        """
+
+        return {
+            't': self._t,
+            'pretrain_step': self._pretrain_step,
+            'sparse_step': self._sparse_step,
+            'frequency': self._frequency,
+            'prune_dict': dict(self._prune_dict),
+            'initial_sparsity': dict(self._initial_sparsity),
+            'masks': {name: pack_mask(mask).cpu() for name, mask in self._mask.items()},
+            'scores': {name: score.cpu() for name, score in self._score.items()},
+        }
+
+    def load_state_dict(self, state_dict):
+        """
+        Resume from 'state_dict()'. The schedule is restored as well, so that a resumed run continues
+        at the exact step & sparsity whatever number of steps is left. Masks are copied in place, which
+        keeps them bound to the optimizer & the gradient hooks.
+        """
+
+        self._t = state_dict['t']
+        self._pretrain_step = state_dict['pretrain_step']
+        self._sparse_step = state_dict['sparse_step']
+        self._frequency = state_dict['frequency']
+
+        missing = [name for name in self._plan if name not in state_dict['masks']]
+        if missing:
+            raise RuntimeError(f"Masks of {len(missing)} pruned parameter(s) are missing in the state: {missing}")
+
+        with torch.no_grad():
+            for name in self._plan:
+                self._prune_dict[name] = state_dict['prune_dict'].get(name, self._prune_dict[name])
+                self._initial_sparsity[name] = state_dict['initial_sparsity'].get(name, self._initial_sparsity[name])
+                mask = self._mask[name]
+                mask.copy_(unpack_mask(state_dict['masks'][name], mask.shape, device=mask.device))
+                self._nonzero.pop(name, None)
+                if name in self._score and name in state_dict.get('scores', {}):
+                    self._score[name].copy_(state_dict['scores'][name])
+        # Applied again at the next 'prune()'
+        self._applied = False
 
     def _update_mask(self, name, weight, keep_k):
         if keep_k >= 1:
-            reshape_weight = weight.reshape(-1)
-            index = torch.topk(reshape_weight.abs(), keep_k)[1].cpu().numpy().tolist()
-            mask = numpy.zeros(reshape_weight.shape)
-            mask[index] = 1
-            mask = mask.reshape(weight.shape)
-            mask = torch.as_tensor(mask, dtype=weight.dtype, device=weight.device)
-            self._mask[name][:] = mask
+            # Top-k & scatter stay on the weight's device, no host round trip
+            index = torch.topk(weight.reshape(-1).abs(), keep_k, sorted=False)[1]
+            mask = self._mask[name].zero_()
+            mask.view(-1).scatter_(0, index.to(mask.device), True)
         else:
-            self._mask[name][:] = 0
+            self._mask[name].zero_()
 
-    def _update_mask_fpga(self, name, weight, keep_k):
-        def _block_sparsity_balance(transpose_weight, keep_k, inc_group):
-            reshape_weight = transpose_weight.reshape(
-                [
-                    -1,
-                    transpose_weight.shape[-2]
-                    * transpose_weight.shape[-1]
-                    // inc_group,
-                ]
-            )
-            base_k = keep_k // reshape_weight.shape[0]
-            remain_k = keep_k % reshape_weight.shape[0]
-            if remain_k > 0:
-                index = torch.topk(reshape_weight.abs(), base_k + 1)[1]
-            else:
-                index = torch.topk(reshape_weight.abs(), base_k)[1]
-            dim1 = []
-            dim2 = []
-            for i, temp in enumerate(index.cpu().numpy().tolist()):
-                for j in temp:
-                    dim1.append(i)
-                    dim2.append(j)
-            mask = numpy.zeros(reshape_weight.shape)
-            mask[dim1, dim2] = 1
-            mask = mask.reshape(transpose_weight.shape)
-            mask = mask.transpose([0, 2, 1, 3])
-            mask = torch.as_tensor(
-                mask, dtype=transpose_weight.dtype, device=transpose_weight.device
-            )
-            return mask
+    def _fpga_banks(self, weight, keep_k):
+        """
+        FPGA bank layout of a 4-D weight. Every (output channel, kernel row) slab of
+        'in_channels x width' is a row, its balanced banks are laid out by '_fpga_bank_layout'.
+
+        Returns:
+            matrix: (rows, columns) view of the weight.
+            index: (banks, length) column index of each bank.
+            bank_k: list of int, number of entries kept per row in each bank.
+            uncovered: columns that are not pruned, None as all are.
+        """
+
+        out_channels, in_channels, height, width = weight.shape
+        rows = out_channels * height
+        matrix = weight.permute([0, 2, 1, 3]).reshape(rows, -1)
+        index = _fpga_bank_layout(in_channels, width, self._fpga_input_group, weight.device)
+        if in_channels % self._fpga_input_group == 0:
+            bank_k = [_ceil_div(keep_k, rows * self._fpga_input_group)] * self._fpga_input_group
+        else:
+            num_banks = self._fpga_input_group - 1
+            split = num_banks * (in_channels // self._fpga_input_group + 1)
+            keep_k_1 = int(split / in_channels * keep_k)
+            keep_k_2 = keep_k - keep_k_1
+            bank_k = [_ceil_div(keep_k_1, rows * num_banks)] * num_banks + [_ceil_div(keep_k_2, rows)]
+
+        return matrix, index, bank_k, None
+
+    def _asic_banks(self, weight, keep_k):
+        """
+        ASIC bank layout of a 2-D or 4-D weight, the banks are laid out by '_asic_bank_layout'
+        and 'keep_k' is shared out over blocks then banks. Returns the same as '_fpga_banks'.
+        """
+
+        if len(weight.shape) == 2:
+            matrix, block_size, input_group = weight, 512, self._asic_input_gloup
+        elif weight.shape[2] == 1 and weight.shape[3] == 1:
+            matrix, block_size, input_group = weight.reshape(weight.shape[:2]), 512, self._asic_input_gloup
+        else:
+            # Rows are the (output channel, kernel position) pairs, banks are along input channels
+            matrix = weight.permute([0, 2, 3, 1]).reshape(-1, weight.shape[1])
+            block_size, input_group = self._group_size, None
+
+        rows, columns = matrix.shape
+        index, uncovered, banks = _asic_bank_layout(columns, block_size, input_group, weight.device)
+
+        num_blocks = columns // block_size
+        keep_k_1 = int(keep_k * num_blocks * block_size / columns)
+        block_k = [keep_k_1 // num_blocks] * num_blocks if num_blocks else []
+        if columns % block_size:
+            block_k.append(keep_k - keep_k_1)
+        bank_k = [
+            _ceil_div(int(length / width * block_k[block]), rows)
+            for block, length, width in banks
+        ]
 
+        return matrix, index, bank_k, uncovered
+
+    def _nm_keep(self, numel, keep_k):
+        """
+        N of the current step. It is annealed from M down to the target N as the cubic schedule
+        goes, i.e. the smallest N keeping no less than 'keep_k' entries, but never below the target.
+        """
+
+        n = _ceil_div(keep_k * self._nm_m, numel)
+        return min(max(n, self._nm_n), self._nm_m)
+
+    def _nm_banks(self, weight, keep_k):
+        """N:M bank layout of a 2-D weight, returns the same as '_fpga_banks'."""
+
+        rows, columns = weight.shape
+        index = _nm_bank_layout(columns, self._nm_m, weight.device)
+        bank_k = [self._nm_keep(weight.numel(), keep_k)] * index.shape[0]
+
+        return weight, index, bank_k, None
+
+    def _tile_keep(self, numel, keep_k):
+        """Number of tiles kept, rounded up so that the sparsity never overshoots the schedule."""
+        return min(_ceil_div(keep_k, self._tile_size ** 2), numel // self._tile_size ** 2)
+
+    def _banks(self, kind, weight, keep_k):
+        if kind == "fpga":
+            return self._fpga_banks(weight, keep_k)
+        if kind in ("asic_4d", "asic_2d"):
+            return self._asic_banks(weight, keep_k)
+        if kind == "nm":
+            return self._nm_banks(weight, keep_k)
+
+        return None
+
+    def _update_mask_fpga(self, name, weight, keep_k):
         if keep_k >= 1:
-            transpose_weight = weight.permute([0, 2, 1, 3])
-            if transpose_weight.shape[-2] % self._fpga_input_group == 0:
-                mask = _block_sparsity_balance(
-                    transpose_weight, keep_k, self._fpga_input_group
-                )
-            else:
-                temp1 = transpose_weight.shape[-2]
-                temp4 = (self._fpga_input_group - 1) * (
-                    temp1 // self._fpga_input_group + 1
-                )
-                keep_k_1 = int(temp4 / temp1 * keep_k)
-                keep_k_2 = keep_k - keep_k_1
-                transpose_weight_1 = transpose_weight[:, :, :temp4, :]
-                transpose_weight_2 = transpose_weight[:, :, temp4:, :]
-                mask_1 = _block_sparsity_balance(
-                    transpose_weight_1, keep_k_1, self._fpga_input_group - 1
-                )
-                mask_2 = _block_sparsity_balance(transpose_weight_2, keep_k_2, 1)
-                mask = torch.cat([mask_1, mask_2], 1)
-            self._mask[name][:] = mask
+            matrix, index, bank_k, _ = self._fpga_banks(weight, keep_k)
+            mask = _bank_topk_mask(matrix.abs(), index, bank_k)
+            out_channels, in_channels, height, width = weight.shape
+            mask = mask.reshape(out_channels, height, in_channels, width).permute([0, 2, 1, 3])
+            self._mask[name].copy_(mask)
         else:
-            self._mask[name][:] = 0
+            self._mask[name].zero_()
 
     def _update_mask_asic_4d(self, name, weight, keep_k):
-        def _block_sparsity_balance(transpose_weight, keep_k):
-            reshape_weight = transpose_weight.reshape([-1, transpose_weight.shape[-1]])
-            base_k = keep_k // reshape_weight.shape[0]
-            remain_k = keep_k % reshape_weight.shape[0]
-            if remain_k > 0:
-                index = torch.topk(reshape_weight.abs(), base_k + 1)[1]
-            else:
-                index = torch.topk(reshape_weight.abs(), base_k)[1]
-            dim1 = []
-            dim2 = []
-            for i, temp in enumerate(index.cpu().numpy().tolist()):
-                for j in temp:
-                    dim1.append(i)
-                    dim2.append(j)
-            mask = numpy.zeros(reshape_weight.shape)
-            mask[dim1, dim2] = 1
-            mask = mask.reshape(transpose_weight.shape)
-            mask = mask.transpose([0, 3, 1, 2])
-            mask = torch.as_tensor(
-                mask, dtype=transpose_weight.dtype, device=transpose_weight.device
-            )
-            return mask
-
-        def _block_1x1(transpose_weight, keep_k):
-            temp1 = transpose_weight.shape[-1] // self._asic_input_gloup
-            temp2 = transpose_weight.shape[-1] % self._asic_input_gloup
-            for i in range(self._asic_input_gloup):
-                locals()["list%s" % i] = []
-            for i in range(temp1):
-                for j in range(
-                    i * self._asic_input_gloup, (i + 1) * self._asic_input_gloup
-                ):
-                    locals()["list%s" % (j % self._asic_input_gloup)].append(j)
-            for i in range(temp1 * self._asic_input_gloup, transpose_weight.shape[-1]):
-                locals()["list%s" % (i % self._asic_input_gloup)].append(i)
-            temp3 = []
-            for i in range(self._asic_input_gloup):
-                temp3.append(
-                    int(
-                        len(locals()["list%s" % i])
-                        / transpose_weight.shape[-1]
-                        * keep_k
-                    )
-                )
-            group_mask = numpy.ones(transpose_weight.shape).transpose([0, 3, 1, 2])
-            for i in range(self._asic_input_gloup):
-                temp4 = torch.cat(
-                    [
-                        transpose_weight[:, :, :, one : one + 1]
-                        for one in locals()["list%s" % i]
-                    ],
-                    3,
-                )
-                mask = _block_sparsity_balance(temp4, temp3[i])
-                for one, two in enumerate(locals()["list%s" % i]):
-                    group_mask[:, two : two + 1, :, :] = (
-                        mask[:, one : one + 1, :, :].cpu().numpy()
-                    )
-            group_mask = torch.as_tensor(
-                group_mask, dtype=transpose_weight.dtype, device=transpose_weight.device
-            )
-            return group_mask
-
         if keep_k >= 1:
-            transpose_weight = weight.permute([0, 2, 3, 1])
-            if transpose_weight.shape[1] == 1 and transpose_weight.shape[2] == 1:
-                group_size = 512
-                temp1 = transpose_weight.shape[-1] // group_size
-                temp2 = transpose_weight.shape[-1] % group_size
-                keep_k_1 = int(keep_k * temp1 * group_size / transpose_weight.shape[-1])
-                keep_k_2 = keep_k - keep_k_1
-                mask = numpy.ones(weight.shape)
-                if temp1 > 0:
-                    for i in range(temp1):
-                        transpose_weight_1 = transpose_weight[
-                            :, :, :, i * group_size : (i + 1) * group_size
-                        ]
-                        mask_1 = _block_1x1(transpose_weight_1, keep_k_1 // temp1)
-                        mask[
-                            :, i * group_size : (i + 1) * group_size, :, :
-                        ] = mask_1.cpu().numpy()
-                if temp2 > 0:
-                    transpose_weight_2 = transpose_weight[:, :, :, temp1 * group_size :]
-                    if transpose_weight_2.shape[-1] >= self._asic_input_gloup:
-                        mask_2 = _block_1x1(transpose_weight_2, keep_k_2)
-                        mask[:, temp1 * group_size :, :, :] = mask_2.cpu().numpy()
-                    else:
-                        pass
-                mask = torch.as_tensor(
-                    mask, dtype=transpose_weight.dtype, device=transpose_weight.device
-                )
+            matrix, index, bank_k, uncovered = self._asic_banks(weight, keep_k)
+            mask = _bank_topk_mask(matrix.abs(), index, bank_k) | uncovered
+            out_channels, in_channels, height, width = weight.shape
+            if height == 1 and width == 1:
+                mask = mask.reshape(weight.shape)
             else:
-                group_size = self._group_size
-                temp1 = transpose_weight.shape[-1] // group_size
-                temp2 = transpose_weight.shape[-1] % group_size
-                keep_k_1 = int(keep_k * temp1 * group_size / transpose_weight.shape[-1])
-                keep_k_2 = keep_k - keep_k_1
-                mask = numpy.ones(weight.shape)
-                if temp1 > 0:
-                    for i in range(temp1):
-                        transpose_weight_1 = transpose_weight[
-                            :, :, :, i * group_size : (i + 1) * group_size
-                        ]
-                        mask_1 = _block_sparsity_balance(
-                            transpose_weight_1, keep_k_1 // temp1
-                        )
-                        mask[
-                            :, i * group_size : (i + 1) * group_size, :, :
-                        ] = mask_1.cpu().numpy()
-                if temp2 > 0:
-                    transpose_weight_2 = transpose_weight[:, :, :, temp1 * group_size :]
-                    mask_2 = _block_sparsity_balance(transpose_weight_2, keep_k_2)
-                    mask[:, temp1 * group_size :, :, :] = mask_2.cpu().numpy()
-                mask = torch.as_tensor(
-                    mask, dtype=transpose_weight.dtype, device=transpose_weight.device
-                )
-            self._mask[name][:] = mask
+                mask = mask.reshape(out_channels, height, width, in_channels).permute([0, 3, 1, 2])
+            self._mask[name].copy_(mask)
         else:
-            self._mask[name][:] = 0
+            self._mask[name].zero_()
 
     def _update_mask_asic_2d(self, name, weight, keep_k):
-        def _block_sparsity_balance(transpose_weight, keep_k):
-            reshape_weight = transpose_weight
-            base_k = keep_k // reshape_weight.shape[0]
-            remain_k = keep_k % reshape_weight.shape[0]
-            if remain_k > 0:
-                index = torch.topk(reshape_weight.abs(), base_k + 1)[1]
-            else:
-                index = torch.topk(reshape_weight.abs(), base_k)[1]
-            dim1 = []
-            dim2 = []
-            for i, temp in enumerate(index.cpu().numpy().tolist()):
-                for j in temp:
-                    dim1.append(i)
-                    dim2.append(j)
-            mask = numpy.zeros(reshape_weight.shape)
-            mask[dim1, dim2] = 1
-            mask = torch.as_tensor(
-                mask, dtype=transpose_weight.dtype, device=transpose_weight.device
-            )
-            return mask
-
-        def _block_1x1(transpose_weight, keep_k):
-            temp1 = transpose_weight.shape[-1] // self._asic_input_gloup
-            temp2 = transpose_weight.shape[-1] % self._asic_input_gloup
-            for i in range(self._asic_input_gloup):
-                locals()["list%s" % i] = []
-            for i in range(temp1):
-                for j in range(
-                    i * self._asic_input_gloup, (i + 1) * self._asic_input_gloup
-                ):
-                    locals()["list%s" % (j % self._asic_input_gloup)].append(j)
-            for i in range(temp1 * self._asic_input_gloup, transpose_weight.shape[-1]):
-                locals()["list%s" % (i % self._asic_input_gloup)].append(i)
-            temp3 = []
-            for i in range(self._asic_input_gloup):
-                temp3.append(
-                    int(
-                        len(locals()["list%s" % i])
-                        / transpose_weight.shape[-1]
-                        * keep_k
-                    )
-                )
-            group_mask = numpy.ones(transpose_weight.shape)
-            for i in range(self._asic_input_gloup):
-                temp4 = torch.cat(
-                    [
-                        transpose_weight[:, one : one + 1]
-                        for one in locals()["list%s" % i]
-                    ],
-                    1,
-                )
-                mask = _block_sparsity_balance(temp4, temp3[i])
-                for one, two in enumerate(locals()["list%s" % i]):
-                    group_mask[:, two : two + 1] = mask[:, one : one + 1].cpu().numpy()
-            group_mask = torch.as_tensor(
-                group_mask, dtype=transpose_weight.dtype, device=transpose_weight.device
-            )
-            return group_mask
-
         if keep_k >= 1:
-            transpose_weight = weight
-            group_size = 512
-            temp1 = transpose_weight.shape[-1] // group_size
-            temp2 = transpose_weight.shape[-1] % group_size
-            keep_k_1 = int(keep_k * temp1 * group_size / transpose_weight.shape[-1])
-            keep_k_2 = keep_k - keep_k_1
-            mask = numpy.ones(weight.shape)
-            if temp1 > 0:
-                for i in range(temp1):
-                    transpose_weight_1 = transpose_weight[
-                        :, i * group_size : (i + 1) * group_size
-                    ]
-                    mask_1 = _block_1x1(transpose_weight_1, keep_k_1 // temp1)
-                    mask[
-                        :, i * group_size : (i + 1) * group_size
-                    ] = mask_1.cpu().numpy()
-            if temp2 > 0:
-                transpose_weight_2 = transpose_weight[:, temp1 * group_size :]
-                if transpose_weight_2.shape[-1] >= self._asic_input_gloup:
-                    mask_2 = _block_1x1(transpose_weight_2, keep_k_2)
-                    mask[:, temp1 * group_size :] = mask_2.cpu().numpy()
-                else:
-                    pass
-            mask = torch.as_tensor(
-                mask, dtype=transpose_weight.dtype, device=transpose_weight.device
-            )
-            self._mask[name][:] = mask
+            matrix, index, bank_k, uncovered = self._asic_banks(weight, keep_k)
+            mask = _bank_topk_mask(matrix.abs(), index, bank_k) | uncovered
+            self._mask[name].copy_(mask)
+        else:
+            self._mask[name].zero_()
+
+    def _update_mask_nm(self, name, weight, keep_k):
+        # Groups are contiguous, so a plain top-k along the last dim of a view does it
+        n = self._nm_keep(weight.numel(), keep_k)
+        groups = weight.reshape(weight.shape[0], -1, self._nm_m).abs()
+        index = torch.topk(groups, n, dim=-1, sorted=False)[1]
+        mask = self._mask[name].zero_()
+        mask.view(groups.shape).scatter_(-1, index.to(mask.device), True)
+
+    def _update_mask_tile(self, name, weight, keep_k):
+        keep_tiles = self._tile_keep(weight.numel(), keep_k)
+        mask = self._mask[name]
+        if keep_tiles >= 1:
+            score = _tile_score(weight, self._tile_size)
+            index = torch.topk(score.reshape(-1), keep_tiles, sorted=False)[1]
+            tiles = torch.zeros(score.numel(), dtype=torch.bool, device=mask.device)
+            tiles.scatter_(0, index.to(mask.device), True)
+            # Broadcast every tile over its 'tile_size x tile_size' entries
+            tiles = tiles.view(score.shape[0], 1, score.shape[1], 1)
+            mask.view(score.shape[0], self._tile_size, score.shape[1], self._tile_size).copy_(tiles)
         else:
-            self._mask[name][:] = 0
+            mask.zero_()
 
     def _update_mask_conditions(self):
         condition1 = self._fix_sparsity == False
@@ -396,324 +522,323 @@ class Prune:
             weight = parameter.data.to(device=torch.device("cpu"))
         return weight
 
+    def _current_sparsity(self, name):
+        """Cubic sparsity schedule from the initial sparsity to the target one."""
+
+        target_sparsity = self._prune_dict[name]
+        current_sparse_step = (self._t - self._pretrain_step) // self._frequency
+        total_srarse_step = self._sparse_step // self._frequency
+
+        return (
+            target_sparsity
+            + (self._initial_sparsity[name] - target_sparsity)
+            * (1.0 - current_sparse_step / total_srarse_step) ** 3
+        )
+
     def prune(self):
         current_sparsity = None
 
         with torch.no_grad():
             self._t = self._t + 1
-            for name, parameter in self._model.named_parameters():
-                if any(name == one for one in self._prune_dict):
-                    weight = self._get_weight(parameter)
-                    if self._update_mask_conditions():
-                        weight = weight * self._mask[name]
-                        target_sparsity = self._prune_dict[name]
-                        current_sparse_step = (
-                            self._t - self._pretrain_step
-                        ) // self._frequency
-                        total_srarse_step = self._sparse_step // self._frequency
-                        current_sparsity = (
-                            target_sparsity
-                            + (self._initial_sparsity[name] - target_sparsity)
-                            * (1.0 - current_sparse_step / total_srarse_step) ** 3
-                        )
-                        keep_k = int(
-                            weight.cpu().numpy().size * (1.0 - current_sparsity)
-                        )
-                        if self._deploy_device == "none":
-                            self._update_mask(name, weight, keep_k)
-                        elif self._deploy_device == "fpga":
-                            if len(weight.shape) == 4:
-                                self._update_mask_fpga(name, weight, keep_k)
-                            else:
-                                self._update_mask(name, weight, keep_k)
-                        elif self._deploy_device == "asic":
-                            if len(weight.shape) == 4:
-                                self._update_mask_asic_4d(name, weight, keep_k)
-                            elif len(weight.shape) == 2:
-                                self._update_mask_asic_2d(name, weight, keep_k)
-                            else:
-                                self._update_mask(name, weight, keep_k)
-
-                    mask = self._mask[name]
-                    if not mask.is_cuda:
-                        mask = torch.as_tensor(
-                            mask, dtype=weight.dtype, device=weight.device
-                        )
-                        self._mask[name] = mask
-                    parameter.mul_(self._mask[name])
+            if self._update_mask_conditions():
+                owned = self._owned_shard()
+                for name, entry in self._plan.items():
+                    current_sparsity = self._current_sparsity(name)
+                    if owned is not None and name not in owned:
+                        continue
+                    weight = self._get_weight(self._importance(name, entry))
+                    keep_k = int(entry.numel * (1.0 - current_sparsity))
+                    entry.kernel(name, weight, keep_k)
+                if owned is not None:
+                    self._broadcast_masks()
+
+                for name in self._plan:
+                    # Kept on device, read back by 'sparsity(from_mask=True)'
+                    self._nonzero[name] = self._mask[name].count_nonzero()
+                if self._history is not None:
+                    self._history.append(self._t, self._mask)
+
+            # Only the planned parameters are touched, multiplied by their bool masks(promoted
+            # in the kernel, never cast to the parameter's dtype) in one fused call. Once fused
+            # into the optimizer, they are only applied when they change.
+            if not self._fused or not self._applied or current_sparsity is not None:
+                parameters = [entry.parameter for entry in self._plan.values()]
+                masks = [self._mask[name] for name in self._plan]
+                if hasattr(torch, "_foreach_mul_"):
+                    torch._foreach_mul_(parameters, masks)
+                else:
+                    for parameter, mask in zip(parameters, masks):
+                        parameter.mul_(mask)
+                self._applied = True
 
         return current_sparsity
 
-    def sparsity(self):
-        total_param = 0
-        total_nonezero = 0
-        layer_sparse_rate = {}
-        for name, parameter in self._model.named_parameters():
-            if any(name == one for one in self._prune_dict):
-                temp = parameter.data.cpu().numpy()
-                total_param = total_param + temp.size
-                total_nonezero = total_nonezero + numpy.flatnonzero(temp).size
-                layer_sparse_rate[name] = 1 - numpy.flatnonzero(temp).size / temp.size
-        total_sparse_rate = 1 - total_nonezero / total_param
-        return layer_sparse_rate, total_sparse_rate
+    def _importance(self, name, entry):
+        """
+        Non-negative importance of the entries, ranked through '.abs()' by the mask kernels,
+        the pruned entries are the least important so that they stay pruned.
+        """
 
-    def check(self):
-        def _check_weight(weight, keep_k):
-            qualify = numpy.flatnonzero(weight).size <= keep_k
-            return qualify
-
-        def _check_weight_fpga(weight, keep_k):
-            def _check_block_sparsity_balance(transpose_weight, keep_k, inc_group):
-                reshape_weight = transpose_weight.reshape(
-                    [
-                        -1,
-                        transpose_weight.shape[-2]
-                        * transpose_weight.shape[-1]
-                        // inc_group,
-                    ]
-                )
-                base_k = keep_k // reshape_weight.shape[0]
-                remain_k = keep_k % reshape_weight.shape[0]
-                k = base_k + 1 if remain_k > 0 else base_k
-                qualify_list = []
-                for one in reshape_weight:
-                    qualify_list.append(numpy.flatnonzero(one).size <= k)
-                return all(qualify_list)
-
-            transpose_weight = weight.transpose([0, 2, 1, 3])
-            if transpose_weight.shape[-2] % self._fpga_input_group == 0:
-                qualify = _check_block_sparsity_balance(
-                    transpose_weight, keep_k, self._fpga_input_group
+        mask = self._mask[name]
+        if self._criterion == "magnitude":
+            return entry.parameter * mask
+
+        # Shift the scores above zero keeping their order, the kept minimum gets the smallest positive value
+        score = self._score[name]
+        kept_min = score.masked_fill(~mask, float("inf")).min()
+        importance = score - kept_min + torch.finfo(score.dtype).tiny
+        return importance.masked_fill_(~mask, 0.)
+
+    def accumulate_scores(self):
+        """
+        Accumulate the movement scores '-w * grad' of the current gradients, to be called before
+        'optimizer.step()'. It is a no-op when moved into the optimizer step by 'bind_scores'.
+        """
+
+        if self._criterion != "movement" or self._scores_fused:
+            return
+
+        with torch.no_grad():
+            names = [name for name, entry in self._plan.items() if entry.parameter.grad is not None]
+            if names:
+                parameters = [self._plan[name].parameter for name in names]
+                torch._foreach_addcmul_(
+                    [self._score[name] for name in names], parameters,
+                    [parameter.grad for parameter in parameters], value=-1
                 )
+
+    def bind_scores(self, optimizer):
+        """
+        Move the accumulation of the movement scores into the step of an optimizer supporting it
+        (see 'MaskedStateMixin' in 'optimizer.py'), as a multi-tensor pass right before the update.
+        """
+
+        optimizer = getattr(optimizer, "optimizer", optimizer)
+        if self._criterion == "movement" and hasattr(optimizer, "set_param_scores"):
+            optimizer.set_param_scores({self._plan[name].parameter: score for name, score in self._score.items()})
+            self._scores_fused = True
+
+        return self._scores_fused
+
+    def _mask_grad(self, name, grad):
+        return grad * self._mask[name]
+
+    def bind_optimizer(self, optimizer):
+        """
+        Fuse the masks into training: gradients of the pruned entries are masked by hooks at backward,
+        and an optimizer supporting masks(see 'MaskedStateMixin' in 'optimizer.py') keeps states for
+        the kept entries only & never updates the pruned ones, so 'prune()' no longer multiplies the
+        masks at every step.
+        """
+
+        for handle in self._hooks:
+            handle.remove()
+        self._hooks = [
+            entry.parameter.register_hook(partial(self._mask_grad, name)) for name, entry in self._plan.items()
+        ]
+
+        # e.g. the optimizer wrapped by 'accelerate'
+        optimizer = getattr(optimizer, "optimizer", optimizer)
+        if hasattr(optimizer, "set_param_masks"):
+            optimizer.set_param_masks(self.param_masks())
+            self._fused = True
+
+        return self._fused
+
+    def param_masks(self, fixed=False):
+        """
+        Parameter -> its bool mask. With 'fixed', the masks must never change(the 'fix_sparsity' /
+        'fixed_mask' path), which is what consumers caching their layout rely on.
+        """
+
+        if fixed and not self._fix_sparsity:
+            raise RuntimeError("Masks are updated during pruning, use 'fix_sparsity' or 'fixed_mask' to fix them.")
+        return {entry.parameter: self._mask[name] for name, entry in self._plan.items()}
+
+    def _shards(self, world_size):
+        """
+        Split the plan into 'world_size' disjoint shards balanced by number of elements, the
+        largest parameters are assigned first to the least loaded rank. It only depends on the
+        plan, so every rank gets the same split.
+        """
+
+        shards, loads = [[] for _ in range(world_size)], [0] * world_size
+        for name in sorted(self._plan, key=lambda name: -self._plan[name].numel):
+            rank = loads.index(min(loads))
+            shards[rank].append(name)
+            loads[rank] += self._plan[name].numel
+
+        return shards
+
+    def _owned_shard(self):
+        """Names of the parameters whose masks are computed by this rank, None if not sharded."""
+
+        from utils.dist import is_dist_avail_and_initialized, get_rank, get_world_size
+
+        if not self._distributed or not is_dist_avail_and_initialized() or get_world_size() == 1:
+            return None
+        return set(self._shards(get_world_size())[get_rank()])
+
+    def _broadcast_masks(self):
+        """Every rank broadcasts the bit-packed masks of its shard, so all ranks end with the same masks."""
+
+        from utils.dist import get_rank, get_world_size, broadcast_coalesced
+
+        rank = get_rank()
+        for src, shard in enumerate(self._shards(get_world_size())):
+            if src == rank:
+                packed = [pack_mask(self._mask[name]) for name in shard]
             else:
-                temp1 = transpose_weight.shape[-2]
-                temp4 = (self._fpga_input_group - 1) * (
-                    temp1 // self._fpga_input_group + 1
-                )
-                keep_k_1 = int(temp4 / temp1 * keep_k)
-                keep_k_2 = keep_k - keep_k_1
-                transpose_weight_1 = transpose_weight[:, :, :temp4, :]
-                transpose_weight_2 = transpose_weight[:, :, temp4:, :]
-                qualify_1 = _check_block_sparsity_balance(
-                    transpose_weight_1, keep_k_1, self._fpga_input_group - 1
-                )
-                qualify_2 = _check_block_sparsity_balance(
-                    transpose_weight_2, keep_k_2, 1
-                )
-                qualify = all([qualify_1, qualify_2])
-            return qualify
+                packed = [
+                    torch.empty((self._plan[name].numel + 7) // 8, dtype=torch.uint8, device=self._mask[name].device)
+                    for name in shard
+                ]
+            broadcast_coalesced(packed, src)
 
-        def _check_weight_asic_4d(weight, keep_k):
-            def _check_block_sparsity_balance(transpose_weight, keep_k):
-                reshape_weight = transpose_weight.reshape(
-                    [-1, transpose_weight.shape[-1]]
-                )
-                base_k = keep_k // reshape_weight.shape[0]
-                remain_k = keep_k % reshape_weight.shape[0]
-                k = base_k + 1 if remain_k > 0 else base_k
-                qualify_list = []
-                for one in reshape_weight:
-                    qualify_list.append(numpy.flatnonzero(one).size <= k)
-                return all(qualify_list)
-
-            def _check_block_1x1(transpose_weight, keep_k):
-                temp1 = transpose_weight.shape[-1] // self._asic_input_gloup
-                temp2 = transpose_weight.shape[-1] % self._asic_input_gloup
-                for i in range(self._asic_input_gloup):
-                    locals()["list%s" % i] = []
-                for i in range(temp1):
-                    for j in range(
-                        i * self._asic_input_gloup, (i + 1) * self._asic_input_gloup
-                    ):
-                        locals()["list%s" % (j % self._asic_input_gloup)].append(j)
-                for i in range(
-                    temp1 * self._asic_input_gloup, transpose_weight.shape[-1]
-                ):
-                    locals()["list%s" % (i % self._asic_input_gloup)].append(i)
-                temp3 = []
-                for i in range(self._asic_input_gloup):
-                    temp3.append(
-                        int(
-                            len(locals()["list%s" % i])
-                            / transpose_weight.shape[-1]
-                            * keep_k
-                        )
-                    )
-                qualify_list = []
-                for i in range(self._asic_input_gloup):
-                    temp4 = numpy.concatenate(
-                        [
-                            transpose_weight[:, :, :, one : one + 1]
-                            for one in locals()["list%s" % i]
-                        ],
-                        3,
-                    )
-                    qualify_list.append(_check_block_sparsity_balance(temp4, temp3[i]))
-                return all(qualify_list)
-
-            transpose_weight = weight.transpose([0, 2, 3, 1])
-            if transpose_weight.shape[1] == 1 and transpose_weight.shape[2] == 1:
-                group_size = 512
-                temp1 = transpose_weight.shape[-1] // group_size
-                temp2 = transpose_weight.shape[-1] % group_size
-                keep_k_1 = int(keep_k * temp1 * group_size / transpose_weight.shape[-1])
-                keep_k_2 = keep_k - keep_k_1
-                if temp1 > 0:
-                    for i in range(temp1):
-                        transpose_weight_1 = transpose_weight[
-                            :, :, :, i * group_size : (i + 1) * group_size
-                        ]
-                        qualify_1 = _check_block_1x1(
-                            transpose_weight_1, keep_k_1 // temp1
-                        )
-                if temp2 > 0:
-                    transpose_weight_2 = transpose_weight[:, :, :, temp1 * group_size :]
-                    if transpose_weight_2.shape[-1] >= self._asic_input_gloup:
-                        qualify_2 = _check_block_1x1(transpose_weight_2, keep_k_2)
-                    else:
-                        pass
-                qualify_list = []
-                try:
-                    qualify_list.append(qualify_1)
-                except:
-                    pass
-                try:
-                    qualify_list.append(qualify_2)
-                except:
-                    pass
-                qualify = all(qualify_list)
+            if src != rank:
+                for name, one in zip(shard, packed):
+                    self._mask[name].copy_(unpack_mask(one, self._mask[name].shape))
+
+    def sparsity(self, from_mask=False):
+        """
+        Counts nonzeros of the pruned weights on their device with a single host sync.
+
+        Args:
+            from_mask: bool, count the kept entries of the masks instead of the weights, which
+                reuses the mask sums recorded at the last mask update.
+        Returns:
+            layer_sparse_rate: dict, parameter name -> sparsity.
+            total_sparse_rate: float, sparsity over all the pruned parameters.
+        """
+
+        if not self._plan:
+            return {}, 0.
+
+        with torch.no_grad():
+            if from_mask:
+                nonzero = [self._mask_nonzero(name) for name in self._plan]
             else:
-                group_size = self._group_size
-                temp1 = transpose_weight.shape[-1] // group_size
-                temp2 = transpose_weight.shape[-1] % group_size
-                keep_k_1 = int(keep_k * temp1 * group_size / transpose_weight.shape[-1])
-                keep_k_2 = keep_k - keep_k_1
-                if temp1 > 0:
-                    for i in range(temp1):
-                        transpose_weight_1 = transpose_weight[
-                            :, :, :, i * group_size : (i + 1) * group_size
-                        ]
-                        qualify_1 = _check_block_sparsity_balance(
-                            transpose_weight_1, keep_k_1 // temp1
-                        )
-                if temp2 > 0:
-                    transpose_weight_2 = transpose_weight[:, :, :, temp1 * group_size :]
-                    qualify_2 = _check_block_sparsity_balance(
-                        transpose_weight_2, keep_k_2
-                    )
-                qualify_list = []
-                try:
-                    qualify_list.append(qualify_1)
-                except:
-                    pass
-                try:
-                    qualify_list.append(qualify_2)
-                except:
-                    pass
-                qualify = all(qualify_list)
-            return qualify
-
-        def _check_weight_asic_2d(weight, keep_k):
-            def _check_block_sparsity_balance(transpose_weight, keep_k):
-                reshape_weight = transpose_weight
-                base_k = keep_k // reshape_weight.shape[0]
-                remain_k = keep_k % reshape_weight.shape[0]
-                k = base_k + 1 if remain_k > 0 else base_k
-                qualify_list = []
-                for one in reshape_weight:
-                    qualify_list.append(numpy.flatnonzero(one).size <= k)
-                return all(qualify_list)
-
-            def _check_block_1x1(transpose_weight, keep_k):
-                temp1 = transpose_weight.shape[-1] // self._asic_input_gloup
-                temp2 = transpose_weight.shape[-1] % self._asic_input_gloup
-                for i in range(self._asic_input_gloup):
-                    locals()["list%s" % i] = []
-                for i in range(temp1):
-                    for j in range(
-                        i * self._asic_input_gloup, (i + 1) * self._asic_input_gloup
-                    ):
-                        locals()["list%s" % (j % self._asic_input_gloup)].append(j)
-                for i in range(
-                    temp1 * self._asic_input_gloup, transpose_weight.shape[-1]
-                ):
-                    locals()["list%s" % (i % self._asic_input_gloup)].append(i)
-                temp3 = []
-                for i in range(self._asic_input_gloup):
-                    temp3.append(
-                        int(
-                            len(locals()["list%s" % i])
-                            / transpose_weight.shape[-1]
-                            * keep_k
-                        )
-                    )
-                qualify_list = []
-                for i in range(self._asic_input_gloup):
-                    temp4 = numpy.concatenate(
-                        [
-                            transpose_weight[:, one : one + 1]
-                            for one in locals()["list%s" % i]
-                        ],
-                        1,
+                nonzero = [entry.parameter.count_nonzero() for entry in self._plan.values()]
+            device = nonzero[0].device
+            nonzero = torch.stack([one.to(device) for one in nonzero]).tolist()
+
+        numel = [entry.numel for entry in self._plan.values()]
+        layer_sparse_rate = {
+            name: 1 - one / size for name, one, size in zip(self._plan, nonzero, numel)
+        }
+        total_sparse_rate = 1 - sum(nonzero) / sum(numel)
+        return layer_sparse_rate, total_sparse_rate
+
+    def _mask_nonzero(self, name):
+        nonzero = self._nonzero.get(name)
+        if nonzero is None:
+            nonzero = self._nonzero[name] = self._mask[name].count_nonzero()
+        return nonzero
+
+    def _budget_sparsity(self, name, current):
+        # Outside of the sparse steps the schedule has reached its target
+        in_sparse_step = self._pretrain_step < self._t <= self._pretrain_step + self._sparse_step
+        if current and not self._fix_sparsity and in_sparse_step:
+            return self._current_sparsity(name)
+        return self._prune_dict[name]
+
+    def verify(self, current=False, from_mask=False, strict=False):
+        """
+        Vectorized check that every pruned parameter respects its keep budget and the bank
+        constraints of the deploy device. Nonzeros of each (row, bank) are counted on the
+        parameter's device, all the layers are read back with a single host sync.
+
+        Args:
+            current: bool, check against the sparsity of the schedule at the current step
+                instead of the target sparsity, so that it can be called during gradual pruning.
+            from_mask: bool, check the masks instead of the weights.
+            strict: bool, raise 'RuntimeError' if any parameter fails the check.
+        Returns:
+            dict, parameter name -> {'qualify', 'nonzero', 'keep_k', 'violated_banks'}, where
+            'violated_banks' is the number of (row, bank) pairs over budget, or of the nonzero
+            tiles over budget for the tile deploy device.
+        """
+
+        keep_ks, stats = [], []
+        with torch.no_grad():
+            for name, entry in self._plan.items():
+                weight = self._mask[name] if from_mask else entry.parameter.data
+                keep_k = int(entry.numel * (1.0 - self._budget_sparsity(name, current)))
+                nonzero = weight.count_nonzero()
+
+                banks = self._banks(entry.kind, weight, keep_k)
+                if entry.kind == "tile":
+                    # Number of nonzero tiles over the tile budget
+                    rows, columns = weight.shape
+                    tiles = (weight != 0).reshape(
+                        rows // self._tile_size, self._tile_size, columns // self._tile_size, self._tile_size
                     )
-                    qualify_list.append(_check_block_sparsity_balance(temp4, temp3[i]))
-                return all(qualify_list)
-
-            transpose_weight = weight
-            group_size = 512
-            temp1 = transpose_weight.shape[-1] // group_size
-            temp2 = transpose_weight.shape[-1] % group_size
-            keep_k_1 = int(keep_k * temp1 * group_size / transpose_weight.shape[-1])
-            keep_k_2 = keep_k - keep_k_1
-            if temp1 > 0:
-                for i in range(temp1):
-                    transpose_weight_1 = transpose_weight[
-                        :, i * group_size : (i + 1) * group_size
-                    ]
-                    qualify_1 = _check_block_1x1(transpose_weight_1, keep_k_1 // temp1)
-            if temp2 > 0:
-                transpose_weight_2 = transpose_weight[:, temp1 * group_size :]
-                if transpose_weight_2.shape[-1] >= self._asic_input_gloup:
-                    qualify_2 = _check_block_1x1(transpose_weight_2, keep_k_2)
+                    nonzero_tiles = tiles.any(3).any(1).sum()
+                    violated = (nonzero_tiles - self._tile_keep(entry.numel, keep_k)).clamp(min=0)
+                elif banks is None:
+                    violated = (nonzero > keep_k).long()
                 else:
-                    pass
-            qualify_list = []
-            try:
-                qualify_list.append(qualify_1)
-            except:
-                pass
-            try:
-                qualify_list.append(qualify_2)
-            except:
-                pass
-            qualify = all(qualify_list)
-            return qualify
+                    matrix, index, bank_k, _ = banks
+                    bank_k = torch.as_tensor(bank_k, device=weight.device)
+                    violated = (_bank_nonzero(matrix, index) > bank_k).sum()
 
-        with torch.no_grad():
-            layer_sparse_qualify = {}
-            for name, parameter in self._model.named_parameters():
-                if any(name == one for one in self._prune_dict):
-                    weight = parameter.data.cpu().numpy()
-                    target_sparsity = self._prune_dict[name]
-                    keep_k = int(weight.size * (1.0 - target_sparsity))
-                    if self._deploy_device == "none":
-                        qualify = _check_weight(weight, keep_k)
-                    elif self._deploy_device == "fpga":
-                        if len(weight.shape) == 4:
-                            qualify = _check_weight_fpga(weight, keep_k)
-                        else:
-                            qualify = _check_weight(weight, keep_k)
-                    elif self._deploy_device == "asic":
-                        if len(weight.shape) == 4:
-                            qualify = _check_weight_asic_4d(weight, keep_k)
-                        elif len(weight.shape) == 2:
-                            qualify = _check_weight_asic_2d(weight, keep_k)
-                        else:
-                            qualify = _check_weight(weight, keep_k)
-                    layer_sparse_qualify[name] = qualify
+                keep_ks.append(keep_k)
+                stats.append(torch.stack([nonzero, violated]))
+
+            if stats:
+                device = stats[0].device
+                stats = torch.stack([one.to(device) for one in stats]).tolist()
+
+        report = {}
+        for name, keep_k, (nonzero, violated) in zip(self._plan, keep_ks, stats):
+            report[name] = {
+                'qualify': violated == 0,
+                'nonzero': nonzero,
+                'keep_k': keep_k,
+                'violated_banks': violated,
+            }
+
+        if strict:
+            failed = [name for name, one in report.items() if not one['qualify']]
+            if failed:
+                raise RuntimeError(
+                    f"{len(failed)} pruned parameter(s) violate the sparsity constraints of "
+                    f"deploy device '{self._deploy_device}': {failed}"
+                )
+
+        return report
+
+    def check(self):
+        report = self.verify()
+        layer_sparse_qualify = {name: one['qualify'] for name, one in report.items()}
         total_sparse_qualify = all(one for one in layer_sparse_qualify.values())
         return layer_sparse_qualify, total_sparse_qualify
 
+    def export_nm(self):
+        """
+        Compress the N:M pruned weights for a CPU sparse GEMM, see 'sparse.NMSparseLinear'.
+
+        Returns:
+            dict, parameter name -> {'values', 'metadata', 'n', 'm'}, where 'values' holds the
+            kept weights ordered by column & 'metadata' the uint8 position of each inside its group.
+        """
+
+        assert self._deploy_device == "nm", f"deploy device '{self._deploy_device}' is not N:M"
+
+        compressed = {}
+        with torch.no_grad():
+            for name, entry in self._plan.items():
+                weight = entry.parameter.data * self._mask[name]
+                values, metadata = compress_nm(weight, self._nm_n, self._nm_m)
+                compressed[name] = {
+                    'values': values.cpu(),
+                    'metadata': metadata.cpu(),
+                    'n': self._nm_n,
+                    'm': self._nm_m,
+                }
+
+        return compressed
+
 """
 (deberta): DebertaModel(
     (embeddings): DebertaEmbeddings(
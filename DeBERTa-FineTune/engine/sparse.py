@@ -0,0 +1,383 @@
+# --------------------------------------------------------
+# [Sparse] Compressed layouts & modules of pruned weights for CPU inference
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+import torch
+import torch.nn as nn
+
+
+def compress_nm(weight, n, m):
+    """
+    Compress a 2-D N:M sparse weight, i.e. at most 'n' nonzeros in every contiguous group
+    of 'm' input weights, into its values & metadata.
+
+    Returns:
+        values: (out_features, in_features // m * n) kept weights, ordered by column.
+        metadata: (out_features, in_features // m * n) uint8, position of each value inside its group.
+    """
+
+    out_features, in_features = weight.shape
+    assert in_features % m == 0, f"in_features {in_features} can not be divided by m {m}"
+
+    groups = weight.reshape(out_features, -1, m)
+    position = torch.topk(groups.abs(), n, dim=-1, sorted=False)[1].sort(dim=-1)[0]
+    values = groups.gather(-1, position)
+
+    return values.reshape(out_features, -1), position.reshape(out_features, -1).to(torch.uint8)
+
+
+def is_nm_sparse(weight, n, m):
+    """Whether a 2-D weight keeps at most 'n' nonzeros in every contiguous group of 'm' input weights."""
+
+    out_features, in_features = weight.shape
+    if in_features % m:
+        return False
+
+    return bool((weight.reshape(out_features, -1, m) != 0).sum(-1).max() <= n)
+
+
+def nm_columns(metadata, n, m):
+    """(out_features, in_features // m * n) input column of each value of the N:M layout."""
+
+    group = torch.arange(metadata.shape[1] // n, device=metadata.device).repeat_interleave(n)
+    return group.unsqueeze(0) * m + metadata.long()
+
+
+def decompress_nm(values, metadata, n, m):
+    """Inverse of 'compress_nm', returns the dense weight."""
+
+    out_features = values.shape[0]
+    weight = values.new_zeros(out_features, values.shape[1] // n * m)
+    return weight.scatter_(1, nm_columns(metadata, n, m), values)
+
+
+class NMSparseLinear(nn.Module):
+    """
+        Linear layer holding an N:M sparse weight in the values & metadata layout of 'compress_nm'.
+        Every output row has the same number of values, so the layout maps to CSR without any copy
+        of the values, which is what the forward multiplies with.
+    """
+
+    def __init__(self, values, metadata, n, m, bias=None):
+        super().__init__()
+
+        self.n = n
+        self.m = m
+        self.out_features = values.shape[0]
+        self.in_features = values.shape[1] // n * m
+
+        self.register_buffer('values', values)
+        self.register_buffer('metadata', metadata)
+        self.register_buffer('bias', bias)
+        self._csr = None
+
+    @classmethod
+    def from_dense(cls, linear, n, m):
+        values, metadata = compress_nm(linear.weight.data, n, m)
+        bias = linear.bias.data.clone() if linear.bias is not None else None
+
+        return cls(values, metadata, n, m, bias=bias)
+
+    def _apply(self, fn):
+        # The CSR weight shares the values, rebuild it once the buffers are moved/casted
+        self._csr = None
+        return super()._apply(fn)
+
+    @property
+    def weight(self):
+        """Dense weight, for the code paths which read 'weight' directly."""
+        return self.to_dense()
+
+    def weight_csr(self):
+        if self._csr is None:
+            nnz_per_row = self.values.shape[1]
+            crow = torch.arange(self.out_features + 1, device=self.values.device) * nnz_per_row
+            columns = nm_columns(self.metadata, self.n, self.m).reshape(-1)
+            self._csr = torch.sparse_csr_tensor(
+                crow, columns, self.values.reshape(-1), size=(self.out_features, self.in_features)
+            )
+
+        return self._csr
+
+    def to_dense(self):
+        return decompress_nm(self.values, self.metadata, self.n, self.m)
+
+    def forward(self, input):
+        shape = input.shape
+        output = torch.mm(self.weight_csr(), input.reshape(-1, self.in_features).t()).t()
+        if self.bias is not None:
+            output = output + self.bias
+
+        return output.reshape(*shape[:-1], self.out_features)
+
+    def extra_repr(self):
+        return f'in_features={self.in_features}, out_features={self.out_features}, ' \
+               f'n={self.n}, m={self.m}, bias={self.bias is not None}'
+
+
+class BlockSparseLinear(nn.Module):
+    """
+        Linear layer holding only the nonzero 'tile_size x tile_size' tiles of a tile pruned weight.
+        Inputs are gathered per kept tile and multiplied with one batched matmul, the partial outputs
+        are then summed into their tile rows, so the cost scales with the number of kept tiles.
+    """
+
+    def __init__(self, tiles, tile_rows, tile_columns, out_features, in_features, bias=None):
+        super().__init__()
+
+        self.tile_size = tiles.shape[-1]
+        self.out_features = out_features
+        self.in_features = in_features
+
+        # (tiles, tile_size, tile_size) values & the (row, column) position of each tile
+        self.register_buffer('tiles', tiles)
+        self.register_buffer('tile_rows', tile_rows)
+        self.register_buffer('tile_columns', tile_columns)
+        self.register_buffer('bias', bias)
+
+    @classmethod
+    def from_dense(cls, linear, tile_size):
+        weight = linear.weight.data
+        out_features, in_features = weight.shape
+        assert out_features % tile_size == 0 and in_features % tile_size == 0, \
+            f"weight {tuple(weight.shape)} can not be tiled by {tile_size}"
+
+        tiles = weight.reshape(out_features // tile_size, tile_size, in_features // tile_size, tile_size)
+        tiles = tiles.permute(0, 2, 1, 3)
+        tile_rows, tile_columns = (tiles != 0).any(-1).any(-1).nonzero(as_tuple=True)
+        bias = linear.bias.data.clone() if linear.bias is not None else None
+
+        return cls(
+            tiles[tile_rows, tile_columns].contiguous(), tile_rows, tile_columns,
+            out_features, in_features, bias=bias
+        )
+
+    @property
+    def density(self):
+        return self.tiles.shape[0] * self.tile_size ** 2 / (self.out_features * self.in_features)
+
+    @property
+    def weight(self):
+        """Dense weight, for the code paths which read 'weight' directly."""
+        return self.to_dense()
+
+    def to_dense(self):
+        tile_size = self.tile_size
+        weight = self.tiles.new_zeros(self.out_features // tile_size, self.in_features // tile_size, tile_size, tile_size)
+        weight[self.tile_rows, self.tile_columns] = self.tiles
+
+        return weight.permute(0, 2, 1, 3).reshape(self.out_features, self.in_features)
+
+    def forward(self, input):
+        shape = input.shape
+        tile_size = self.tile_size
+
+        # (in tiles, tile_size, tokens) -> (kept tiles, tile_size, tokens)
+        input = input.reshape(-1, self.in_features).t().reshape(-1, tile_size, shape[:-1].numel())
+        partial = torch.bmm(self.tiles, input[self.tile_columns])
+        output = partial.new_zeros(self.out_features // tile_size, tile_size, partial.shape[-1])
+        output.index_add_(0, self.tile_rows, partial)
+
+        output = output.reshape(self.out_features, -1).t()
+        if self.bias is not None:
+            output = output + self.bias
+
+        return output.reshape(*shape[:-1], self.out_features)
+
+    def extra_repr(self):
+        return f'in_features={self.in_features}, out_features={self.out_features}, ' \
+               f'tile_size={self.tile_size}, density={self.density:.4f}, bias={self.bias is not None}'
+
+
+class SparseLinear(nn.Module):
+    """
+        Linear layer holding an unstructured sparse weight in CSR or COO layout, the forward is a
+        sparse x dense matmul. Indices are kept in int32 to halve their size.
+    """
+
+    LAYOUTS = ('csr', 'coo')
+
+    def __init__(self, row_indices, col_indices, values, out_features, in_features, layout='csr', bias=None):
+        super().__init__()
+
+        assert layout in self.LAYOUTS, f"layout '{layout}' is not one of {self.LAYOUTS}"
+
+        self.layout = layout
+        self.out_features = out_features
+        self.in_features = in_features
+
+        # CSR: compressed row offsets, COO: row of each value
+        self.register_buffer('row_indices', row_indices)
+        self.register_buffer('col_indices', col_indices)
+        self.register_buffer('values', values)
+        self.register_buffer('bias', bias)
+        self._sparse = None
+
+    @classmethod
+    def from_dense(cls, linear, layout='csr'):
+        weight = linear.weight.data
+        out_features, in_features = weight.shape
+        if layout == 'csr':
+            sparse = weight.to_sparse_csr()
+            row_indices, col_indices = sparse.crow_indices(), sparse.col_indices()
+        else:
+            sparse = weight.to_sparse().coalesce()
+            row_indices, col_indices = sparse.indices()
+        bias = linear.bias.data.clone() if linear.bias is not None else None
+
+        return cls(
+            row_indices.int(), col_indices.int(), sparse.values().clone(),
+            out_features, in_features, layout=layout, bias=bias
+        )
+
+    def _apply(self, fn):
+        # The sparse weight shares the buffers, rebuild it once they are moved/casted
+        self._sparse = None
+        return super()._apply(fn)
+
+    @property
+    def density(self):
+        return self.values.numel() / (self.out_features * self.in_features)
+
+    @property
+    def weight(self):
+        """Dense weight, for the code paths which read 'weight' directly."""
+        return self.to_dense()
+
+    def weight_sparse(self):
+        if self._sparse is None:
+            size = (self.out_features, self.in_features)
+            if self.layout == 'csr':
+                self._sparse = torch.sparse_csr_tensor(self.row_indices, self.col_indices, self.values, size=size)
+            else:
+                indices = torch.stack([self.row_indices, self.col_indices]).long()
+                self._sparse = torch.sparse_coo_tensor(indices, self.values, size=size).coalesce()
+
+        return self._sparse
+
+    def to_dense(self):
+        return self.weight_sparse().to_dense()
+
+    def forward(self, input):
+        shape = input.shape
+        input = input.reshape(-1, self.in_features).t()
+        if self.layout == 'csr':
+            output = torch.mm(self.weight_sparse(), input)
+        else:
+            output = torch.sparse.mm(self.weight_sparse(), input)
+        output = output.t()
+        if self.bias is not None:
+            output = output + self.bias
+
+        return output.reshape(*shape[:-1], self.out_features)
+
+    def extra_repr(self):
+        return f'in_features={self.in_features}, out_features={self.out_features}, ' \
+               f'layout={self.layout}, density={self.density:.4f}, bias={self.bias is not None}'
+
+
+def _set_module(model, name, module):
+    parent, _, child = name.rpartition('.')
+    setattr(model.get_submodule(parent) if parent else model, child, module)
+
+
+def sparsify_model(model, min_sparsity=0.5, layout='csr', names=None, nm=(2, 4)):
+    """
+    Replace the pruned 'nn.Linear' layers of a model with 'SparseLinear' in place, or with
+    'NMSparseLinear' for the 'nm' layout.
+
+    Args:
+        min_sparsity: float, only the layers of a weight sparsity no less than it are replaced,
+            below it a dense matmul is faster.
+        layout: 'csr', 'coo' or 'nm'. With 'nm' only the layers which are N:M sparse are replaced,
+            since compressing any other one would drop some of its weights.
+        names: list of module names to replace regardless of their sparsity, e.g. the ones pruned.
+        nm: (n, m) of the 'nm' layout.
+    Returns:
+        list of the replaced module names.
+    """
+
+    n, m = nm
+    replaced = []
+    for name, module in list(model.named_modules()):
+        if not isinstance(module, nn.Linear):
+            continue
+        if names is not None:
+            if name not in names:
+                continue
+        elif 1. - module.weight.count_nonzero().item() / module.weight.numel() < min_sparsity:
+            continue
+
+        if layout == 'nm':
+            if not is_nm_sparse(module.weight.data, n, m):
+                if names is not None:
+                    raise ValueError(f"'{name}' is not {n}:{m} sparse")
+                continue
+            _set_module(model, name, NMSparseLinear.from_dense(module, n, m))
+        else:
+            _set_module(model, name, SparseLinear.from_dense(module, layout=layout))
+        replaced.append(name)
+
+    return replaced
+
+
+def save_sparse_model(model, model_config, path):
+    """
+    Save a model sparsified by 'sparsify_model' with its config, the state dict only holds the
+    sparse buffers for the replaced layers.
+    """
+
+    sparse_modules = {}
+    for name, module in model.named_modules():
+        if isinstance(module, SparseLinear):
+            sparse_modules[name] = {
+                'layout': module.layout, 'out_features': module.out_features, 'in_features': module.in_features
+            }
+        elif isinstance(module, NMSparseLinear):
+            sparse_modules[name] = {
+                'layout': 'nm', 'n': module.n, 'm': module.m,
+                'out_features': module.out_features, 'in_features': module.in_features
+            }
+    torch.save({
+        'model': model.state_dict(),
+        'model_config': model_config,
+        'model_class': model.__class__.__name__,
+        'sparse_modules': sparse_modules,
+    }, path)
+
+    return path
+
+
+def load_sparse_model(path, model_cls, config_cls):
+    """
+    Build the model saved by 'save_sparse_model' for inference.
+
+    Args:
+        model_cls: class of the model, e.g. 'DebertaForSequenceClassification'.
+        config_cls: class of its config, built by 'config_cls.from_dict'.
+    """
+
+    artifact = torch.load(path, map_location='cpu')
+    assert artifact['model_class'] == model_cls.__name__, \
+        f"artifact holds '{artifact['model_class']}' rather than '{model_cls.__name__}'"
+
+    model = model_cls(config_cls.from_dict(artifact['model_config']))
+    state_dict = artifact['model']
+    for name, meta in artifact['sparse_modules'].items():
+        # Built from the saved buffers, whose shapes depend on the number of nonzeros
+        if meta['layout'] == 'nm':
+            module = NMSparseLinear(
+                state_dict[f'{name}.values'], state_dict[f'{name}.metadata'], meta['n'], meta['m'],
+                bias=state_dict.get(f'{name}.bias')
+            )
+        else:
+            module = SparseLinear(
+                state_dict[f'{name}.row_indices'], state_dict[f'{name}.col_indices'], state_dict[f'{name}.values'],
+                meta['out_features'], meta['in_features'], layout=meta['layout'], bias=state_dict.get(f'{name}.bias')
+            )
+        _set_module(model, name, module)
+    model.load_state_dict(state_dict)
+
+    return model.eval()
@@ -0,0 +1,300 @@
+# --------------------------------------------------------
+# [Sparsity Plan] Latency-aware per-layer sparsity allocation for Prune
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+"""
+    Allocate a target sparsity to every prune target under a global latency budget:
+        i.   profile the latency of each target weight shape at a grid of sparsities on the deploy backend,
+             i.e. 'csr'('SparseLinear') or 'tile'('BlockSparseLinear') on CPU, the dense layer is used
+             wherever it is faster;
+        ii.  score the cost of pruning each weight to each sparsity by the magnitude(or Fisher) scores
+             of the entries removed;
+        iii. greedily raise the sparsity with the best latency saved per cost until the budget is met.
+    The plan is saved as a JSON file, its 'prune_dict' is loaded by 'run_glue.py' with 'PRUNE.PLAN'.
+    Fisher scores need labeled data: from the command line, a few batches of a classification CSV or
+    JSON lines file with the columns 'sentence1', 'sentence2'(optional) & 'label'(see 'load_batches'),
+    other tasks pass their own batches to 'build_plan'.
+
+    Run this script like:
+
+    python sparsity_plan.py --checkpoint best.pth --backend csr --budget 0.4 --output plan.json
+    python sparsity_plan.py --checkpoint best.pth --score fisher --data train.csv --num_batches 16 --output plan.json
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+
+BASE_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(BASE_DIR, '..'))
+
+from pruner import Prune
+from sparse import SparseLinear, BlockSparseLinear
+
+
+SPARSITY_GRID = [0., 0.5, 0.75, 0.875, 0.9375, 0.96875]
+
+
+def prune_targets(model):
+    """Names of the prune targets of a DeBERTa, the same as 'run_glue.py'."""
+
+    return [
+        name for name, _ in model.named_parameters()
+        if name.endswith(('attention.self.in_proj.weight', 'attention.output.dense.weight',
+                          'intermediate.dense.weight', 'output.dense.weight'))
+    ]
+
+
+def _time_forward(module, input, repeat):
+    with torch.no_grad():
+        module(input)
+        start = time.time()
+        for _ in range(repeat):
+            module(input)
+
+    return (time.time() - start) / repeat
+
+
+def profile_latency(shape, grid=SPARSITY_GRID, backend='csr', tokens=1024, tile_size=32, repeat=5):
+    """
+    Latency(seconds) of a Linear layer of weight 'shape' at each sparsity of 'grid', which is
+    the faster one of the dense layer & the sparse layer of the backend.
+    """
+
+    out_features, in_features = shape
+    input = torch.randn(tokens, in_features)
+    linear = nn.Linear(in_features, out_features)
+    dense_time = _time_forward(linear, input, repeat)
+
+    latency = []
+    for sparsity in grid:
+        if sparsity == 0.:
+            latency.append(dense_time)
+            continue
+
+        layer = nn.Linear(in_features, out_features)
+        # A single sparse step reaches the target sparsity at the first 'prune()'
+        Prune(
+            layer, pretrain_step=0, sparse_step=1, frequency=1, prune_dict={'weight': sparsity},
+            deploy_device='tile' if backend == 'tile' else 'none', tile_size=tile_size
+        ).prune()
+        if backend == 'tile':
+            sparse = BlockSparseLinear.from_dense(layer, tile_size)
+        else:
+            sparse = SparseLinear.from_dense(layer, layout='csr')
+        latency.append(min(dense_time, _time_forward(sparse, input, repeat)))
+
+    return latency
+
+
+def magnitude_scores(model, names):
+    parameters = dict(model.named_parameters())
+    return {name: parameters[name].detach().abs() for name in names}
+
+
+def fisher_scores(model, batches, names):
+    """
+    Empirical Fisher scores (weight x gradient)^2 accumulated over 'batches', each batch is the
+    keyword inputs of the model including the labels, so that the model returns its loss first.
+    """
+
+    parameters = dict(model.named_parameters())
+    scores = {name: torch.zeros_like(parameters[name]) for name in names}
+    model.eval()
+    for batch in batches:
+        model.zero_grad()
+        loss = model(**batch)[0]
+        loss.backward()
+        with torch.no_grad():
+            for name in names:
+                scores[name] += (parameters[name] * parameters[name].grad) ** 2
+    model.zero_grad()
+
+    return scores
+
+
+def load_batches(path, tokenizer, batch_size=8, num_batches=16, max_length=128):
+    """
+    The first 'num_batches' batches of a classification CSV or JSON lines file, each is the keyword
+    inputs of the model with the labels, as taken by 'fisher_scores'.
+    """
+
+    with open(path) as f:
+        if path.endswith('.csv'):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    rows = rows[:batch_size * num_batches]
+
+    batches = []
+    for start in range(0, len(rows), batch_size):
+        chunk = rows[start:start + batch_size]
+        texts = [[row['sentence1'] for row in chunk]]
+        if chunk[0].get('sentence2') is not None:
+            texts.append([row['sentence2'] for row in chunk])
+        batch = dict(tokenizer(*texts, padding=True, truncation=True, max_length=max_length, return_tensors='pt'))
+        batch['labels'] = torch.tensor([int(row['label']) for row in chunk])
+        batches.append(batch)
+
+    return batches
+
+
+def pruning_costs(scores, grid=SPARSITY_GRID):
+    """Cost of pruning each weight to each sparsity: the sum of its smallest scores removed, over all the scores."""
+
+    total = sum(score.sum().item() for score in scores.values()) or 1.
+    costs = {}
+    for name, score in scores.items():
+        cumsum = score.reshape(-1).float().sort()[0].cumsum(0)
+        num_pruned = [int(cumsum.numel() * sparsity) for sparsity in grid]
+        costs[name] = [cumsum[k - 1].item() / total if k else 0. for k in num_pruned]
+
+    return costs
+
+
+def allocate(latency, costs, budget, grid=SPARSITY_GRID):
+    """
+    Greedy allocation: start dense and repeatedly move one weight to a higher sparsity of the grid,
+    the one which saves the most latency per cost, until the total latency is within 'budget'.
+
+    Args:
+        latency: dict, name -> latency at each sparsity of the grid.
+        costs: dict, name -> pruning cost at each sparsity of the grid.
+        budget: float, total latency budget(seconds).
+    Returns:
+        dict, name -> sparsity.
+    """
+
+    level = {name: 0 for name in latency}
+    total = sum(one[0] for one in latency.values())
+    while total > budget:
+        best, best_ratio = None, None
+        for name, i in level.items():
+            for j in range(i + 1, len(grid)):
+                saved = latency[name][i] - latency[name][j]
+                if saved <= 0:
+                    continue
+                ratio = saved / (costs[name][j] - costs[name][i] + 1e-12)
+                if best_ratio is None or ratio > best_ratio:
+                    best, best_ratio = (name, j), ratio
+        if best is None:
+            print(f"=> latency budget {budget * 1000:.2f}ms can not be met, stopped at {total * 1000:.2f}ms")
+            break
+
+        name, j = best
+        total -= latency[name][level[name]] - latency[name][j]
+        level[name] = j
+
+    return {name: grid[i] for name, i in level.items()}
+
+
+def build_plan(model, budget, backend='csr', score='magnitude', batches=None, grid=SPARSITY_GRID,
+               tokens=1024, tile_size=32, repeat=5):
+    """
+    Returns the plan, a dict with 'prune_dict'(name -> target sparsity) & the profiled latency.
+    'budget' is the ratio of the dense latency of all the prune targets.
+    """
+
+    names = prune_targets(model)
+    parameters = dict(model.named_parameters())
+
+    # Weights of the same shape share their profile
+    profiles = {}
+    for name in names:
+        shape = tuple(parameters[name].shape)
+        if shape not in profiles:
+            profiles[shape] = profile_latency(shape, grid, backend, tokens, tile_size, repeat)
+    latency = {name: profiles[tuple(parameters[name].shape)] for name in names}
+
+    scores = fisher_scores(model, batches, names) if score == 'fisher' else magnitude_scores(model, names)
+    costs = pruning_costs(scores, grid)
+
+    dense_latency = sum(one[0] for one in latency.values())
+    prune_dict = allocate(latency, costs, budget * dense_latency, grid)
+    planned_latency = sum(latency[name][grid.index(sparsity)] for name, sparsity in prune_dict.items())
+
+    return {
+        'backend': backend,
+        'score': score,
+        'budget': budget,
+        'tokens': tokens,
+        'dense_latency': dense_latency,
+        'planned_latency': planned_latency,
+        'latency': {'x'.join(map(str, shape)): one for shape, one in profiles.items()},
+        'grid': grid,
+        'prune_dict': prune_dict,
+    }
+
+
+def save_plan(plan, path):
+    with open(path, 'w') as f:
+        json.dump(plan, f, indent=2)
+
+    return path
+
+
+def load_plan(path):
+    """Returns the 'prune_dict' of a plan file."""
+
+    with open(path) as f:
+        return json.load(f)['prune_dict']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Latency-aware per-layer sparsity allocation")
+    parser.add_argument('--checkpoint', type=str, required=True, help="'.pth' file or 'save_pretrained' directory")
+    parser.add_argument('--task', type=str, default='cls', choices=['cls', 'qa'])
+    parser.add_argument('--backend', type=str, default='csr', choices=['csr', 'tile'])
+    parser.add_argument('--budget', type=float, default=0.4, help='ratio of the dense latency of the prune targets')
+    parser.add_argument('--tokens', type=int, default=1024, help='tokens per forward when profiling')
+    parser.add_argument('--tile_size', type=int, default=32)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--score', type=str, default='magnitude', choices=['magnitude', 'fisher'])
+    parser.add_argument('--data', type=str, help="CSV or JSON lines file of labeled examples for '--score fisher'")
+    parser.add_argument('--tokenizer', type=str, default='microsoft/deberta-large')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_batches', type=int, default=16)
+    parser.add_argument('--max_length', type=int, default=128)
+    parser.add_argument('--output', type=str, default='plan.json')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.score == 'fisher' and (args.data is None or args.task != 'cls'):
+        raise ValueError("'--score fisher' needs '--data' & is only supported for the 'cls' task from the command line")
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    from export_sparse import MODEL_CLASSES, load_pruned_checkpoint
+    from models.configuration_deberta import DebertaConfig
+
+    state_dict, model_config = load_pruned_checkpoint(args.checkpoint)
+    model = MODEL_CLASSES[args.task](DebertaConfig.from_dict(model_config))
+    model.load_state_dict(state_dict)
+
+    batches = None
+    if args.score == 'fisher':
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+        batches = load_batches(args.data, tokenizer, args.batch_size, args.num_batches, args.max_length)
+
+    plan = build_plan(model, args.budget, backend=args.backend, score=args.score, batches=batches,
+                      tokens=args.tokens, tile_size=args.tile_size, repeat=args.repeat)
+    save_plan(plan, args.output)
+
+    sparsity = list(plan['prune_dict'].values())
+    print(f"=> latency of the prune targets: {plan['dense_latency'] * 1000:.2f}ms -> "
+          f"{plan['planned_latency'] * 1000:.2f}ms, mean sparsity {sum(sparsity) / len(sparsity):.4f}")
+    print(f"=> plan saved to '{args.output}'")
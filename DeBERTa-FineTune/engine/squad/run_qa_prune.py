@@ -258,12 +258,19 @@ def parse_args():
     # parser.add_argument('--early_stop_metric', type=str, default='acc', help='Early stop metric')
     parser.add_argument('--fixed_mask', default=None, type=str, help="Fixed mask path.")
     parser.add_argument('--mask', default=None, type=str, help="mask path")
+    parser.add_argument('--resume_pruner', default=None, type=str,
+                        help="pruner state saved in 'output_dir' by a previous run, pruning resumes at its step")
     # parser.add_argument('--sparse_mnli_init', default=None, type=str, help="MNLI weight initialization.")
     parser.add_argument('--pruning_sparsity',type=float, default=0.875, help='sparsity')
     parser.add_argument("--current_step", default=0, type=int, help="current step.")
     parser.add_argument("--start_epoch", default=0, type=int, help="current step.")
-    parser.add_argument('--deploy_device',type=str, default='none', help='also known as balance. options none, fix=asic, fpga')
+    parser.add_argument('--deploy_device',type=str, default='none', help='also known as balance. options none, fix=asic, fpga, nm, tile')
     parser.add_argument('--group_size',type=int, default=64, help='also known as bank_size')
+    parser.add_argument('--nm', type=int, nargs=2, default=[2, 4], help="N M of the 'nm' deploy device")
+    parser.add_argument('--tile_size', type=int, default=32, help="tile size of the 'tile' deploy device")
+    parser.add_argument('--criterion', type=str, default='magnitude', choices=['magnitude', 'movement'],
+                        help='rank the weights by magnitude or by accumulated movement scores')
+    parser.add_argument('--mask_history', type=str, default=None, help='append-only mask history file of the mask updates')
     parser.add_argument('--pruning_frequency',type=int, default=800, help='also known as bank_size')
     parser.add_argument('--pruning_epochs',type=int, default=0, help='pruning epochs')
     parser.add_argument('--local_rank',type=int, default=0, help='rank')
@@ -807,8 +814,15 @@ def main():
             deploy_device=args.deploy_device,
             group_size=args.group_size,
             fixed_mask=args.fixed_mask,
-            mask=args.mask
+            mask=args.mask,
+            nm=tuple(args.nm),
+            tile_size=args.tile_size,
+            criterion=args.criterion,
+            history=args.mask_history if accelerator.is_main_process else None
         )
+        if args.resume_pruner:
+            pruner.load_state_dict(torch.load(args.resume_pruner, map_location='cpu'))
+            logger.info(f"=> Resume pruning from step{pruner._t} of '{args.resume_pruner}'")
 
     # Train!
     total_batch_size = args.per_device_train_batch_size * accelerator.num_processes * args.gradient_accumulation_steps
@@ -890,6 +904,8 @@ def main():
 
             accelerator.backward(loss)
             if step % args.gradient_accumulation_steps == 0 or step == len(train_dataloader) - 1:
+                if pruner:
+                    pruner.accumulate_scores()
                 optimizer.step()
                 lr_scheduler.step()
                 optimizer.zero_grad()
@@ -927,6 +943,12 @@ def main():
             if completed_steps >= args.max_train_steps:
                 break
 
+        if pruner and args.output_dir is not None:
+            accelerator.wait_for_everyone()
+            if accelerator.is_main_process:
+                # Step, schedule & bit-packed masks, loaded by '--resume_pruner'
+                accelerator.save(pruner.state_dict(), os.path.join(args.output_dir, 'pruner.pth'))
+
         if args.push_to_hub and epoch < args.num_train_epochs - 1:
             accelerator.wait_for_everyone()
             unwrapped_model = accelerator.unwrap_model(model)
@@ -0,0 +1,125 @@
+# --------------------------------------------------------
+# [Structured] Physically shrink attention heads & FFN neurons of DeBERTa
+# Copyright (c) 2021 Moffett.AI
+# Licensed under Moffett.AI
+# --------------------------------------------------------
+
+"""
+    Score every attention head & FFN neuron by the magnitude of its weights, then remove the lowest
+    scored ones of each layer with 'prune_heads' & 'prune_neurons', so that the matrices get smaller.
+    Heads & neurons whose weights are all zero(e.g. after 'Prune') are always removed.
+    The shrunk model is saved with its config, whose 'pruned_heads' & 'intermediate_sizes' rebuild
+    the same shapes on reload with 'models.modeling_deberta'.
+
+    Run this script like:
+
+    python structured.py --checkpoint best.pth --task cls --head_sparsity 0.25 --neuron_sparsity 0.5 --output shrunk.pth
+"""
+
+import os
+import sys
+import math
+import argparse
+
+import torch
+
+BASE_DIR = os.path.dirname(__file__)
+sys.path.append(os.path.join(BASE_DIR, '..'))
+
+from export_sparse import MODEL_CLASSES, load_pruned_checkpoint
+from models.configuration_deberta import DebertaConfig
+
+
+def head_scores(attention):
+    """(num_heads,) L1 norm of the weights of each head over 'in_proj'(q,k,v) & 'output.dense'."""
+
+    self_attention = attention.self
+    num_heads, head_size = self_attention.num_attention_heads, self_attention.attention_head_size
+
+    # in_proj 的输出按头部排列，每个头部依次是 q,k,v
+    score = self_attention.in_proj.weight.abs().view(num_heads, 3 * head_size, -1).sum((1, 2))
+    score = score + attention.output.dense.weight.abs().view(-1, num_heads, head_size).sum((0, 2))
+
+    return score
+
+
+def neuron_scores(layer):
+    """(intermediate_size,) L1 norm of the weights of each FFN neuron over both FFN matrices."""
+
+    return layer.intermediate.dense.weight.abs().sum(1) + layer.output.dense.weight.abs().sum(0)
+
+
+def _lowest(score, sparsity):
+    """Index of the 'sparsity' lowest scores plus the zero ones, at least one entry is kept."""
+
+    num_pruned = min(max(math.floor(score.numel() * sparsity), int((score == 0).sum())), score.numel() - 1)
+    return sorted(torch.topk(score, num_pruned, largest=False)[1].tolist())
+
+
+def select_structures(model, head_sparsity=0., neuron_sparsity=0.):
+    """
+    Returns:
+        heads_to_prune: dict, layer -> original indices of the heads to prune.
+        neurons_to_prune: dict, layer -> indices of the FFN neurons to prune.
+    """
+
+    heads_to_prune, neurons_to_prune = {}, {}
+    with torch.no_grad():
+        for i, layer in enumerate(model.base_model.encoder.layer):
+            pruned_heads = sorted(layer.attention.self.pruned_heads)
+            # Current head positions -> original head indices
+            original_heads = [h for h in range(len(pruned_heads) + layer.attention.self.num_attention_heads)
+                              if h not in pruned_heads]
+            heads = [original_heads[h] for h in _lowest(head_scores(layer.attention), head_sparsity)]
+            neurons = _lowest(neuron_scores(layer), neuron_sparsity)
+            if heads:
+                heads_to_prune[i] = heads
+            if neurons:
+                neurons_to_prune[i] = neurons
+
+    return heads_to_prune, neurons_to_prune
+
+
+def shrink_model(model, head_sparsity=0., neuron_sparsity=0.):
+    """Remove the selected heads & neurons from the model in place, the config is updated along."""
+
+    heads_to_prune, neurons_to_prune = select_structures(model, head_sparsity, neuron_sparsity)
+    if heads_to_prune:
+        model.prune_heads(heads_to_prune)
+    if neurons_to_prune:
+        model.prune_neurons(neurons_to_prune)
+
+    return heads_to_prune, neurons_to_prune
+
+
+def count_parameters(model):
+    return sum(parameter.numel() for parameter in model.parameters())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Shrink attention heads & FFN neurons of a DeBERTa checkpoint")
+    parser.add_argument('--checkpoint', type=str, required=True, help="'.pth' file or 'save_pretrained' directory")
+    parser.add_argument('--task', type=str, default='cls', choices=list(MODEL_CLASSES.keys()))
+    parser.add_argument('--head_sparsity', type=float, default=0., help='ratio of heads removed per layer')
+    parser.add_argument('--neuron_sparsity', type=float, default=0., help='ratio of FFN neurons removed per layer')
+    parser.add_argument('--output', type=str, required=True, help='shrunk checkpoint path')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    state_dict, model_config = load_pruned_checkpoint(args.checkpoint)
+    model = MODEL_CLASSES[args.task](DebertaConfig.from_dict(model_config))
+    model.load_state_dict(state_dict)
+
+    num_parameters = count_parameters(model)
+    heads_to_prune, neurons_to_prune = shrink_model(model, args.head_sparsity, args.neuron_sparsity)
+    print(f"=> {sum(len(heads) for heads in heads_to_prune.values())} heads & "
+          f"{sum(len(neurons) for neurons in neurons_to_prune.values())} FFN neurons removed")
+    print(f"=> parameters: {num_parameters / 1e6:.1f}M -> {count_parameters(model) / 1e6:.1f}M")
+
+    # Same layout as 'save_checkpoint', so that it can be exported by 'export_sparse.py'
+    torch.save({'model': model.state_dict(), 'model_config': model.config.to_dict()}, args.output)
+    print(f"=> shrunk checkpoint saved to '{args.output}'")
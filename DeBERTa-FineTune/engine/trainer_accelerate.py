@@ -77,6 +77,9 @@ class Trainer:
 
             # Update parameters, lr, zero gradients, pruning(optional)
             if not (step + 1) % config.TRAIN.GRADIENT_ACCUMULATION_STEPS or step == len(dataloader) - 1:
+                if pruner is not None:
+                    # Movement scores of this step, a no-op if they are accumulated by the optimizer
+                    pruner.accumulate_scores()
                 optimizer.step()
                 lr_scheduler.step()
                 optimizer.zero_grad()
@@ -97,6 +100,9 @@ class Trainer:
                         layer_sparse_rate, total_sparse_rate = pruner.sparsity()
                         logger.info(f'\nweight sparsity: {total_sparse_rate}\n'
                                     f'layer weight sparsity:\n{layer_sparse_rate}\n')
+                        # Fail fast once the weights break the constraints of the deploy device
+                        if config.PRUNE.CHECK:
+                            pruner.verify(current=True, strict=True)
                     
                     # pruner.prune()
             
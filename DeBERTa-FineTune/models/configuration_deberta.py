@@ -148,6 +148,16 @@ class DebertaConfig(PretrainedConfig):
             :obj:`["p2c"]`, :obj:`["p2c", "c2p"]`, :obj:`["p2c", "c2p", 'p2p"]`.
         layer_norm_eps (:obj:`float`, optional, defaults to 1e-12):
             The epsilon used by the layer normalization layers.
+        intermediate_sizes (:obj:`List[int]`, `optional`):
+            The intermediate size of each layer after its FFN neurons are pruned, see
+            :meth:`~DebertaPreTrainedModel.prune_neurons`. All layers use :obj:`intermediate_size` if not set.
+        relative_shift (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Whether to get the c2p & p2c scores by relative shifting(pad, reshape & slice) instead of gathering
+            them by index, when the query & key have the same length and the default relative positions.
+        attention_backend (:obj:`str`, `optional`, defaults to :obj:`"eager"`):
+            The attention kernel, :obj:`"eager"` or :obj:`"sdpa"`. :obj:`"sdpa"` runs the attention through
+            :func:`torch.nn.functional.scaled_dot_product_attention` with the c2p & p2c scores as an additive bias,
+            it falls back to :obj:`"eager"` when the attention matrix is output, with talking heads or when tracing.
     """
     model_type = "deberta"
 
@@ -172,6 +182,9 @@ class DebertaConfig(PretrainedConfig):
         pos_att_type=None,
         pooler_dropout=0,
         pooler_hidden_act="gelu",
+        intermediate_sizes=None,
+        relative_shift=False,
+        attention_backend="eager",
         **kwargs
     ):
         super().__init__(**kwargs)
@@ -180,6 +193,7 @@ class DebertaConfig(PretrainedConfig):
         self.num_hidden_layers = num_hidden_layers
         self.num_attention_heads = num_attention_heads
         self.intermediate_size = intermediate_size
+        self.intermediate_sizes = intermediate_sizes
         self.hidden_act = hidden_act
         self.hidden_dropout_prob = hidden_dropout_prob
         self.attention_probs_dropout_prob = attention_probs_dropout_prob
@@ -190,6 +204,10 @@ class DebertaConfig(PretrainedConfig):
         self.max_relative_positions = max_relative_positions
         self.pad_token_id = pad_token_id
         self.position_biased_input = position_biased_input
+        self.relative_shift = relative_shift
+        if attention_backend not in ("eager", "sdpa"):
+            raise ValueError(f"attention_backend must be 'eager' or 'sdpa', got '{attention_backend}'")
+        self.attention_backend = attention_backend
 
         # Backwards compatibility
         if type(pos_att_type) == str:
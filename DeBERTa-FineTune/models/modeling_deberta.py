@@ -18,6 +18,7 @@
 import math
 import torch
 
+from functools import lru_cache
 from collections.abc import Sequence
 
 from torch import _softmax_backward_data, nn
@@ -51,6 +52,51 @@ DEBERTA_PRETRAINED_MODEL_ARCHIVE_LIST = [
 ]
 
 
+def prune_linear_layer(layer, index, dim=0):
+    """
+    Rebuild a linear layer keeping only the entries in 'index' along 'dim' of its weight,
+    i.e. output features for dim 0 and input features for dim 1.
+    """
+
+    index = index.to(layer.weight.device)
+    weight = layer.weight.index_select(dim, index).clone().detach()
+    bias = None
+    if layer.bias is not None:
+        bias = layer.bias.clone().detach() if dim == 1 else layer.bias[index].clone().detach()
+
+    new_size = list(layer.weight.size())
+    new_size[dim] = len(index)
+    new_layer = nn.Linear(new_size[1], new_size[0], bias=bias is not None).to(layer.weight.device)
+
+    new_layer.weight.requires_grad = False
+    new_layer.weight.copy_(weight.contiguous())
+    new_layer.weight.requires_grad = True
+    if bias is not None:
+        new_layer.bias.requires_grad = False
+        new_layer.bias.copy_(bias.contiguous())
+        new_layer.bias.requires_grad = True
+
+    return new_layer
+
+
+def find_pruneable_heads_and_indices(heads, n_heads, head_size, already_pruned_heads):
+    """
+    Returns the heads to prune(original indices, excluding the already pruned ones) &
+    the kept index of a (n_heads x head_size) dim, where 'n_heads' is the current number of heads.
+    """
+
+    mask = torch.ones(n_heads, head_size)
+    heads = set(heads) - already_pruned_heads
+    for head in heads:
+        # Heads before it which have been pruned shift its position
+        head = head - sum(1 if h < head else 0 for h in already_pruned_heads)
+        mask[head] = 0
+
+    index = torch.arange(len(mask.view(-1)))[mask.view(-1).eq(1)].long()
+
+    return heads, index
+
+
 class ContextPooler(nn.Module):
     """这里实质上并没有做池化，仅仅是取出第1个 token 然后经过 Dropout、FC 以及 激活函数"""
     def __init__(self, config):
@@ -82,6 +128,7 @@ class XSoftmax(torch.autograd.Function):
     Args:
         input (:obj:`torch.tensor`): The input tensor that will apply softmax.
         mask (:obj:`torch.IntTensor`): The mask matrix where 0 indicate that element will be ignored in the softmax calculation.
+            It is broadcast to the input, e.g. a (B,1,1,L) key padding mask for (B,num_heads,L,L) scores.
         dim (int): The dimension that will apply softmax
 
     Example::
@@ -298,6 +345,15 @@ class DebertaAttention(nn.Module):
 
         self.config = config
 
+    def prune_heads(self, heads):
+        if len(heads) == 0:
+            return
+
+        # 输出 FC 的输入维度对应各个头部的输出
+        index = self.self.prune_heads(heads)
+        if index is not None:
+            self.output.dense = prune_linear_layer(self.output.dense, index, dim=1)
+
     def forward(
         self,
         hidden_states,
@@ -323,16 +379,18 @@ class DebertaAttention(nn.Module):
         # 将 self_output 经过 FC & Dropout 然后将输出与 query_states 相加后送入 LN
         attention_output = self.output(self_output, query_states)
 
-        return attention_output, att_matrix if output_attentions else attention_output
+        return (attention_output, att_matrix) if output_attentions else attention_output
 
 
 # Copied from transformers.models.bert.modeling_bert.BertIntermediate with Bert->Deberta
 class DebertaIntermediate(nn.Module):
     """FC->ACT"""
-    def __init__(self, config):
+    def __init__(self, config, intermediate_size=None):
         super().__init__()
 
-        self.dense = nn.Linear(config.hidden_size, config.intermediate_size)
+        # 结构化剪枝后每层的 intermediate size 可能不同
+        intermediate_size = intermediate_size or config.intermediate_size
+        self.dense = nn.Linear(config.hidden_size, intermediate_size)
         self.intermediate_act_fn = ACT2FN[config.hidden_act] \
             if isinstance(config.hidden_act, str) else config.hidden_act
 
@@ -345,10 +403,11 @@ class DebertaIntermediate(nn.Module):
 
 class DebertaOutput(nn.Module):
     """FC->Dropout->LN"""
-    def __init__(self, config):
+    def __init__(self, config, intermediate_size=None):
         super().__init__()
 
-        self.dense = nn.Linear(config.intermediate_size, config.hidden_size)
+        intermediate_size = intermediate_size or config.intermediate_size
+        self.dense = nn.Linear(intermediate_size, config.hidden_size)
         self.LayerNorm = DebertaLayerNorm(config.hidden_size, config.layer_norm_eps)
         self.dropout = StableDropout(config.hidden_dropout_prob)
 
@@ -364,14 +423,26 @@ class DebertaOutput(nn.Module):
 
 
 class DebertaLayer(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, intermediate_size=None):
         super().__init__()
 
         self.attention = DebertaAttention(config)
         # FFN
-        self.intermediate = DebertaIntermediate(config)
+        self.intermediate = DebertaIntermediate(config, intermediate_size=intermediate_size)
         # FC->Dropout->LN
-        self.output = DebertaOutput(config)
+        self.output = DebertaOutput(config, intermediate_size=intermediate_size)
+
+    def prune_neurons(self, neurons):
+        """Remove the FFN neurons in 'neurons', i.e. output features of 'intermediate.dense'."""
+
+        keep = torch.ones(self.intermediate.dense.out_features, dtype=torch.bool)
+        keep[list(neurons)] = False
+        index = keep.nonzero().squeeze(-1)
+        if len(index) == 0:
+            raise ValueError("Can not prune all the FFN neurons of a layer.")
+
+        self.intermediate.dense = prune_linear_layer(self.intermediate.dense, index, dim=0)
+        self.output.dense = prune_linear_layer(self.output.dense, index, dim=1)
 
     def forward(
         self,
@@ -411,7 +482,10 @@ class DebertaEncoder(nn.Module):
     def __init__(self, config):
         super().__init__()
 
-        self.layer = nn.ModuleList([DebertaLayer(config) for _ in range(config.num_hidden_layers)])
+        # 'intermediate_sizes' 记录了结构化剪枝后每层的 intermediate size
+        intermediate_sizes = getattr(config, "intermediate_sizes", None) or \
+            [config.intermediate_size] * config.num_hidden_layers
+        self.layer = nn.ModuleList([DebertaLayer(config, size) for size in intermediate_sizes])
 
         self.relative_attention = getattr(config, "relative_attention", False)
         if self.relative_attention:
@@ -431,16 +505,14 @@ class DebertaEncoder(nn.Module):
 
     def get_attention_mask(self, attention_mask):
         if attention_mask.dim() <= 2:
-            # (B,L)->(B,1,1,L)
-            extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
-            # (B,1,1,L) * (B,1,L,1) = (B,1,L,L)
-            attention_mask = extended_attention_mask * extended_attention_mask.squeeze(-2).unsqueeze(-1)
-            attention_mask = attention_mask.byte()
+            # (B,L)->(B,1,1,L) 只保留 key 的 padding mask，在注意力计算中广播，不再外积成 (B,1,L,L)；
+            # 自注意力中 query 的 padding mask 就是它的转置，由 'DisentangledSelfAttention' 按需使用
+            attention_mask = attention_mask.unsqueeze(1).unsqueeze(2).byte()
         elif attention_mask.dim() == 3:
             # (B,L,L)->(B,1,L,L)
             attention_mask = attention_mask.unsqueeze(1)
 
-        # (B,1,L,L) dim1 对应注意力头部
+        # (B,1,1,L) 或 (B,1,L,L) dim1 对应注意力头部
         return attention_mask
 
     def get_rel_pos(self, hidden_states, query_states=None, relative_pos=None):
@@ -462,7 +534,7 @@ class DebertaEncoder(nn.Module):
     ):
         '''i. 准备 attention mask & 计算 query 和 key 的相对位置值'''
         # 对于第1层 Transformer 来说，输入的 hidden_states 是 patch embedding
-        # (B,1,L,L) 对于第一层 Transformer 来说，(B,L)->(B,1,L,L)
+        # (B,1,1,L) 对于第一层 Transformer 来说，(B,L)->(B,1,1,L)；(B,L,L)->(B,1,L,L)
         attention_mask = self.get_attention_mask(attention_mask)
         # (1,query_size or hidden_size,hidden_size) 
         # 对于第一层来说，就是 (1,L,L) 其中每个值的范围是 [-(L-1),L-1]
@@ -555,6 +627,25 @@ def build_relative_position(query_size, key_size, device):
 
     """
 
+    # 每个 (query_size,key_size,device) 只计算一次，所有层与所有 step 共享，因此返回值不能被原地修改
+    if _use_position_cache():
+        return _cached_relative_position(query_size, key_size, device)
+
+    return _relative_position(query_size, key_size, device)
+
+
+# 相对位置 & c2p/p2c gather 索引的缓存开关，用于对比测试
+RELATIVE_POSITION_CACHE = True
+# 推理时相对位置 embedding 映射(pos_key_layer & pos_query_layer)的缓存开关，用于对比测试
+POS_PROJECTION_CACHE = True
+
+
+def _use_position_cache():
+    # trace/script 时不能使用缓存，否则索引会被固化为常量，导出的图失去动态长度
+    return RELATIVE_POSITION_CACHE and not torch.jit.is_tracing() and not torch.jit.is_scripting()
+
+
+def _relative_position(query_size, key_size, device):
     q_ids = torch.arange(query_size, dtype=torch.long, device=device)
     k_ids = torch.arange(key_size, dtype=torch.long, device=device)
 
@@ -568,6 +659,70 @@ def build_relative_position(query_size, key_size, device):
     return rel_pos_ids
 
 
+@lru_cache(maxsize=64)
+def _cached_relative_position(query_size, key_size, device):
+    return _relative_position(query_size, key_size, device)
+
+
+def _relative_position_index(relative_pos, query_size, key_size, att_span, device):
+    """
+    Clamped gather indices of c2p & p2c: (1,1,query_size,key_size) c2p_pos and p2c_pos, which is
+    (1,1,key_size,key_size) if the lengths differ.
+    """
+
+    c2p_pos = torch.clamp(relative_pos + att_span, 0, att_span * 2 - 1)
+    # 当 query 与 key 的长度不一致的情况下，以 key 长度做相对位置计算，以兼容 p2p
+    if query_size != key_size:
+        # (1,1,k_L,k_L)
+        r_pos = build_relative_position(key_size, key_size, device).unsqueeze(1)
+    else:
+        # (1,1,q_L,k_L) 这种情况下 q_L=k_L
+        r_pos = relative_pos
+    # 加上偏移量以便用作注意力矩阵的索引
+    p2c_pos = torch.clamp(-r_pos + att_span, 0, att_span * 2 - 1)
+
+    return c2p_pos, p2c_pos
+
+
+@lru_cache(maxsize=64)
+def _cached_relative_position_index(query_size, key_size, att_span, device):
+    """'_relative_position_index' of the relative positions built by 'build_relative_position', keyed by shape."""
+
+    relative_pos = _cached_relative_position(query_size, key_size, device).unsqueeze(1)
+    return _relative_position_index(relative_pos, query_size, key_size, att_span, device)
+
+
+def relative_shift(scores, length, shift):
+    """
+    Gather-free equivalent of taking 'scores[..., i, clamp(j - i + shift, 0, 2L' - 1)]' for every (i, j),
+    where 'scores' is (..., L, 2L') and the result (..., L, L).
+
+    The row of the 2L - 1 relative offsets is built by slicing 'scores' and padding its edge columns
+    (which is what the clamp does), then every row 'i' is shifted left by 'i' through a flat view whose
+    row stride is one column shorter.
+    """
+
+    span = scores.size(-1)
+    # 第 n 列对应索引 clamp(n - (L-1) + shift)，n ∈ [0,2L-2]
+    left = max(0, length - 1 - shift)
+    right = max(0, length - span + shift)
+    middle = scores[..., max(0, shift - length + 1):min(span - 1, length - 1 + shift) + 1]
+    parts = [middle]
+    if left:
+        parts.insert(0, scores[..., :1].expand(*scores.shape[:-1], left))
+    if right:
+        parts.append(scores[..., -1:].expand(*scores.shape[:-1], right))
+    # (...,L,2L-1)
+    scores = torch.cat(parts, dim=-1) if len(parts) > 1 else middle
+
+    # 第 i 行第 j 个元素位于展平后的 i x (2L-1) + j - i + L-1 = i x (2L-2) + (L-1) + j
+    rows, width = scores.shape[-2:]
+    flat = scores.reshape(*scores.shape[:-2], rows * width)
+    flat = flat[..., length - 1:length - 1 + rows * (width - 1)]
+
+    return flat.reshape(*scores.shape[:-2], rows, width - 1)[..., :length]
+
+
 @torch.jit.script
 def c2p_dynamic_expand(c2p_pos, query_layer, relative_pos):
     return c2p_pos.expand([query_layer.size(0), query_layer.size(1), query_layer.size(2), relative_pos.size(-1)])
@@ -614,6 +769,11 @@ class DisentangledSelfAttention(nn.Module):
         # 位置注意力类型 i.e. ['c2p', 'p2c']
         self.pos_att_type = config.pos_att_type if config.pos_att_type is not None else []
 
+        # c2p & p2c 用相对位移(pad, reshape & slice)代替 gather 索引
+        self.relative_shift = getattr(config, "relative_shift", False)
+        # 'eager' 或 'sdpa'，后者用 F.scaled_dot_product_attention 计算注意力
+        self.attention_backend = getattr(config, "attention_backend", "eager")
+
         self.talking_head = getattr(config, "talking_head", False)
         if self.talking_head:
             # 对原始的注意力系数(logits)做线性映射
@@ -637,6 +797,54 @@ class DisentangledSelfAttention(nn.Module):
                 self.pos_q_proj = nn.Linear(config.hidden_size, self.all_head_size)
 
         self.dropout = StableDropout(config.attention_probs_dropout_prob)
+        # 已剪掉的头部(原始序号)
+        self.pruned_heads = set()
+        # 推理时整个相对位置 embedding 表的映射缓存，见 '_project_rel_embeddings'
+        self._pos_projection = None
+
+    def prune_heads(self, heads):
+        """
+        Remove the attention heads in 'heads'(original indices) by slicing every per-head projection.
+
+        Returns:
+            The kept index of the (num_heads x head_size) dim, which 'attention.output.dense' is sliced
+            along its input, or None if no head is removed.
+        """
+
+        heads, index = find_pruneable_heads_and_indices(
+            heads, self.num_attention_heads, self.attention_head_size, self.pruned_heads
+        )
+        if not heads:
+            return None
+        if len(heads) == self.num_attention_heads:
+            raise ValueError("Can not prune all the attention heads of a layer.")
+
+        head_size = self.attention_head_size
+        kept_heads = index.view(-1, head_size)[:, 0] // head_size
+        # in_proj 的输出按头部排列，每个头部依次是 q,k,v 各 head_size 维
+        qkv_index = (kept_heads.unsqueeze(-1) * 3 * head_size + torch.arange(3 * head_size)).view(-1)
+
+        self.in_proj = prune_linear_layer(self.in_proj, qkv_index, dim=0)
+        self.q_bias = nn.Parameter(self.q_bias.data[index.to(self.q_bias.device)].clone())
+        self.v_bias = nn.Parameter(self.v_bias.data[index.to(self.v_bias.device)].clone())
+        if self.relative_attention:
+            if hasattr(self, "pos_proj"):
+                self.pos_proj = prune_linear_layer(self.pos_proj, index, dim=0)
+            if hasattr(self, "pos_q_proj"):
+                self.pos_q_proj = prune_linear_layer(self.pos_q_proj, index, dim=0)
+        if self.talking_head:
+            kept_heads = kept_heads.to(self.head_logits_proj.weight.device)
+            for proj in ("head_logits_proj", "head_weights_proj"):
+                weight = getattr(self, proj).weight.data[kept_heads][:, kept_heads]
+                layer = nn.Linear(len(kept_heads), len(kept_heads), bias=False).to(weight.device)
+                layer.weight.data.copy_(weight)
+                setattr(self, proj, layer)
+
+        self.num_attention_heads = self.num_attention_heads - len(heads)
+        self.all_head_size = self.attention_head_size * self.num_attention_heads
+        self.pruned_heads = self.pruned_heads.union(heads)
+
+        return index
 
     def transpose_for_scores(self, x):
         # (B,L,C)->(B,L,num_heads,C//num_heads)
@@ -646,6 +854,112 @@ class DisentangledSelfAttention(nn.Module):
         # (B,L,num_heads,C//num_heads)->(B,num_heads,L,C//num_heads)
         return x.permute(0, 2, 1, 3)
 
+    def _apply(self, fn):
+        # .to()/.cuda()/.half() 通过 set_data 替换参数的数据，参数对象与版本号都不变，需要在此清空映射缓存
+        self._pos_projection = None
+        return super()._apply(fn)
+
+    def _projection_sources(self, rel_embeddings):
+        # 映射结果依赖的所有张量，它们被替换(如剪头、替换模块)或原地修改(optimizer.step、load_state_dict、剪枝 mask)
+        # 时缓存失效，后者由张量的版本号 '_version' 判断
+        sources = [rel_embeddings]
+        for name in ("pos_proj", "pos_q_proj"):
+            if hasattr(self, name):
+                module = getattr(self, name)
+                sources.extend(module.parameters())
+                sources.extend(module.buffers())
+
+        return sources
+
+    def _project(self, rel_embeddings, scale_factor):
+        """(1,num_heads,N,hidden_dim_per_head) key & scaled query position embeddings of (1,N,hidden_dim) ones."""
+
+        pos_key_layer = pos_query_layer = None
+        # 计算 key 的位置 embedding，用于 c2p 和 p2p
+        if "c2p" in self.pos_att_type or "p2p" in self.pos_att_type:
+            # (1,N,hidden_dim)->(1,num_heads,N,hidden_dim_per_head)
+            pos_key_layer = self.transpose_for_scores(self.pos_proj(rel_embeddings))
+        # 计算 query 的位置 embedding，用于 p2c 和 p2p
+        if "p2c" in self.pos_att_type or "p2p" in self.pos_att_type:
+            # (1,N,hidden_dim)->(1,num_heads,N,hidden_dim_per_head)
+            pos_query_layer = self.transpose_for_scores(self.pos_q_proj(rel_embeddings))
+            if "p2c" in self.pos_att_type:
+                # 除以 sqrt(3 x hidden_dim_per_head) 缩放
+                pos_query_layer = pos_query_layer / math.sqrt(pos_query_layer.size(-1) * scale_factor)
+
+        return pos_key_layer, pos_query_layer
+
+    def _project_rel_embeddings(self, rel_embeddings, att_span, scale_factor):
+        """
+        Key & scaled query position embeddings of the 2L' relative positions within 'att_span'.
+
+        At inference(eval mode without grad) they do not depend on the input, so the projection of the whole
+        relative embedding table is cached, each 'att_span' is a slice of it. The cache is rebuilt when any
+        tensor it depends on is replaced or modified in place, tracked by the tensor version counters.
+
+        Returns:
+            (1,num_heads,2L',hidden_dim_per_head) pos_key_layer & pos_query_layer, None if not used.
+        """
+
+        span = slice(self.max_relative_positions - att_span, self.max_relative_positions + att_span)
+        # 训练时 pos_dropout 随机，且需要梯度；trace 时映射应保留在图中
+        if not POS_PROJECTION_CACHE or self.training or torch.is_grad_enabled() \
+                or torch.jit.is_tracing() or torch.jit.is_scripting():
+            self._pos_projection = None
+            # (1,2L',hidden_dim)
+            return self._project(rel_embeddings[span, :].unsqueeze(0), scale_factor)
+
+        sources = self._projection_sources(rel_embeddings)
+        versions = [source._version for source in sources]
+        key = (scale_factor, torch.is_autocast_enabled())
+        cache = self._pos_projection
+        if cache is None or cache[2] != key or cache[1] != versions or len(cache[0]) != len(sources) \
+                or any(cached is not source for cached, source in zip(cache[0], sources)):
+            # (1,2 x max_relative_positions,hidden_dim)
+            cache = (sources, versions, key, self._project(rel_embeddings.unsqueeze(0), scale_factor))
+            self._pos_projection = cache
+
+        # Linear 逐行映射，整表映射后切片与切片后映射相同
+        return tuple(None if layer is None else layer[:, :, span] for layer in cache[3])
+
+    def _use_sdpa(self, output_attentions):
+        # SDPA 不输出注意力矩阵，也无法在 Softmax 前后插入 talking head 的映射，这些情况下退回 eager；
+        # trace(如 ONNX 导出)时也用 eager，以保留 XSoftmax 的 symbolic
+        return self.attention_backend == "sdpa" and hasattr(nn.functional, "scaled_dot_product_attention") \
+            and not output_attentions and not self.talking_head and not torch.jit.is_tracing()
+
+    def _sdpa_attention(self, query_layer, key_layer, value_layer, attention_mask, rel_att):
+        """
+        Attention by 'F.scaled_dot_product_attention' with the c2p & p2c scores as an additive bias.
+
+        Args:
+            query_layer: (B,num_heads,L_q,head_size), already divided by 'sqrt(head_size x scale_factor)'.
+            attention_mask: (B,1,L_q,L_k) or a (B,1,1,L_k) key padding mask, 1 for the positions to attend to.
+            rel_att: (B,num_heads,L_q,L_k) c2p + p2c scores, or None.
+        Returns:
+            (B,num_heads,L_q,head_size) context.
+        """
+
+        mask = attention_mask.bool()
+        # 整行都被 mask 的 query(padding token 或全是 padding 的样本)，XSoftmax 的输出为0；
+        # 这里不对其 mask 以免 Softmax 出现 NaN，之后再将其输出置0
+        valid_rows = mask.any(-1, keepdim=True)
+        if rel_att is None:
+            rel_att = torch.zeros(mask.shape, dtype=query_layer.dtype, device=query_layer.device)
+        bias = rel_att.to(query_layer.dtype).masked_fill(~mask & valid_rows, torch.finfo(query_layer.dtype).min)
+
+        # SDPA 默认将 QK^T 乘以 1/sqrt(head_size)，而 query 已经除过 sqrt(head_size x scale_factor)，
+        # 先乘回 sqrt(head_size) 使两者等价(兼容没有 'scale' 参数的 PyTorch 版本)
+        context_layer = nn.functional.scaled_dot_product_attention(
+            query_layer * math.sqrt(query_layer.size(-1)),
+            key_layer,
+            value_layer,
+            attn_mask=bias,
+            dropout_p=self.dropout.drop_prob if self.training else 0.,
+        )
+
+        return context_layer * valid_rows.to(context_layer.dtype)
+
     def forward(
         self,
         hidden_states,
@@ -664,9 +978,9 @@ class DisentangledSelfAttention(nn.Module):
                 `Attention(Q,K,V)`
 
             attention_mask (:obj:`torch.ByteTensor`):
-                An attention mask matrix of shape [`B`, `N`, `N`] where `B` is the batch size, `N` is the maximum
+                An attention mask matrix of shape [`B`, 1, `N`, `N`] where `B` is the batch size, `N` is the maximum
                 sequence length in which element [i,j] = `1` means the `i` th token in the input can attend to the `j`
-                th token.
+                th token, or a key padding mask of shape [`B`, 1, 1, `N`], whose transpose is the query padding mask.
 
             output_attentions (:obj:`bool`, optional):
                 Whether return the attention matrix.
@@ -724,8 +1038,10 @@ class DisentangledSelfAttention(nn.Module):
         scale_factor = 1 + len(self.pos_att_type)
         scale = math.sqrt(query_layer.size(-1) * scale_factor)
         query_layer = query_layer / scale
-        # (B,num_heads,L,L) 这部分是 c2c(内容到内容) 的注意力计算
-        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
+        use_sdpa = self._use_sdpa(output_attentions)
+        # (B,num_heads,L,L) 这部分是 c2c(内容到内容) 的注意力计算，SDPA 在 kernel 中计算，这里跳过
+        if not use_sdpa:
+            attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
 
         '''iii. 内容与位置之间的注意力计算(c2p,p2c)'''
         rel_att = None
@@ -736,25 +1052,39 @@ class DisentangledSelfAttention(nn.Module):
             rel_att = self.disentangled_att_bias(query_layer, key_layer, relative_pos, rel_embeddings, scale_factor)
         
         '''iv. 注意力的后处理：内容与位置之间的注意力相加、线性映射、Softmax 映射到 (0,1) 区间'''
-        if rel_att is not None:
-            # c2c + (c2p + p2c) (B,num_heads,L,L)
-            attention_scores = attention_scores + rel_att
-        if self.talking_head:
-            # 因为 head_logits_proj(实质是一个 FC) 的输入维度是 num_heads，所以需要先排列维度再恢复回来
-            # (B,num_heads,L,L)->(B,L,L,num_heads)->(B,num_heads,L,L)
-            attention_scores = self.head_logits_proj(attention_scores.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
-
-        # Softmax 将注意力分数映射到 (0,1) 区间，mask 用于忽略掉某些位置
-        # 将 mask == 0 的位置用 -inf 填充输入到 softmax，然后将输出结果在这些位置上再用0填充
-        attention_probs = XSoftmax.apply(attention_scores, attention_mask, -1)
-        attention_probs = self.dropout(attention_probs)
-        if self.talking_head:
-            # 因为 head_weights_proj(实质是一个 FC) 的输入维度是 num_heads，所以需要先排列维度再恢复回来
-            # (B,num_heads,L,L)->(B,L,L,num_heads)->(B,num_heads,L,L)
-            attention_probs = self.head_weights_proj(attention_probs.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
+        if use_sdpa:
+            # c2c、加上 c2p + p2c 偏置、mask、Softmax、Dropout 以及施加在 value 上都在 SDPA kernel 中完成，
+            # 不会生成 (B,num_heads,L,L) 的注意力概率矩阵
+            context_layer = self._sdpa_attention(query_layer, key_layer, value_layer, attention_mask, rel_att)
+        else:
+            if rel_att is not None:
+                # c2c + (c2p + p2c) (B,num_heads,L,L)
+                attention_scores = attention_scores + rel_att
+            if self.talking_head:
+                # 因为 head_logits_proj(实质是一个 FC) 的输入维度是 num_heads，所以需要先排列维度再恢复回来
+                # (B,num_heads,L,L)->(B,L,L,num_heads)->(B,num_heads,L,L)
+                attention_scores = self.head_logits_proj(attention_scores.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
+
+            # Softmax 将注意力分数映射到 (0,1) 区间，mask 用于忽略掉某些位置
+            # 将 mask == 0 的位置用 -inf 填充输入到 softmax，然后将输出结果在这些位置上再用0填充
+            attention_probs = XSoftmax.apply(attention_scores, attention_mask, -1)
+            attention_probs = self.dropout(attention_probs)
+            if self.talking_head:
+                # 因为 head_weights_proj(实质是一个 FC) 的输入维度是 num_heads，所以需要先排列维度再恢复回来
+                # (B,num_heads,L,L)->(B,L,L,num_heads)->(B,num_heads,L,L)
+                attention_probs = self.head_weights_proj(attention_probs.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
 
         '''v. 将注意力施加在 value 上并恢复原来的维度'''
-        context_layer = torch.matmul(attention_probs, value_layer)
+        if not use_sdpa:
+            context_layer = torch.matmul(attention_probs, value_layer)
+        # (B,1,1,L) 的 key mask 不会屏蔽 padding 的 query 行，将其输出置0，与 (B,1,L,L) mask 下 XSoftmax 输出0的行一致；
+        # 只对 (B,num_heads,L,hidden_dim_per_head) 的输出做，而不对 (B,num_heads,L,L) 的注意力概率矩阵做
+        if attention_mask.size(-2) == 1 and attention_mask.size(-1) == context_layer.size(-2):
+            # (B,1,1,L)->(B,1,L,1)
+            query_mask = attention_mask.transpose(-1, -2)
+            context_layer = context_layer * query_mask.to(context_layer.dtype)
+            if output_attentions:
+                attention_probs = attention_probs * query_mask.to(attention_probs.dtype)
         # (B,num_heads,L,hidden_dim_per_head)->(B,L,num_heads,hidden_dim_per_head)
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         # (B,L,-1)
@@ -762,15 +1092,20 @@ class DisentangledSelfAttention(nn.Module):
         # (B,L,num_heads,hidden_dim_per_head)->(B,L,hidden_dim = num_heads x hidden_dim_per_head)
         context_layer = context_layer.view(*new_context_layer_shape)
 
-        return context_layer, attention_probs if output_attentions else context_layer
+        return (context_layer, attention_probs) if output_attentions else context_layer
 
     def disentangled_att_bias(self, query_layer, key_layer, relative_pos, rel_embeddings, scale_factor):
         '''i. 计算(确定) query 和 key 的相对位置值'''
+        # q_L(query length), k_L(key length)
+        q, k = query_layer.size(-2), key_layer.size(-2)
+        # 默认的相对位置 i.e. 由 'build_relative_position' 构建
+        default_pos = relative_pos is None
         if relative_pos is None:
-            # q_L(query length)
-            q = query_layer.size(-2)
             # (1,q_L,k_L)
-            relative_pos = build_relative_position(q, key_layer.size(-2), query_layer.device)
+            relative_pos = build_relative_position(q, k, query_layer.device)
+        # 由 'build_relative_position' 缓存的相对位置，其 gather 索引也只由形状决定，可以直接取缓存
+        cached_index = _use_position_cache() and \
+            relative_pos is _cached_relative_position(q, k, query_layer.device)
         if relative_pos.dim() == 2:
             relative_pos = relative_pos.unsqueeze(0).unsqueeze(0)
         elif relative_pos.dim() == 3:
@@ -782,27 +1117,22 @@ class DisentangledSelfAttention(nn.Module):
         '''ii. 根据相对位置在 embedding 矩阵中取出对应的 embedding 部分'''
         # 以下注释记 L'=max(q_L,k_L)
         att_span = min(max(query_layer.size(-2), key_layer.size(-2)), self.max_relative_positions)
-        # (1,2L',hidden_dim)
-        rel_embeddings = rel_embeddings[
-            (self.max_relative_positions - att_span):(self.max_relative_positions + att_span), :
-        ].unsqueeze(0)
 
         '''iii. 根据相对位置 embedding 分别计算出 query 和 key 的位置 embedding，分别用于 c2p(& p2p) 和 p2c(& p2p)'''
-        # 计算 key 的位置 embedding，用于 c2p 和 p2p
-        if "c2p" in self.pos_att_type or "p2p" in self.pos_att_type:
-            # (1,2L',hidden_dim)
-            pos_key_layer = self.pos_proj(rel_embeddings)
-            # (1,num_heads,2L',hidden_dim_per_head)
-            pos_key_layer = self.transpose_for_scores(pos_key_layer)
-        # 计算 query 的位置 embedding，用于 p2c 和 p2p
-        if "p2c" in self.pos_att_type or "p2p" in self.pos_att_type:
-            # (1,2L',hidden_dim)
-            pos_query_layer = self.pos_q_proj(rel_embeddings)
-            # (1,num_heads,2L',hidden_dim_per_head)
-            pos_query_layer = self.transpose_for_scores(pos_query_layer)
+        # (1,num_heads,2L',hidden_dim_per_head) x 2，其中 pos_query_layer 已经除以 sqrt(3 x hidden_dim_per_head) 缩放
+        pos_key_layer, pos_query_layer = self._project_rel_embeddings(rel_embeddings, att_span, scale_factor)
 
         score = 0
         relative_pos = relative_pos.long().to(query_layer.device)
+        # (1,1,q_L,k_L) c2p 索引 & (1,1,q_L or k_L,k_L) p2c 索引
+        # 相对位移只适用于默认的相对位置且 q_L=k_L 的情况
+        shift = self.relative_shift and q == k and q > 1 and (default_pos or cached_index)
+        if shift:
+            c2p_pos = p2c_pos = None
+        elif cached_index:
+            c2p_pos, p2c_pos = _cached_relative_position_index(q, k, att_span, query_layer.device)
+        else:
+            c2p_pos, p2c_pos = _relative_position_index(relative_pos, q, k, att_span, query_layer.device)
 
         '''iv. query 内容 -> key 位置 的注意力计算'''
         # content->position
@@ -810,52 +1140,46 @@ class DisentangledSelfAttention(nn.Module):
             # query 内容 与 所有 key 位置(2L' 个位置，maybe 当前序列并没有那么长) embedding 计算注意力
             # (B,num_heads,q_L,hidden_dim_per_head) dot (1,num_heads,hidden_dim_per_head,2L')
             # (B,num_heads,q_L,2L')
-            c2p_att = torch.matmul(query_layer, pos_key_layer.transpose(-1, -2))
-            # relative_pos 的值域是 [min(-k_L,-q_L), max(k_L,q_L)]，这里加上 attn_span(L') 并裁剪至 2L'-1 以便用作索引
-            # (1,1,q_L,k_L)
-            c2p_pos = torch.clamp(relative_pos + att_span, 0, att_span * 2 - 1)
-            # 根据 query 和 key 的相对位置在以上计算出的注意力矩阵中取出实际的 c2p 注意力值
-            # (B,num_heads,q_L,k_L) 'c2p_dynamic_expand' 使得 c2p_pos 的前3个 dim 与 query 一致，最后1个与 relative_pos 一致
-            c2p_att = torch.gather(c2p_att, dim=-1, index=c2p_dynamic_expand(c2p_pos, query_layer, relative_pos))
+            if shift:
+                # 将 pos_key 沿 2L' 个位置翻转(开销很小)，使 c2p_pos[i,j] = clamp(i-j+L') 变为 clamp(j-i+L'-1)，
+                # 与 p2c 同向，从而可以用相对位移取出
+                c2p_att = torch.matmul(query_layer, pos_key_layer.flip(-2).transpose(-1, -2))
+                c2p_att = relative_shift(c2p_att, q, att_span - 1)
+            else:
+                c2p_att = torch.matmul(query_layer, pos_key_layer.transpose(-1, -2))
+                # relative_pos 的值域是 [min(-k_L,-q_L), max(k_L,q_L)]，c2p_pos 是其加上 attn_span(L') 并裁剪至 2L'-1 的索引
+                # 根据 query 和 key 的相对位置在以上计算出的注意力矩阵中取出实际的 c2p 注意力值
+                # (B,num_heads,q_L,k_L) 'c2p_dynamic_expand' 使得 c2p_pos 的前3个 dim 与 query 一致，最后1个与 relative_pos 一致
+                c2p_att = torch.gather(c2p_att, dim=-1, index=c2p_dynamic_expand(c2p_pos, query_layer, relative_pos))
             
             score += c2p_att
 
         '''iv. query 位置 -> key 内容 的注意力计算'''
         # position->content
-        if "p2c" in self.pos_att_type or "p2p" in self.pos_att_type:
-            # 当 query 与 key 的长度不一致的情况下，以 key 长度做相对位置计算，以兼容 p2p
-            if query_layer.size(-2) != key_layer.size(-2):
-                # (1,k_L,k_L)
-                r_pos = build_relative_position(key_layer.size(-2), key_layer.size(-2), query_layer.device)
-            else:
-                # (1,1,q_L,k_L) 这种情况下 q_L=k_L
-                r_pos = relative_pos
-
-            # 加上偏移量以便用作注意力矩阵的索引
-            p2c_pos = torch.clamp(-r_pos + att_span, 0, att_span * 2 - 1)
-
         if "p2c" in self.pos_att_type:
-            # 除以 sqrt(3 x hidden_dim_per_head) 缩放
-            pos_query_layer /= math.sqrt(pos_query_layer.size(-1) * scale_factor)
             # key 的内容 与 所有 query 的位置(2L' 个位置，maybe 当前序列并没有那么长) 计算注意力
             # (B,num_heads,k_L,hidden_dim_per_head) dot (1,num_heads,hidden_dim_per_head,2L')
             # (B,num_heads,k_L,2L')
             p2c_att = torch.matmul(key_layer, pos_query_layer.transpose(-1, -2))
-            # 根据 query 和 key 的相对位置在以上计算出的注意力矩阵中取出实际的 p2c 注意力值
-            # (B,num_heads,k_L,k_L) 这里有可能 k_L=q_L
-            p2c_att = torch.gather(
-                # 'p2c_dynamic_expand' 将 p2c_pos 的前两个 dim 变成与 query_layer 一致，后两个变成与 key_layer 一致
-                p2c_att, dim=-1, index=p2c_dynamic_expand(p2c_pos, query_layer, key_layer)
-            ).transpose(-1, -2)  # dim -1 对应 query 位置，dim -2 对应 key 内容
-
-            # 当 query 和 key 长度不等时，进一步将对应 query 位置的注意力取出来
-            # (这种情况下 query 的长度必定要比 key 小，否则会越界)
-            if query_layer.size(-2) != key_layer.size(-2):
-                # (1,1,q_L,1)
-                pos_index = relative_pos[:, :, :, 0].unsqueeze(-1)
-                # 'pos_dynamic_expand' 将 pos_index 前2个 dim 变成与 p2c_att 一致，最后1个 dim 变成与 key_layer 一致
-                # 注意这里是在 dim -2 做 gather，因为前面已经将 query 位置对应的 dim 置换到 -2 dim 了
-                p2c_att = torch.gather(p2c_att, dim=-2, index=pos_dynamic_expand(pos_index, p2c_att, key_layer))
+            if shift:
+                # p2c_pos[a,b] = clamp(b-a+L')，位移后转置使 dim -1 对应 query 位置
+                p2c_att = relative_shift(p2c_att, k, att_span).transpose(-1, -2)
+            else:
+                # 根据 query 和 key 的相对位置在以上计算出的注意力矩阵中取出实际的 p2c 注意力值
+                # (B,num_heads,k_L,k_L) 这里有可能 k_L=q_L
+                p2c_att = torch.gather(
+                    # 'p2c_dynamic_expand' 将 p2c_pos 的前两个 dim 变成与 query_layer 一致，后两个变成与 key_layer 一致
+                    p2c_att, dim=-1, index=p2c_dynamic_expand(p2c_pos, query_layer, key_layer)
+                ).transpose(-1, -2)  # dim -1 对应 query 位置，dim -2 对应 key 内容
+
+                # 当 query 和 key 长度不等时，进一步将对应 query 位置的注意力取出来
+                # (这种情况下 query 的长度必定要比 key 小，否则会越界)
+                if query_layer.size(-2) != key_layer.size(-2):
+                    # (1,1,q_L,1)
+                    pos_index = relative_pos[:, :, :, 0].unsqueeze(-1)
+                    # 'pos_dynamic_expand' 将 pos_index 前2个 dim 变成与 p2c_att 一致，最后1个 dim 变成与 key_layer 一致
+                    # 注意这里是在 dim -2 做 gather，因为前面已经将 query 位置对应的 dim 置换到 -2 dim 了
+                    p2c_att = torch.gather(p2c_att, dim=-2, index=pos_dynamic_expand(pos_index, p2c_att, key_layer))
             
             score += p2c_att
 
@@ -1003,6 +1327,21 @@ class DebertaPreTrainedModel(PreTrainedModel):
         if isinstance(module, DebertaEncoder):
             module.gradient_checkpointing = value
 
+    def prune_neurons(self, neurons_to_prune):
+        """
+        Prunes FFN neurons of the model, the counterpart of 'prune_heads' for the FFN.
+
+        Arguments:
+            neurons_to_prune (:obj:`Dict[int, List[int]]`):
+                Dictionary with keys being selected layer indices (:obj:`int`) and associated values being the list
+                of neurons(output features of 'intermediate.dense') to prune in said layer.
+        """
+        self.base_model._prune_neurons(neurons_to_prune)
+        # 记录每层剪枝后的 intermediate size，以便重新加载时按该尺寸构建模型
+        self.config.intermediate_sizes = [
+            layer.intermediate.dense.out_features for layer in self.base_model.encoder.layer
+        ]
+
 
 DEBERTA_START_DOCSTRING = r"""
     The DeBERTa model was proposed in `DeBERTa: Decoding-enhanced BERT with Disentangled Attention
@@ -1095,7 +1434,13 @@ class DebertaModel(DebertaPreTrainedModel):
         Prunes heads of the model. heads_to_prune: dict of {layer_num: list of heads to prune in this layer} 
         See base class PreTrainedModel
         """
-        raise NotImplementedError("The prune function is not implemented in DeBERTa model.")
+        for layer, heads in heads_to_prune.items():
+            self.encoder.layer[layer].attention.prune_heads(heads)
+
+    def _prune_neurons(self, neurons_to_prune):
+        """neurons_to_prune: dict of {layer_num: list of FFN neurons to prune in this layer}"""
+        for layer, neurons in neurons_to_prune.items():
+            self.encoder.layer[layer].prune_neurons(neurons)
 
     @add_start_docstrings_to_model_forward(DEBERTA_INPUTS_DOCSTRING.format("batch_size, sequence_length"))
     @add_code_sample_docstrings(
@@ -1174,7 +1519,7 @@ class DebertaModel(DebertaPreTrainedModel):
             # 相对位置 embedding 矩阵
             # (2 x max_L, hidden_dim)
             rel_embeddings = self.encoder.get_rel_embedding()
-            # (B,1,q_L,k_L)
+            # (B,1,1,k_L)
             attention_mask = self.encoder.get_attention_mask(attention_mask)
             # (1,q_L,k_L)
             rel_pos = self.encoder.get_rel_pos(embedding_output)
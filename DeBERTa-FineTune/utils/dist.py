@@ -110,3 +110,28 @@ def distributed_master_first(rank: int):
     if not rank:
         # 主进程通知其余进程(同时也有等待其余进程的效果)
         synchronize()
+
+
+def is_dist_avail_and_initialized():
+    return dist.is_available() and dist.is_initialized()
+
+
+def broadcast_coalesced(tensors, src):
+    """
+    Broadcast a list of tensors(same dtype & device) from rank 'src' in place with a single collective,
+    they are flattened into one buffer so that many small tensors don't cost one call each.
+    """
+
+    if not tensors:
+        return tensors
+
+    buffer = torch.cat([tensor.reshape(-1) for tensor in tensors])
+    dist.broadcast(buffer, src)
+
+    if get_rank() != src:
+        offset = 0
+        for tensor in tensors:
+            tensor.view(-1).copy_(buffer[offset:offset + tensor.numel()])
+            offset += tensor.numel()
+
+    return tensors
@@ -14,7 +14,7 @@ def auto_resume_helper(checkpoint_dir):
     return max([os.path.join(checkpoint_dir, ckp) for ckp in all_checkpoints], key=os.path.getmtime)
 
 
-def load_checkpoint(model, optimizer, lr_scheduler, config, logger):
+def load_checkpoint(model, optimizer, lr_scheduler, config, logger, pruner=None):
     if config.MODEL.RESUME.startswith('https'):
         checkpoint = torch.hub.load_state_dict_from_url(
             config.MODEL.RESUME, map_location='cpu', check_hash=True
@@ -34,6 +34,12 @@ def load_checkpoint(model, optimizer, lr_scheduler, config, logger):
         config.TRAIN.START_EPOCH = checkpoint['epoch'] + 1
         config.freeze()
         logger.info(f"=> Resume from epoch{checkpoint['epoch']}")
+    if pruner is not None:
+        if 'pruner' in checkpoint:
+            pruner.load_state_dict(checkpoint['pruner'])
+            logger.info(f"=> Resume pruning from step{checkpoint['pruner']['t']}")
+        else:
+            logger.warning("=> No pruner state in the checkpoint, pruning starts from scratch")
     
     metrics = checkpoint.get('metric', {})
     del checkpoint
@@ -44,7 +50,7 @@ def load_checkpoint(model, optimizer, lr_scheduler, config, logger):
 
 
 def save_checkpoint(checkpoint_dir, model, optimizer, lr_scheduler, 
-                    epoch, model_config, results, tokenizer=None, accelerator=None, best=False):
+                    epoch, model_config, results, tokenizer=None, accelerator=None, best=False, pruner=None):
     os.makedirs(checkpoint_dir, exist_ok=True)
 
     # epoch_dir = os.path.join(checkpoint_dir, f'epoch{epoch}')
@@ -69,6 +75,9 @@ def save_checkpoint(checkpoint_dir, model, optimizer, lr_scheduler,
                   'epoch': epoch,
                   'model_config': model_config_dict,
                   'metric': results}
+    if pruner is not None:
+        # Step, schedule & bit-packed masks to resume pruning
+        save_state['pruner'] = pruner.state_dict()
 
     if best:
         # Delete previous checkpoints